@@ -0,0 +1,86 @@
+"""Chuẩn bị môi trường chung cho các script đo hiệu năng trong bench/"""
+
+import os
+import sys
+import tempfile
+from datetime import datetime, timezone
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def use_backend(database_url: str | None = None) -> str:
+    """Cho phép import các module của BackEnd và chọn cơ sở dữ liệu: mặc định là một
+    file SQLite tạm. Phải gọi trước khi import database/main. Thư mục làm việc được
+    chuyển sang thư mục tạm để file tải lên không rơi vào uploads/ thật."""
+    work_dir = tempfile.mkdtemp(prefix="chat-bench-")
+    os.environ["DATABASE_URL"] = (
+        database_url
+        or os.environ.get("DATABASE_URL")
+        or f"sqlite:///{os.path.join(work_dir, 'bench.db')}"
+    )
+    os.chdir(work_dir)
+    sys.path.insert(0, BACKEND_DIR)
+    return os.environ["DATABASE_URL"]
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(samples: list[float]) -> str:
+    """p50/p95/p99/max của các mẫu thời gian (giây), in theo mili giây"""
+    return " ".join(
+        f"{name}={percentile(samples, fraction) * 1000:.2f}ms"
+        for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1))
+    )
+
+
+def create_group(
+    users: int, messages: int, prefix: str = "bench"
+) -> tuple[int, list[str]]:
+    """Tạo user, một nhóm chứa tất cả và một lượng tin nhắn; trả về (nhóm, token)"""
+    import models
+    from database import SessionLocal
+    from routers.untils import create_access_token
+
+    now = datetime.now(timezone.utc)
+    with SessionLocal() as db:
+        accounts = [
+            models.User(
+                username=f"{prefix}{index}",
+                nickname=f"{prefix} {index}",
+                email=f"{prefix}{index}@example.com",
+                password_hash="x",
+                created_at_UTC=now,
+            )
+            for index in range(users)
+        ]
+        db.add_all(accounts)
+        group = models.Conversation(type="group", name="Bench", created_at_UTC=now)
+        db.add(group)
+        db.flush()
+        db.add_all(
+            models.GroupMember(
+                conversation_id=group.conversation_id,
+                username=account.username,
+                joined_at_UTC=now,
+            )
+            for account in accounts
+        )
+        db.add_all(
+            models.Message(
+                sender_id=accounts[index % users].user_id,
+                conversation_id=group.conversation_id,
+                content=f"tin {index}",
+                timestamp=now,
+                is_read=False,
+            )
+            for index in range(messages)
+        )
+        db.commit()
+        tokens = [
+            create_access_token({"sub": account.username, "user_id": account.user_id})
+            for account in accounts
+        ]
+        return group.conversation_id, tokens
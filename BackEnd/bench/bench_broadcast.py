@@ -0,0 +1,121 @@
+"""Đo độ trễ gửi tin vào nhóm lớn khi một phần người nhận có kết nối chậm hoặc treo.
+
+    python bench/bench_broadcast.py --sizes 10 100 500 --slow 0.2 --hanging 0.05
+
+Mỗi thành viên có một WebSocket giả nối vào websocket_manager: socket chậm mất
+--slow-delay giây cho mỗi lần gửi, socket treo không bao giờ gửi xong. Độ trễ của
+POST /messages/ phải gần như không đổi theo kích thước nhóm vì handler chỉ đưa tin
+vào hàng đợi; in thêm số tin đã giao tới các socket khỏe sau mỗi vòng."""
+
+import argparse
+import asyncio
+import time
+
+from _setup import create_group, summarize, use_backend
+
+
+class FakeWebSocket:
+    """Giả lập đủ giao diện WebSocket mà websocket_manager dùng"""
+
+    def __init__(self, delay: float = 0, hanging: bool = False):
+        self.delay = delay
+        self.hanging = hanging
+        self.received = 0
+        self.close_code = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message: str):
+        if self.hanging:
+            await asyncio.Event().wait()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.received += 1
+
+    async def close(self, code: int = 1000):
+        self.close_code = code
+
+
+async def run_group(app, size: int, args) -> tuple[list[float], int, int, int]:
+    import httpx
+    from routers.presence import presence_service
+    from routers.websocket import websocket_manager
+
+    conversation_id, tokens = create_group(size, 0, prefix=f"g{size}_")
+    sockets = []
+    slow = int(size * args.slow)
+    hanging = int(size * args.hanging)
+    # Người gửi (thành viên 0) luôn có kết nối khỏe
+    for index in range(size):
+        if 0 < index <= hanging:
+            websocket = FakeWebSocket(hanging=True)
+        elif hanging < index <= hanging + slow:
+            websocket = FakeWebSocket(delay=args.slow_delay)
+        else:
+            websocket = FakeWebSocket()
+        await websocket_manager.connect(websocket, "user", f"g{size}_{index}")
+        sockets.append(websocket)
+
+    headers = {"Authorization": f"Bearer {tokens[0]}"}
+    latencies: list[float] = []
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    client = httpx.AsyncClient(transport=transport, base_url="http://bench")
+    async with client:
+        for index in range(args.messages):
+            started = time.perf_counter()
+            response = await client.post(
+                "/messages/",
+                params={"conversation_id": conversation_id, "content": f"tin {index}"},
+                headers=headers,
+            )
+            latencies.append(time.perf_counter() - started)
+            response.raise_for_status()
+
+    # Cho các task ghi xả hàng đợi của socket khỏe trước khi đếm
+    await asyncio.sleep(0.1)
+    # Người gửi không nhận lại tin của chính mình
+    healthy = [ws for ws in sockets[1:] if not ws.hanging and not ws.delay]
+    delivered = sum(ws.received for ws in healthy)
+    expected = len(healthy) * args.messages
+    closed = sum(ws.close_code is not None for ws in sockets)
+
+    for index, websocket in enumerate(sockets):
+        websocket_manager.disconnect(websocket, "user", f"g{size}_{index}")
+    # Chờ các task báo offline cho bạn bè (mở phiên DB) chạy xong
+    await asyncio.gather(*presence_service._tasks)
+    return latencies, delivered, expected, closed
+
+
+async def run(app, args):
+    from database import async_engine
+
+    for size in args.sizes:
+        latencies, delivered, expected, closed = await run_group(app, size, args)
+        print(
+            f"Nhóm {size:>5} thành viên: {summarize(latencies)}, "
+            f"socket khỏe nhận {delivered}/{expected} tin, {closed} socket bị đóng"
+        )
+    # Đóng các kết nối async (luồng của aiosqlite giữ tiến trình không thoát)
+    await async_engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--messages", type=int, default=50, help="Số tin mỗi nhóm")
+    parser.add_argument("--slow", type=float, default=0.2, help="Tỉ lệ socket chậm")
+    parser.add_argument("--slow-delay", type=float, default=0.05)
+    parser.add_argument("--hanging", type=float, default=0.05, help="Tỉ lệ socket treo")
+    args = parser.parse_args()
+    print(f"Cơ sở dữ liệu: {use_backend()}")
+
+    from database import Base, engine
+    from main import app
+
+    Base.metadata.create_all(bind=engine)
+    asyncio.run(run(app, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Tải thử pool kết nối: nhiều client đồng thời gọi API và theo dõi pool bão hòa.
+
+    python bench/bench_db_pool.py --clients 200 --pool-size 5 --max-overflow 5
+
+Gọi thẳng ứng dụng ASGI trong tiến trình (không qua mạng). Mặc định dùng một file
+SQLite tạm; đặt DATABASE_URL để đo trên MySQL. In số kết nối đang mượn cao nhất của
+từng pool, độ trễ và số request lỗi (vd. 500 khi chờ pool quá DB_POOL_TIMEOUT)."""
+
+import argparse
+import asyncio
+import os
+import time
+from collections import Counter
+
+from _setup import create_group, summarize, use_backend
+
+# Route async dùng pool của engine async, route đồng bộ dùng pool của engine đồng bộ
+ENDPOINTS = {
+    "messages": "/messages/{conversation_id}/messages?limit=20",
+    "conversations": "/conversations/",
+    "profile": "/users/",
+}
+
+
+async def run(app, url: str, tokens: list[str], clients: int, requests: int):
+    import httpx
+    from database import async_engine, get_pool_stats
+
+    peaks = Counter()
+    latencies: list[float] = []
+    statuses: Counter = Counter()
+    done = asyncio.Event()
+
+    async def sample_pools():
+        while not done.is_set():
+            for name, stats in get_pool_stats().items():
+                peaks[name] = max(peaks[name], stats.get("checked_out", 0))
+            await asyncio.sleep(0.002)
+
+    async def client_loop(index: int, client: httpx.AsyncClient):
+        headers = {"Authorization": f"Bearer {tokens[index % len(tokens)]}"}
+        for _ in range(requests):
+            started = time.perf_counter()
+            try:
+                response = await client.get(url, headers=headers)
+                statuses[response.status_code] += 1
+            except Exception as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    client = httpx.AsyncClient(transport=transport, base_url="http://bench")
+    async with client:
+        sampler = asyncio.create_task(sample_pools())
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(i, client) for i in range(clients)))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await sampler
+    # Đóng các kết nối async (luồng của aiosqlite giữ tiến trình không thoát)
+    await async_engine.dispose()
+    return elapsed, latencies, statuses, peaks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--endpoint", choices=ENDPOINTS, default="messages")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=20, help="Số request/client")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--pool-size", type=int)
+    parser.add_argument("--max-overflow", type=int)
+    parser.add_argument("--pool-timeout", type=float)
+    args = parser.parse_args()
+
+    # Cấu hình pool được đọc lúc import database nên phải đặt trước
+    for option, variable in (
+        (args.pool_size, "DB_POOL_SIZE"),
+        (args.max_overflow, "DB_MAX_OVERFLOW"),
+        (args.pool_timeout, "DB_POOL_TIMEOUT"),
+    ):
+        if option is not None:
+            os.environ[variable] = str(option)
+    print(f"Cơ sở dữ liệu: {use_backend()}")
+
+    from database import DB_MAX_OVERFLOW, DB_POOL_SIZE, DB_POOL_TIMEOUT, Base, engine
+    from main import app
+
+    Base.metadata.create_all(bind=engine)
+    conversation_id, tokens = create_group(args.users, args.messages)
+    url = ENDPOINTS[args.endpoint].format(conversation_id=conversation_id)
+
+    print(
+        f"pool_size={DB_POOL_SIZE} max_overflow={DB_MAX_OVERFLOW} "
+        f"timeout={DB_POOL_TIMEOUT}s, {args.clients} client x {args.requests} request"
+        f" -> GET {url}"
+    )
+    elapsed, latencies, statuses, peaks = asyncio.run(
+        run(app, url, tokens, args.clients, args.requests)
+    )
+    print(f"Thông lượng: {len(latencies) / elapsed:.0f} request/s")
+    print(f"Độ trễ: {summarize(latencies)}")
+    print(f"Mã trạng thái: {dict(statuses)}")
+    print(
+        "Kết nối mượn cao nhất: "
+        + ", ".join(f"{name}={count}" for name, count in sorted(peaks.items()))
+        + f" (giới hạn mỗi pool {DB_POOL_SIZE + DB_MAX_OVERFLOW})"
+    )
+
+
+if __name__ == "__main__":
+    main()
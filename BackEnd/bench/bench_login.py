@@ -0,0 +1,116 @@
+"""Đo đăng nhập khi nhiều client đăng nhập cùng lúc: thông lượng, độ trễ, thời gian
+chờ trong pool băm mật khẩu và độ trễ của event loop.
+
+    python bench/bench_login.py --clients 50 --logins 4 --workers 4
+
+bcrypt chạy trong password_hash_pool nên event loop vẫn phải phản hồi nhanh dù pool
+đang bận; độ trễ loop được đo bằng một task ngủ 10 ms liên tục và ghi lại phần
+thức dậy muộn. Tăng --workers để xem thời gian chờ trong pool giảm theo số lõi."""
+
+import argparse
+import asyncio
+import os
+import time
+from collections import Counter
+
+from _setup import create_group, summarize, use_backend
+
+PASSWORD = "Matkhau123@"
+TICK = 0.01
+
+
+async def run(app, usernames: list[str], clients: int, logins: int):
+    import httpx
+    from database import async_engine
+
+    latencies: list[float] = []
+    lags: list[float] = []
+    statuses: Counter = Counter()
+    done = asyncio.Event()
+
+    async def watch_loop():
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(TICK)
+            lags.append(max(0.0, time.perf_counter() - started - TICK))
+
+    async def client_loop(index: int, client: httpx.AsyncClient):
+        form = {"username": usernames[index % len(usernames)], "password": PASSWORD}
+        for _ in range(logins):
+            started = time.perf_counter()
+            try:
+                response = await client.post("/auth/login", data=form)
+                statuses[response.status_code] += 1
+            except Exception as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    client = httpx.AsyncClient(transport=transport, base_url="http://bench")
+    async with client:
+        watcher = asyncio.create_task(watch_loop())
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(i, client) for i in range(clients)))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await watcher
+    # Đóng các kết nối async (luồng của aiosqlite giữ tiến trình không thoát)
+    await async_engine.dispose()
+    return elapsed, latencies, lags, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--logins", type=int, default=4, help="Số lần đăng nhập/client")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--workers", type=int, help="PASSWORD_HASH_WORKERS")
+    args = parser.parse_args()
+
+    # Số luồng của pool được đọc lúc import nên phải đặt trước
+    if args.workers is not None:
+        os.environ["PASSWORD_HASH_WORKERS"] = str(args.workers)
+    print(f"Cơ sở dữ liệu: {use_backend()}")
+
+    import models
+    from database import Base, SessionLocal, engine
+
+    # Tạo bảng trước khi import main (main tạo admin mặc định ngay lúc import)
+    Base.metadata.create_all(bind=engine)
+    from main import app
+    from routers.password_pool import password_hash_pool
+    from routers.untils import hash_password
+
+    create_group(args.users, 0)
+    # Dùng chung một mã băm thật cho mọi user (băm từng user chỉ làm chậm khâu chuẩn bị)
+    password_hash = hash_password(PASSWORD)
+    with SessionLocal() as db:
+        usernames = [
+            user.username
+            for user in db.query(models.User).filter(models.User.username != "admin")
+        ]
+        db.query(models.User).filter(models.User.username.in_(usernames)).update(
+            {models.User.password_hash: password_hash}
+        )
+        db.commit()
+
+    print(
+        f"{args.clients} client x {args.logins} lần đăng nhập, "
+        f"pool băm mật khẩu {password_hash_pool.workers} luồng"
+    )
+    elapsed, latencies, lags, statuses = asyncio.run(
+        run(app, usernames, args.clients, args.logins)
+    )
+    stats = password_hash_pool.stats()
+    print(f"Thông lượng: {len(latencies) / elapsed:.1f} lần đăng nhập/s")
+    print(f"Độ trễ: {summarize(latencies)}")
+    print(f"Mã trạng thái: {dict(statuses)}")
+    print(
+        f"Pool băm mật khẩu: chờ tb {stats['avg_queue_ms']}ms, "
+        f"chờ tối đa {stats['max_queue_ms']}ms, chạy tb {stats['avg_run_ms']}ms"
+    )
+    print(f"Độ trễ event loop: {summarize(lags)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Đo độ trễ /users/search trên bảng user tổng hợp (mặc định 1 triệu user).
+
+    python bench/bench_user_search.py --users 1000000 --queries 2000
+
+Mặc định dùng một file SQLite tạm; đặt DATABASE_URL để đo trên MySQL. Mỗi truy vấn
+là một tiền tố 1-4 ký tự lấy ngẫu nhiên từ username hoặc nickname có thật, gọi thẳng
+hàm route nên đo cả bước tra trạng thái kết bạn."""
+
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+
+from _setup import summarize, use_backend
+
+FAMILY_NAMES = ["Nguyễn", "Trần", "Lê", "Phạm", "Hoàng", "Huỳnh", "Phan", "Vũ", "Đặng"]
+MIDDLE_NAMES = ["Văn", "Thị", "Hữu", "Đức", "Minh", "Ngọc", "Thanh", "Quốc", ""]
+GIVEN_NAMES = ["An", "Bình", "Châu", "Dũng", "Giang", "Hà", "Hải", "Khánh", "Linh"]
+GIVEN_NAMES += ["Long", "Mai", "Nam", "Phúc", "Quân", "Sơn", "Tâm", "Thảo", "Vy"]
+
+
+def populate(db, users: int, batch_size: int = 20000):
+    import models
+    from routers.search import normalize_text, user_search_terms
+    from types import SimpleNamespace
+
+    now = datetime.now(timezone.utc)
+    for start in range(0, users, batch_size):
+        user_rows, term_rows = [], []
+        for user_id in range(start + 1, min(start + batch_size, users) + 1):
+            nickname = " ".join(
+                name
+                for name in (
+                    random.choice(FAMILY_NAMES),
+                    random.choice(MIDDLE_NAMES),
+                    random.choice(GIVEN_NAMES),
+                )
+                if name
+            )
+            username = normalize_text(nickname).replace(" ", "") + str(user_id)
+            user_rows.append(
+                {
+                    "user_id": user_id,
+                    "username": username,
+                    "nickname": nickname,
+                    "email": f"{username}@example.com",
+                    "password_hash": "x",
+                    "is_admin": False,
+                    "created_at_UTC": now,
+                }
+            )
+            user = SimpleNamespace(username=username, nickname=nickname)
+            term_rows.extend(
+                {"field": field, "term": term, "user_id": user_id}
+                for field, term in user_search_terms(user)
+            )
+        db.execute(models.User.__table__.insert(), user_rows)
+        db.execute(models.UserSearchTerm.__table__.insert(), term_rows)
+        db.commit()
+        print(f"  đã tạo {min(start + batch_size, users)}/{users} user", end="\r")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    print(f"Cơ sở dữ liệu: {use_backend()}")
+
+    import models
+    from database import Base, SessionLocal, engine
+    from fastapi import Response
+    from routers.users import search_users
+    from sqlalchemy import event
+
+    Base.metadata.create_all(bind=engine)
+
+    # Thời gian nằm trong cơ sở dữ liệu, tách khỏi phần xử lý Python của route
+    sql_time = [0.0]
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["query_started"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        sql_time[0] += time.perf_counter() - conn.info.pop("query_started")
+
+    with SessionLocal() as db:
+        started = time.perf_counter()
+        populate(db, args.users)
+        print(f"Tạo dữ liệu: {time.perf_counter() - started:.1f}s")
+
+        samples = random.sample(range(1, args.users + 1), min(200, args.users))
+        names = {
+            user_id: (username, nickname)
+            for user_id, username, nickname in db.query(
+                models.User.user_id, models.User.username, models.User.nickname
+            ).filter(models.User.user_id.in_(samples))
+        }
+        current_user = models.User(user_id=0, username="bench", nickname="Bench")
+
+        loop = asyncio.new_event_loop()
+        timings = {False: [], True: []}
+        sql_timings = []
+        for _ in range(args.queries):
+            username, nickname = names[random.choice(samples)]
+            by_nickname = random.random() < 0.5
+            source = nickname if by_nickname else username
+            query = source[: random.randint(1, 4)]
+            sql_time[0] = 0.0
+            started = time.perf_counter()
+            loop.run_until_complete(
+                search_users(
+                    Response(), query, by_nickname, args.limit, None, db, current_user
+                )
+            )
+            timings[by_nickname].append(time.perf_counter() - started)
+            sql_timings.append(sql_time[0])
+            db.rollback()
+        loop.close()
+
+    print(f"username: {summarize(timings[False])}")
+    print(f"nickname: {summarize(timings[True])}")
+    print(f"tất cả:   {summarize(timings[False] + timings[True])}")
+    print(f"chỉ SQL:  {summarize(sql_timings)}")
+
+
+if __name__ == "__main__":
+    main()
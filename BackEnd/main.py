@@ -1,4 +1,5 @@
 import os
+from contextlib import asynccontextmanager
 from datetime import datetime
 
 from database import SessionLocal
@@ -14,7 +15,16 @@ from routers.friends import friends_router
 from routers.friends_requests import friend_request_router
 from routers.messages import messages_router
 from routers.notifications import notifications_router
+from routers.presence import last_active_tracker, presence_service
+from routers.search import search_router
+from routers.thumbnails import thumbnail_pipeline
 from routers.untils import pwd_context
+from routers.upload_sessions import (
+    start_upload_session_gc,
+    stop_upload_session_gc,
+    upload_sessions_router,
+)
+from routers.uploads import blobs_router
 from routers.users import users_router
 from routers.websocket import websocket_manager
 
@@ -52,7 +62,28 @@ def create_default_admin():
 # 💡 Gọi hàm ngay khi ứng dụng khởi động
 create_default_admin()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Kết nối broker pub/sub để phát WebSocket giữa các worker
+    await websocket_manager.start()
+    # Ghi last_active_UTC xuống DB theo lô
+    await last_active_tracker.start()
+    # Dọn các kết nối không còn gửi heartbeat
+    await presence_service.start()
+    # Dọn các phiên tải lên theo phần đã hết hạn
+    await start_upload_session_gc()
+    # Tạo ảnh thu nhỏ cho file đính kèm ở nền
+    await thumbnail_pipeline.start()
+    yield
+    await thumbnail_pipeline.stop()
+    await stop_upload_session_gc()
+    await presence_service.stop()
+    await last_active_tracker.stop()
+    await websocket_manager.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Thêm middleware CORS
 app.add_middleware(
@@ -73,6 +104,10 @@ app.include_router(friend_request_router)
 app.include_router(friends_router)
 app.include_router(notifications_router)
 app.include_router(admin_router)
+app.include_router(upload_sessions_router)
+app.include_router(search_router)
+# Phải đăng ký trước mount /uploads để blob được phục vụ kèm ETag và Cache-Control
+app.include_router(blobs_router)
 
 
 # WebSocket Endpoint
@@ -82,15 +117,22 @@ async def websocket_endpoint(websocket: WebSocket, user_type: str, username: str
     await websocket_manager.connect(websocket, user_type, username)
     try:
         while True:
-            await websocket.receive_text()  # Lắng nghe tin nhắn (không làm gì)
+            # Mọi tin client gửi lên (vd. "ping") đều được coi là heartbeat
+            await websocket.receive_text()
+            presence_service.heartbeat(
+                websocket, username if user_type == "user" else None
+            )
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Luôn gỡ đúng socket này, kể cả khi kết nối đóng vì lỗi khác
         websocket_manager.disconnect(websocket, user_type, username)
 
 
 @app.get("/ws/active-connections")
 async def get_active_connections():
     """Trả về danh sách các kết nối WebSocket đang hoạt động"""
-    active_users = list(websocket_manager.active_connections["user"].keys())
+    active_users = presence_service.online_usernames()
     active_admins = len(websocket_manager.active_connections["admin"])  # Đếm số admin
 
     return JSONResponse(
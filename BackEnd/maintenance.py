@@ -0,0 +1,454 @@
+"""Các lệnh bảo trì dữ liệu, chạy thủ công: python maintenance.py <lệnh>"""
+
+import argparse
+import hashlib
+import os
+import time
+
+import models
+from database import Base, SessionLocal, engine
+from routers.search import index_message, user_search_terms
+from routers.thumbnails import generate_thumbnail, supports_thumbnail
+from routers.untils import ATTACHMENT_BLOBS_DIR, THUMBNAILS_DIR
+from routers.uploads import (
+    BLOB_FILENAME,
+    UPLOAD_TEMP_DIR,
+    blob_file_lock,
+    blob_url,
+    thumbnail_url,
+)
+from sqlalchemy import func, inspect, or_, select, text, update
+from sqlalchemy.orm import Session, aliased
+
+
+def add_missing_columns(table_name: str):
+    """Thêm các cột và index có trong models nhưng chưa có trong bảng (create_all
+    không tự làm với bảng đã tồn tại)"""
+    table = Base.metadata.tables[table_name]
+    existing = {column["name"] for column in inspect(engine).get_columns(table_name)}
+
+    with engine.begin() as connection:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            ddl = f"ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}"
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+            if not column.nullable:
+                ddl += " NOT NULL"
+            connection.execute(text(ddl))
+            print(f"Đã thêm cột {table_name}.{column.name}")
+
+    existing = {index["name"] for index in inspect(engine).get_indexes(table_name)}
+    for index in table.indexes:
+        if index.name in existing:
+            continue
+        index.create(bind=engine, checkfirst=True)
+        print(f"Đã tạo index {index.name}")
+
+
+def rebuild_conversation_stats(db: Session) -> int:
+    """Tính lại last_message_id, last_message_at, message_count cho mọi cuộc hội thoại"""
+    stats = (
+        db.query(
+            models.Message.conversation_id,
+            func.max(models.Message.message_id).label("last_message_id"),
+            func.count(models.Message.message_id).label("message_count"),
+        )
+        .group_by(models.Message.conversation_id)
+        .subquery()
+    )
+    rows = (
+        db.query(
+            models.Conversation.conversation_id,
+            stats.c.last_message_id,
+            models.Message.timestamp,
+            func.coalesce(stats.c.message_count, 0),
+        )
+        .outerjoin(
+            stats, stats.c.conversation_id == models.Conversation.conversation_id
+        )
+        .outerjoin(models.Message, models.Message.message_id == stats.c.last_message_id)
+        .all()
+    )
+
+    db.bulk_update_mappings(
+        models.Conversation,
+        [
+            {
+                "conversation_id": conversation_id,
+                "last_message_id": last_message_id,
+                "last_message_at": last_message_at,
+                "message_count": message_count,
+            }
+            for conversation_id, last_message_id, last_message_at, message_count in rows
+        ],
+    )
+    db.commit()
+    return len(rows)
+
+
+def backfill_read_cursors(db: Session) -> int:
+    """Khởi tạo last_read_message_id từ cờ is_read cũ: con trỏ của mỗi thành viên là
+    tin nhắn mới nhất đã được đánh dấu đọc hoặc do chính thành viên đó gửi"""
+    member_user_id = (
+        select(models.User.user_id)
+        .where(models.User.username == models.GroupMember.username)
+        .scalar_subquery()
+    )
+    last_read = (
+        select(func.max(models.Message.message_id))
+        .where(
+            models.Message.conversation_id == models.GroupMember.conversation_id,
+            or_(
+                models.Message.is_read == True,
+                models.Message.sender_id == member_user_id,
+            ),
+        )
+        .scalar_subquery()
+    )
+    result = db.execute(
+        update(models.GroupMember)
+        .where(models.GroupMember.last_read_message_id.is_(None))
+        .values(last_read_message_id=last_read)
+    )
+    db.commit()
+    return result.rowcount
+
+
+def backfill_attachment_metadata(db: Session) -> int:
+    """Tính file_size và content_hash cho các file đính kèm tải lên trước khi có cột"""
+    attachments = (
+        db.query(models.Attachment)
+        .filter(models.Attachment.content_hash.is_(None))
+        .all()
+    )
+    count = 0
+    for attachment in attachments:
+        if not os.path.isfile(attachment.file_url):
+            continue
+        hasher = hashlib.sha256()
+        with open(attachment.file_url, "rb") as file:
+            while chunk := file.read(1024 * 1024):
+                hasher.update(chunk)
+        attachment.file_size = os.path.getsize(attachment.file_url)
+        attachment.content_hash = hasher.hexdigest()
+        count += 1
+    db.commit()
+    return count
+
+
+def migrate_attachments_to_blobs(db: Session) -> int:
+    """Chuyển file đính kèm cũ (uploads/conversations/...) vào kho blob theo SHA-256,
+    các bản trùng nội dung chỉ giữ lại một file"""
+    attachments = (
+        db.query(models.Attachment)
+        .filter(
+            models.Attachment.content_hash.isnot(None),
+            models.Attachment.file_url.notlike("uploads/blobs/%"),
+        )
+        .all()
+    )
+    count = 0
+    for attachment in attachments:
+        extension = attachment.file_url.rsplit(".", 1)[-1].lower()
+        target = blob_url(attachment.content_hash, extension)
+        if os.path.isfile(attachment.file_url):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(attachment.file_url, target)
+        elif not os.path.isfile(target):
+            continue
+        attachment.file_url = target
+        count += 1
+    db.commit()
+    return count
+
+
+def _is_referenced(db: Session, column, value) -> bool:
+    """Còn Attachment nào có column == value, đọc theo dữ liệu mới nhất"""
+    # Kết thúc transaction đang mở: MySQL (REPEATABLE READ) vẫn đọc theo snapshot cũ
+    db.rollback()
+    return (
+        db.query(models.Attachment.attachment_id).filter(column == value).first()
+        is not None
+    )
+
+
+def collect_unreferenced_blobs(db: Session, temp_max_age: int = 24 * 3600) -> int:
+    """Xóa blob không còn Attachment nào tham chiếu và file tạm tải lên bị bỏ dở.
+    Mỗi blob được kiểm tra lại trong khóa blob dùng chung với server, nên có thể chạy
+    khi server đang hoạt động (trừ trên Windows, nơi không có khóa liên tiến trình)"""
+    referenced = {
+        file_url
+        for (file_url,) in db.query(models.Attachment.file_url)
+        .filter(models.Attachment.file_url.like("uploads/blobs/%"))
+        .distinct()
+    }
+    removed = 0
+    for directory, _, filenames in os.walk(ATTACHMENT_BLOBS_DIR):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if os.path.normpath(directory) == os.path.normpath(UPLOAD_TEMP_DIR):
+                if os.path.getmtime(path) > time.time() - temp_max_age:
+                    continue
+                os.remove(path)
+                removed += 1
+                continue
+
+            file_url = path.replace(os.sep, "/")
+            match = BLOB_FILENAME.fullmatch(filename)
+            if file_url in referenced or match is None:
+                continue
+            with blob_file_lock(match.group(1)):
+                # Danh sách tham chiếu ở trên có thể đã cũ: kiểm tra lại trong khóa
+                if _is_referenced(db, models.Attachment.file_url, file_url):
+                    continue
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+def backfill_thumbnails(db: Session) -> int:
+    """Tạo ảnh thu nhỏ còn thiếu (file tải lên trước khi có pipeline hoặc bị bỏ qua
+    khi hàng đợi đầy), mỗi nội dung chỉ xử lý một lần"""
+    rows = (
+        db.query(models.Attachment.content_hash, models.Attachment.file_url)
+        .filter(
+            models.Attachment.content_hash.isnot(None),
+            models.Attachment.thumbnail_url.is_(None),
+        )
+        .distinct()
+        .all()
+    )
+    count = 0
+    done = set()
+    for content_hash, file_url in rows:
+        if content_hash in done or not supports_thumbnail(file_url):
+            continue
+        if not os.path.isfile(file_url):
+            continue
+        try:
+            size = generate_thumbnail(file_url, thumbnail_url(content_hash))
+        except Exception as e:
+            print(f"Không tạo được ảnh thu nhỏ cho {file_url}: {e}")
+            continue
+        if size is None:
+            continue
+        db.execute(
+            update(models.Attachment)
+            .where(models.Attachment.content_hash == content_hash)
+            .values(
+                thumbnail_url=thumbnail_url(content_hash),
+                width=size[0],
+                height=size[1],
+            )
+        )
+        db.commit()
+        done.add(content_hash)
+        count += 1
+    return count
+
+
+def collect_unreferenced_thumbnails(db: Session) -> int:
+    """Xóa ảnh thu nhỏ không còn file đính kèm nào cùng nội dung. Như
+    collect_unreferenced_blobs, mỗi ảnh được kiểm tra lại trong khóa blob nên có thể
+    chạy khi server đang hoạt động"""
+    referenced = {
+        content_hash
+        for (content_hash,) in db.query(models.Attachment.content_hash)
+        .filter(models.Attachment.content_hash.isnot(None))
+        .distinct()
+    }
+    removed = 0
+    for directory, _, filenames in os.walk(THUMBNAILS_DIR):
+        for filename in filenames:
+            match = BLOB_FILENAME.fullmatch(filename)
+            # Bỏ qua file tạm của ThumbnailPipeline đang ghi dở
+            if match is None or match.group(1) in referenced:
+                continue
+            content_hash = match.group(1)
+            with blob_file_lock(content_hash):
+                # Một tin nhắn cùng nội dung có thể vừa commit sau lần đọc ở trên
+                if _is_referenced(db, models.Attachment.content_hash, content_hash):
+                    continue
+                os.remove(os.path.join(directory, filename))
+                removed += 1
+    return removed
+
+
+def backfill_deleted_flags(db: Session) -> int:
+    """Đánh dấu is_deleted cho các tin nhắn bị xóa trước khi có cột, nhận ra qua nội
+    dung mà delete_message ghi đè lên"""
+    result = db.execute(
+        update(models.Message)
+        .where(
+            models.Message.is_deleted == False,
+            models.Message.content.like("Tin nhắn đã bị xóa bởi %"),
+        )
+        .values(is_deleted=True)
+    )
+    db.commit()
+    return result.rowcount
+
+
+def rebuild_search_index(db: Session, batch_size: int = 1000) -> int:
+    """Dựng lại chỉ mục tìm kiếm tin nhắn từ đầu, theo từng lô tin nhắn"""
+    db.query(models.MessageSearchTerm).delete()
+    db.commit()
+
+    count = 0
+    last_id = 0
+    while True:
+        messages = (
+            db.query(models.Message)
+            .filter(models.Message.message_id > last_id)
+            .order_by(models.Message.message_id)
+            .limit(batch_size)
+            .all()
+        )
+        if not messages:
+            break
+        last_id = messages[-1].message_id
+        for message in messages:
+            index_message(db, message)
+        db.commit()
+        db.expunge_all()
+        count += len(messages)
+    return count
+
+
+def rebuild_user_search_index(db: Session, batch_size: int = 1000) -> int:
+    """Dựng lại chỉ mục tìm kiếm user (username, nickname đã bỏ dấu), theo từng lô
+    user"""
+    db.query(models.UserSearchTerm).delete()
+    db.commit()
+
+    count = 0
+    last_id = 0
+    while True:
+        users = (
+            db.query(models.User.user_id, models.User.username, models.User.nickname)
+            .filter(models.User.user_id > last_id)
+            .order_by(models.User.user_id)
+            .limit(batch_size)
+            .all()
+        )
+        if not users:
+            break
+        last_id = users[-1].user_id
+        db.bulk_insert_mappings(
+            models.UserSearchTerm,
+            [
+                {"field": field, "term": term, "user_id": user.user_id}
+                for user in users
+                for field, term in user_search_terms(user)
+            ],
+        )
+        db.commit()
+        count += len(users)
+    return count
+
+
+def mirror_friendships(db: Session) -> int:
+    """Chuyển bạn bè lưu một chiều sang dạng hai dòng đối xứng: thêm dòng (b, a) còn
+    thiếu cho mỗi dòng (a, b)"""
+    Reverse = aliased(models.Friend)
+    missing = (
+        db.query(
+            models.Friend.user_username,
+            models.Friend.friend_username,
+            models.Friend.created_at_UTC,
+        )
+        .outerjoin(
+            Reverse,
+            (Reverse.user_username == models.Friend.friend_username)
+            & (Reverse.friend_username == models.Friend.user_username),
+        )
+        .filter(Reverse.id.is_(None))
+        .all()
+    )
+    db.bulk_insert_mappings(
+        models.Friend,
+        [
+            {
+                "user_username": friend_username,
+                "friend_username": user_username,
+                "created_at_UTC": created_at,
+            }
+            for user_username, friend_username, created_at in missing
+        ],
+    )
+    db.commit()
+    return len(missing)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bảo trì dữ liệu ứng dụng chat")
+    parser.add_argument(
+        "command",
+        choices=[
+            "conversation-stats",
+            "read-cursors",
+            "attachments",
+            "thumbnails",
+            "search-index",
+            "friendships",
+        ],
+        help=(
+            "conversation-stats: thêm cột thiếu và tính lại tin nhắn cuối/số tin nhắn; "
+            "read-cursors: thêm cột thiếu và khởi tạo con trỏ đã đọc của thành viên; "
+            "attachments: thêm cột thiếu, tính kích thước/SHA-256 của file đính kèm, "
+            "chuyển file cũ vào kho blob và dọn blob không còn được dùng; "
+            "thumbnails: thêm cột thiếu, tạo ảnh thu nhỏ còn thiếu và dọn ảnh thừa; "
+            "search-index: thêm cột thiếu, đánh dấu tin nhắn đã xóa và dựng lại chỉ "
+            "mục tìm kiếm tin nhắn và user; "
+            "friendships: chuyển quan hệ bạn bè sang dạng hai dòng đối xứng"
+        ),
+    )
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.command == "conversation-stats":
+            add_missing_columns("conversations")
+            add_missing_columns("messages")
+            count = rebuild_conversation_stats(db)
+            print(f"Đã cập nhật {count} cuộc hội thoại.")
+        elif args.command == "read-cursors":
+            add_missing_columns("group_members")
+            count = backfill_read_cursors(db)
+            print(f"Đã khởi tạo con trỏ đọc cho {count} thành viên.")
+        elif args.command == "attachments":
+            add_missing_columns("attachments")
+            count = backfill_attachment_metadata(db)
+            print(f"Đã cập nhật {count} file đính kèm.")
+            count = migrate_attachments_to_blobs(db)
+            print(f"Đã chuyển {count} file đính kèm vào kho blob.")
+            count = collect_unreferenced_blobs(db)
+            print(f"Đã xóa {count} blob/file tạm không còn dùng.")
+        elif args.command == "thumbnails":
+            add_missing_columns("attachments")
+            count = backfill_thumbnails(db)
+            print(f"Đã tạo {count} ảnh thu nhỏ.")
+            count = collect_unreferenced_thumbnails(db)
+            print(f"Đã xóa {count} ảnh thu nhỏ không còn dùng.")
+        elif args.command == "search-index":
+            add_missing_columns("messages")
+            add_missing_columns("message_search_terms")
+            add_missing_columns("user_search_terms")
+            count = backfill_deleted_flags(db)
+            print(f"Đã đánh dấu {count} tin nhắn đã xóa.")
+            count = rebuild_search_index(db)
+            print(f"Đã lập chỉ mục {count} tin nhắn.")
+            count = rebuild_user_search_index(db)
+            print(f"Đã lập chỉ mục {count} user.")
+        elif args.command == "friendships":
+            count = mirror_friendships(db)
+            print(f"Đã thêm {count} dòng bạn bè đối xứng.")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
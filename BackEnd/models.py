@@ -10,6 +10,7 @@ from sqlalchemy import (
     DateTime,
     Enum,
     ForeignKey,
+    Index,
     Integer,
     String,
     Text,
@@ -57,6 +58,10 @@ class Conversation(Base):
     type = Column(Enum("private", "group", name="conversation_type"), nullable=False)
     is_read = Column(Boolean, default=False, nullable=False)
     created_at_UTC = Column(DateTime(timezone=True), server_default=func.now())
+    # Con trỏ tới tin nhắn cuối, được cập nhật cùng transaction khi gửi/xóa tin nhắn
+    last_message_id = Column(Integer, nullable=True)
+    last_message_at = Column(DateTime(timezone=True), nullable=True)
+    message_count = Column(Integer, default=0, server_default="0", nullable=False)
 
     group_members = relationship("GroupMember", back_populates="conversation")
 
@@ -71,6 +76,8 @@ class GroupMember(Base):
     username = Column(String(255), ForeignKey("users.username", ondelete="CASCADE"))
     role = Column(Enum("admin", "member", name="group_role"), default="member")
     joined_at_UTC = Column(DateTime(timezone=True), server_default=func.now())
+    # Tin nhắn cuối cùng thành viên này đã đọc (con trỏ đọc riêng từng người)
+    last_read_message_id = Column(Integer, nullable=True)
 
     user = relationship("User", backref="group_members")
     conversation = relationship("Conversation", back_populates="group_members")
@@ -91,10 +98,20 @@ class Message(Base):
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
     is_read = Column(Boolean, default=False, nullable=False)
+    # Tin nhắn đã bị người gửi xóa (nội dung đã thay bằng thông báo, không lập chỉ mục)
+    is_deleted = Column(Boolean, default=False, server_default="0", nullable=False)
 
     sender = relationship(
         "User", foreign_keys=[sender_id], back_populates="sent_messages"
     )
+    attachments = relationship(
+        "Attachment", back_populates="message", passive_deletes=True
+    )
+
+    __table_args__ = (
+        # Phục vụ phân trang theo con trỏ (keyset) trong từng cuộc hội thoại
+        Index("ix_messages_conversation_message", "conversation_id", "message_id"),
+    )
 
 
 class Attachment(Base):
@@ -104,8 +121,69 @@ class Attachment(Base):
     message_id = Column(Integer, ForeignKey("messages.message_id", ondelete="CASCADE"))
     file_url = Column(String(255), nullable=False)
     file_type = Column(String(50), nullable=False)
+    file_size = Column(Integer, nullable=True)
+    # SHA-256 (hex) của nội dung file, tính trong lúc tải lên
+    content_hash = Column(String(64), nullable=True, index=True)
+    # Ảnh thu nhỏ (ảnh) hoặc khung hình đại diện (video), tạo nền sau khi tải lên
+    thumbnail_url = Column(String(255), nullable=True)
+    # Kích thước (px) của file gốc, để giao diện giữ chỗ đúng tỉ lệ
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
     uploaded_at_UTC = Column(DateTime(timezone=True), server_default=func.now())
 
+    message = relationship("Message", back_populates="attachments")
+
+
+class MessageSearchTerm(Base):
+    """Chỉ mục đảo phục vụ tìm kiếm tin nhắn: mỗi dòng là một từ (đã bỏ dấu, viết
+    thường) xuất hiện trong một tin nhắn"""
+
+    __tablename__ = "message_search_terms"
+
+    term = Column(String(64), primary_key=True)
+    message_id = Column(
+        Integer,
+        ForeignKey("messages.message_id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    conversation_id = Column(
+        Integer,
+        ForeignKey("conversations.conversation_id", ondelete="CASCADE"),
+        nullable=False,
+    )
+    # Số lần từ xuất hiện trong tin nhắn, dùng để xếp hạng kết quả
+    frequency = Column(Integer, nullable=False, default=1)
+
+    __table_args__ = (
+        # Tìm trong một cuộc hội thoại không phải quét mọi tin nhắn chứa từ đó
+        Index(
+            "ix_message_search_terms_term_conversation",
+            "term",
+            "conversation_id",
+            "message_id",
+        ),
+    )
+
+
+class UserSearchTerm(Base):
+    """Chỉ mục tìm user theo tiền tố: username và các từ của nickname đã bỏ dấu,
+    viết thường. Tìm bằng `term LIKE 'abc%'` đi theo index thay vì quét bảng users"""
+
+    __tablename__ = "user_search_terms"
+
+    field = Column(
+        Enum("username", "nickname", name="user_search_field"), primary_key=True
+    )
+    term = Column(String(64), primary_key=True)
+    user_id = Column(
+        Integer, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True
+    )
+
+    __table_args__ = (
+        # Tra các từ của một user: ghi lại chỉ mục và loại các dòng trùng khi tìm
+        Index("ix_user_search_terms_user", "user_id", "field", "term"),
+    )
+
 
 class FriendRequest(Base):
     __tablename__ = "friend_requests"
@@ -135,6 +213,9 @@ class FriendRequest(Base):
 
 
 class Friend(Base):
+    """Mỗi quan hệ bạn bè gồm hai dòng đối xứng (a, b) và (b, a), tạo bằng
+    routers.untils.new_friendship; tra cứu chỉ cần lọc theo user_username"""
+
     __tablename__ = "friends"
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
@@ -147,6 +228,7 @@ class Friend(Base):
     created_at_UTC = Column(DateTime(timezone=True), server_default=func.now())
 
     __table_args__ = (
+        # Đồng thời là index cho tra cứu (user_username) và (user_username, friend)
         UniqueConstraint("user_username", "friend_username", name="unique_friendship"),
         CheckConstraint("user_username != friend_username", name="no_self_friendship"),
     )
@@ -3,10 +3,14 @@ from datetime import datetime, timedelta, timezone
 from typing import List
 
 import models
-from database import get_db
+from database import get_db, get_pool_stats
 from fastapi import APIRouter, Depends, HTTPException, Query
 from models import Conversation, GroupMember, Notification, Report, User
+from routers.password_pool import password_hash_pool
+from routers.presence import presence_service
+from routers.thumbnails import thumbnail_pipeline
 from routers.untils import get_admin_user, update_last_active_dependency
+from routers.user_cache import auth_user_cache
 from routers.websocket import websocket_manager
 from schemas import AdminUserResponse, ConversationResponse
 from sqlalchemy.orm import Session
@@ -36,18 +40,55 @@ def get_online_users(
     db: Session = Depends(get_db),
     admin: User = Depends(get_admin_user),
 ):
-    # Thời gian tối đa để xác định người dùng online (5 phút)
-    online_threshold = datetime.now(timezone.utc) - timedelta(minutes=5)
-
+    # Người dùng online là người đang có kết nối WebSocket (theo presence_service)
     users = (
         db.query(User)
-        .filter(User.last_active_UTC >= online_threshold, User.is_admin == False)
+        .filter(
+            User.username.in_(presence_service.online_usernames()),
+            User.is_admin == False,
+        )
         .all()
     )
 
     return [AdminUserResponse.model_validate(user) for user in users]
 
 
+# API giám sát hàng đợi gửi WebSocket
+@admin_router.get(
+    "/websocket-stats",
+    dependencies=[Depends(update_last_active_dependency)],
+)
+def get_websocket_stats(admin: User = Depends(get_admin_user)):
+    return websocket_manager.get_stats()
+
+
+# API giám sát pool kết nối database
+@admin_router.get(
+    "/db-pool-stats",
+    dependencies=[Depends(update_last_active_dependency)],
+)
+def get_db_pool_stats(admin: User = Depends(get_admin_user)):
+    return get_pool_stats()
+
+
+# API giám sát pool băm mật khẩu (bcrypt)
+@admin_router.get(
+    "/password-hash-stats",
+    dependencies=[Depends(update_last_active_dependency)],
+)
+def get_password_hash_stats(admin: User = Depends(get_admin_user)):
+    return password_hash_pool.stats()
+
+
+# API giám sát hàng đợi tạo ảnh thu nhỏ
+@admin_router.get(
+    "/thumbnail-stats",
+    dependencies=[Depends(update_last_active_dependency)],
+)
+def get_thumbnail_stats(admin: User = Depends(get_admin_user)):
+    return thumbnail_pipeline.stats()
+
+
 @admin_router.get(
     "/get-groups",
     response_model=list[ConversationResponse],
@@ -197,10 +238,14 @@ def delete_user(
         {"target_id": None}
     )
     # Xóa tài khoản
+    db.query(models.UserSearchTerm).filter(
+        models.UserSearchTerm.user_id == user_id
+    ).delete()
     db.delete(user)
 
     try:
         db.commit()  # Commit tất cả thay đổi sau khi hoàn thành
+        auth_user_cache.invalidate(user_id)
 
         # Xóa các thông báo không cần thiết
         db.query(models.Notification).filter(
@@ -287,7 +332,10 @@ async def delete_group(
     db.add_all(notifications)
     db.commit()
 
-    # Xóa tin nhắn & thành viên nhóm
+    # Xóa tin nhắn (kèm chỉ mục tìm kiếm) & thành viên nhóm
+    db.query(models.MessageSearchTerm).filter(
+        models.MessageSearchTerm.conversation_id == group_id
+    ).delete()
     db.query(models.Message).filter(models.Message.conversation_id == group_id).delete()
     db.query(models.GroupMember).filter(
         models.GroupMember.conversation_id == group_id
@@ -7,6 +7,7 @@ from dotenv import load_dotenv
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import EmailStr
+from routers.search import index_user
 from routers.untils import (
     ALGORITHM,
     SECRET_KEY,
@@ -14,10 +15,11 @@ from routers.untils import (
     create_refresh_token,
     create_reset_token,
     decode_jwt_token,
-    hash_password,
-    pwd_context,
+    hash_password_async,
     send_reset_email,
+    verify_password_async,
 )
+from routers.user_cache import auth_user_cache
 from routers.websocket import websocket_manager
 from schemas import (
     ResetPasswordConfirm,
@@ -60,7 +62,7 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
     if db_user_email:
         raise HTTPException(status_code=400, detail="Email đã được sử dụng!")
 
-    hashed_password = pwd_context.hash(user.password)
+    hashed_password = await hash_password_async(user.password)
     new_user = models.User(
         username=user.username,
         nickname=user.nickname,
@@ -71,6 +73,8 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
     )
 
     db.add(new_user)
+    db.flush()
+    index_user(db, new_user)
     db.commit()
     db.refresh(new_user)
 
@@ -112,7 +116,9 @@ async def login(
         .first()
     )
 
-    if not db_user or not pwd_context.verify(form_data.password, db_user.password_hash):
+    if not db_user or not await verify_password_async(
+        form_data.password, db_user.password_hash
+    ):
         raise HTTPException(
             status_code=401, detail="Tên đăng nhập, email hoặc mật khẩu không đúng!"
         )
@@ -254,10 +260,11 @@ async def reset_password_confirm(
     user.last_active_UTC = datetime.now(timezone.utc)
 
     # Cập nhật mật khẩu mới
-    user.password_hash = hash_password(request.new_password)
+    user.password_hash = await hash_password_async(request.new_password)
 
     try:
         db.commit()  # Chỉ commit nếu mọi thứ ổn
+        auth_user_cache.invalidate(user.user_id)
         db.refresh(user)
 
         # Thông báo cho người dùng
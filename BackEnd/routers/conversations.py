@@ -1,27 +1,47 @@
 import os
 import shutil
+from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import List, Optional, Union
 
 import models
-from database import get_db
-from fastapi import APIRouter, Depends, File, HTTPException, Query, UploadFile
-from fastapi.responses import FileResponse
+from database import get_async_db
+from fastapi import (
+    APIRouter,
+    Depends,
+    File,
+    HTTPException,
+    Query,
+    Request,
+    UploadFile,
+)
 from models import Conversation, GroupMember, Notification, User
 from routers.untils import (
+    ATTACHMENT_BLOBS_DIR,
     AVATARS_GROUP_DIR,
     CONVERSATION_ATTACHMENTS_DIR,
-    get_current_user,
+    advance_read_cursor,
+    get_current_user_async,
+    unread_message_counts_subquery,
     update_last_active_dependency,
 )
+from routers.uploads import (
+    attachment_response,
+    delete_conversation_attachments,
+    release_attachment_files,
+)
 from routers.websocket import websocket_manager
 from schemas import ConversationResponse
-from sqlalchemy import case, func
-from sqlalchemy.orm import Session
+from sqlalchemy import case, delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
 conversation_router = APIRouter(prefix="/conversations", tags=["Conversations"])
 
+# Số ký tự tối đa của đoạn xem trước tin nhắn cuối trong danh sách hội thoại
+LAST_MESSAGE_PREVIEW_LENGTH = 100
+
 
 @conversation_router.post(
     "/",
@@ -36,8 +56,8 @@ async def create_conversation(
     name: Optional[str] = Query(
         None, description="Tên nhóm (chỉ sử dụng nếu type là group)"
     ),
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user_async),
 ):
     if type == "private":
         if not username or len(username) != 1:
@@ -47,7 +67,9 @@ async def create_conversation(
             )
 
         recipient_username = username[0]
-        recipient = db.query(User).filter(User.username == recipient_username).first()
+        recipient = await db.scalar(
+            select(User).where(User.username == recipient_username)
+        )
         if not recipient:
             raise HTTPException(status_code=404, detail="Người dùng không tồn tại.")
         if recipient.username == current_user.username:
@@ -56,35 +78,26 @@ async def create_conversation(
             )
 
         # Kiểm tra có phải bạn bè không
-        are_friends = (
-            db.query(models.Friend)
-            .filter(
-                (
-                    (models.Friend.user_username == current_user.username)
-                    & (models.Friend.friend_username == recipient.username)
-                )
-                | (
-                    (models.Friend.user_username == recipient.username)
-                    & (models.Friend.friend_username == current_user.username)
-                )
+        are_friends = await db.scalar(
+            select(models.Friend.id).where(
+                models.Friend.user_username == current_user.username,
+                models.Friend.friend_username == recipient.username,
             )
-            .first()
         )
         if not are_friends:
             raise HTTPException(
                 status_code=400, detail="Bạn chỉ có thể nhắn tin với bạn bè."
             )
 
-        existing_conversation = (
-            db.query(Conversation)
+        existing_conversation = await db.scalar(
+            select(Conversation)
             .join(GroupMember)
-            .filter(
+            .where(
                 Conversation.type == "private",
                 GroupMember.username.in_([current_user.username, recipient.username]),
             )
             .group_by(Conversation.conversation_id)
             .having(func.count(GroupMember.username) == 2)
-            .first()
         )
 
         if existing_conversation:
@@ -100,8 +113,8 @@ async def create_conversation(
             is_read=False,
         )
         db.add(new_conversation)
-        db.commit()
-        db.refresh(new_conversation)
+        await db.commit()
+        await db.refresh(new_conversation)
 
         db.add_all(
             [
@@ -117,7 +130,7 @@ async def create_conversation(
                 ),
             ]
         )
-        db.commit()
+        await db.commit()
 
         # Thông báo cho người nhận
         notification = Notification(
@@ -130,7 +143,7 @@ async def create_conversation(
             created_at_UTC=datetime.now(timezone.utc),
         )
         db.add(notification)
-        db.commit()
+        await db.commit()
 
         await websocket_manager.send_notification(
             noti_id=notification.id,
@@ -154,16 +167,12 @@ async def create_conversation(
 
         # Lấy danh sách bạn bè
         friend_usernames = set(
-            db.query(models.Friend.friend_username)
-            .filter(models.Friend.user_username == current_user.username)
-            .union(
-                db.query(models.Friend.user_username).filter(
-                    models.Friend.friend_username == current_user.username
+            await db.scalars(
+                select(models.Friend.friend_username).where(
+                    models.Friend.user_username == current_user.username
                 )
             )
-            .all()
         )
-        friend_usernames = {username[0] for username in friend_usernames}
 
         # Kiểm tra danh sách hợp lệ
         invalid_users = [u for u in username if u not in friend_usernames]
@@ -181,8 +190,8 @@ async def create_conversation(
             is_read=False,
         )
         db.add(new_conversation)
-        db.commit()
-        db.refresh(new_conversation)
+        await db.commit()
+        await db.refresh(new_conversation)
 
         members = [
             GroupMember(
@@ -193,7 +202,9 @@ async def create_conversation(
             )
         ]
 
-        users = db.query(User).filter(User.username.in_(username)).all()
+        users = (
+            await db.scalars(select(User).where(User.username.in_(username)))
+        ).all()
         for user in users:
             members.append(
                 GroupMember(
@@ -205,7 +216,7 @@ async def create_conversation(
             )
 
         db.add_all(members)
-        db.commit()
+        await db.commit()
 
         # Thông báo cho thành viên mới
         notifications = [
@@ -222,7 +233,7 @@ async def create_conversation(
         ]
 
         db.add_all(notifications)
-        db.commit()
+        await db.commit()
 
         for notification in notifications:
             await websocket_manager.send_notification(
@@ -239,11 +250,12 @@ async def create_conversation(
         raise HTTPException(status_code=400, detail="Loại hội thoại không hợp lệ.")
 
     members = (
-        db.query(User.username, User.avatar, User.nickname, GroupMember.role)
-        .join(GroupMember, User.username == GroupMember.username)
-        .filter(GroupMember.conversation_id == new_conversation.conversation_id)
-        .all()
-    )
+        await db.execute(
+            select(User.username, User.avatar, User.nickname, GroupMember.role)
+            .join(GroupMember, User.username == GroupMember.username)
+            .where(GroupMember.conversation_id == new_conversation.conversation_id)
+        )
+    ).all()
 
     group_members = [
         {
@@ -273,27 +285,23 @@ async def create_conversation(
 async def add_to_group(
     conversation_id: int,
     new_member_username: str,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(get_current_user_async),
 ):
-    group = (
-        db.query(models.Conversation)
-        .filter(
+    group = await db.scalar(
+        select(models.Conversation).where(
             models.Conversation.conversation_id == conversation_id,
             models.Conversation.type == "group",
         )
-        .first()
     )
     if not group:
         raise HTTPException(status_code=404, detail="Nhóm không tồn tại!")
 
-    existing_member = (
-        db.query(models.GroupMember)
-        .filter(
+    existing_member = await db.scalar(
+        select(models.GroupMember).where(
             models.GroupMember.conversation_id == conversation_id,
             models.GroupMember.username == current_user.username,
         )
-        .first()
     )
 
     if not existing_member:
@@ -301,22 +309,18 @@ async def add_to_group(
             status_code=403, detail="Bạn không phải thành viên của nhóm này."
         )
 
-    new_member = (
-        db.query(models.User)
-        .filter(models.User.username == new_member_username)
-        .first()
+    new_member = await db.scalar(
+        select(models.User).where(models.User.username == new_member_username)
     )
 
     if not new_member:
         raise HTTPException(status_code=404, detail="Không tìm thấy người dùng.")
 
-    already_in_group = (
-        db.query(models.GroupMember)
-        .filter(
+    already_in_group = await db.scalar(
+        select(models.GroupMember).where(
             models.GroupMember.conversation_id == conversation_id,
             models.GroupMember.username == new_member_username,
         )
-        .first()
     )
 
     if already_in_group:
@@ -324,19 +328,11 @@ async def add_to_group(
             status_code=400, detail="Người dùng đã là thành viên của nhóm."
         )
 
-    are_friends = (
-        db.query(models.Friend)
-        .filter(
-            (
-                (models.Friend.user_username == current_user.username)
-                & (models.Friend.friend_username == new_member_username)
-            )
-            | (
-                (models.Friend.user_username == new_member_username)
-                & (models.Friend.friend_username == current_user.username)
-            )
+    are_friends = await db.scalar(
+        select(models.Friend.id).where(
+            models.Friend.user_username == current_user.username,
+            models.Friend.friend_username == new_member_username,
         )
-        .first()
     )
 
     if not are_friends:
@@ -349,9 +345,11 @@ async def add_to_group(
         username=new_member_username,
         role="member",
         joined_at_UTC=datetime.now(timezone.utc),
+        # Lịch sử trước khi vào nhóm không tính là chưa đọc với thành viên mới
+        last_read_message_id=group.last_message_id,
     )
     db.add(new_group_member)
-    db.commit()
+    await db.commit()
 
     notification = Notification(
         user_username=new_member.username,
@@ -363,7 +361,7 @@ async def add_to_group(
         created_at_UTC=datetime.now(timezone.utc),
     )
     db.add(notification)
-    db.commit()
+    await db.commit()
 
     await websocket_manager.send_notification(
         noti_id=notification.id,
@@ -376,11 +374,12 @@ async def add_to_group(
     )
 
     members = (
-        db.query(models.GroupMember, models.User)
-        .join(models.User, models.GroupMember.username == models.User.username)
-        .filter(models.GroupMember.conversation_id == conversation_id)
-        .all()
-    )
+        await db.execute(
+            select(models.GroupMember, models.User)
+            .join(models.User, models.GroupMember.username == models.User.username)
+            .where(models.GroupMember.conversation_id == conversation_id)
+        )
+    ).all()
 
     conversation_list = [
         {
@@ -410,49 +409,75 @@ async def add_to_group(
     dependencies=[Depends(update_last_active_dependency)],
 )
 async def get_conversations(
-    db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(get_current_user_async),
 ):
-    conversations = (
-        db.query(models.Conversation)
-        .join(models.GroupMember)
-        .filter(models.GroupMember.username == current_user.username)
-        .all()
+    my_conversation_ids = select(models.GroupMember.conversation_id).where(
+        models.GroupMember.username == current_user.username
     )
 
-    conversation_list = []
-    for convo in conversations:
-        # Lấy thông tin thành viên
-        members = (
-            db.query(
+    # Số tin nhắn người khác gửi sau con trỏ đã đọc của người dùng hiện tại
+    unread_counts = unread_message_counts_subquery(current_user)
+
+    # Tin nhắn cuối lấy theo khóa chính nhờ con trỏ last_message_id
+    LastMessage = aliased(models.Message)
+    last_activity = func.coalesce(
+        models.Conversation.last_message_at, models.Conversation.created_at_UTC
+    )
+
+    rows = (
+        await db.execute(
+            select(
+                models.Conversation,
+                models.Conversation.last_message_at.label("last_message_time"),
+                LastMessage.content.label("last_message_content"),
+                func.coalesce(unread_counts.c.unread_count, 0).label("unread_count"),
+            )
+            .where(models.Conversation.conversation_id.in_(my_conversation_ids))
+            .outerjoin(
+                LastMessage,
+                LastMessage.message_id == models.Conversation.last_message_id,
+            )
+            .outerjoin(
+                unread_counts,
+                unread_counts.c.conversation_id == models.Conversation.conversation_id,
+            )
+            .order_by(last_activity.desc(), models.Conversation.conversation_id.desc())
+        )
+    ).all()
+
+    # Lấy thành viên của tất cả cuộc hội thoại trong một truy vấn
+    members = (
+        await db.execute(
+            select(
+                models.GroupMember.conversation_id,
                 models.User.username,
                 models.User.avatar,
                 models.User.nickname,
                 models.GroupMember.role,
             )
-            .join(
-                models.GroupMember, models.User.username == models.GroupMember.username
-            )
-            .filter(models.GroupMember.conversation_id == convo.conversation_id)
-            .all()
+            .join(models.User, models.User.username == models.GroupMember.username)
+            .where(models.GroupMember.conversation_id.in_(my_conversation_ids))
         )
+    ).all()
 
-        group_members = [
+    members_by_conversation = defaultdict(list)
+    for member in members:
+        members_by_conversation[member.conversation_id].append(
             {
                 "username": member.username,
                 "avatar": member.avatar,
                 "nickname": member.nickname,
                 "role": member.role,
             }
-            for member in members
-        ]
-
-        # Lấy thời gian tin nhắn gần nhất
-        last_message_time = (
-            db.query(func.max(models.Message.timestamp))
-            .filter(models.Message.conversation_id == convo.conversation_id)
-            .scalar()
         )
 
+    conversation_list = []
+    for convo, last_message_time, last_message_content, unread_count in rows:
+        last_message_preview = None
+        if last_message_content is not None:
+            last_message_preview = last_message_content[:LAST_MESSAGE_PREVIEW_LENGTH]
+
         conversation_list.append(
             {
                 "conversation_id": convo.conversation_id,
@@ -460,9 +485,11 @@ async def get_conversations(
                 "name": convo.name,
                 "avatar_url": convo.avatar_url,
                 "created_at_UTC": convo.created_at_UTC,
-                "is_read": convo.is_read,
+                "is_read": unread_count == 0,
                 "last_message_time": last_message_time,
-                "group_members": group_members,
+                "last_message_preview": last_message_preview,
+                "unread_count": unread_count,
+                "group_members": members_by_conversation[convo.conversation_id],
             }
         )
 
@@ -476,15 +503,16 @@ async def get_conversations(
 )
 async def get_conversation(
     conversation_id: int,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(get_current_user_async),
 ):
-    conversation = (
-        db.query(models.Conversation)
-        .filter(models.Conversation.conversation_id == conversation_id)
+    conversation = await db.scalar(
+        select(models.Conversation)
         .join(models.GroupMember)
-        .filter(models.GroupMember.username == current_user.username)
-        .first()
+        .where(
+            models.Conversation.conversation_id == conversation_id,
+            models.GroupMember.username == current_user.username,
+        )
     )
 
     if not conversation:
@@ -495,11 +523,12 @@ async def get_conversation(
 
     # Lấy danh sách thành viên của nhóm
     members = (
-        db.query(models.GroupMember, models.User)
-        .join(models.User, models.GroupMember.username == models.User.username)
-        .filter(models.GroupMember.conversation_id == conversation_id)
-        .all()
-    )
+        await db.execute(
+            select(models.GroupMember, models.User)
+            .join(models.User, models.GroupMember.username == models.User.username)
+            .where(models.GroupMember.conversation_id == conversation_id)
+        )
+    ).all()
 
     return {
         "conversation_id": conversation.conversation_id,
@@ -528,15 +557,16 @@ async def update_group(
     conversation_id: int,
     name_group: str | None = None,
     avatar_file: UploadFile | None = File(None),
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(get_current_user_async),
 ):
-    conversation = (
-        db.query(models.Conversation)
-        .filter(models.Conversation.conversation_id == conversation_id)
+    conversation = await db.scalar(
+        select(models.Conversation)
         .join(models.GroupMember)
-        .filter(models.GroupMember.username == current_user.username)
-        .first()
+        .where(
+            models.Conversation.conversation_id == conversation_id,
+            models.GroupMember.username == current_user.username,
+        )
     )
 
     if not conversation:
@@ -573,15 +603,16 @@ async def update_group(
         conversation.avatar_url = f"/{file_path}"
 
     # Lưu thay đổi vào database
-    db.commit()
-    db.refresh(conversation)
+    await db.commit()
+    await db.refresh(conversation)
 
     members = (
-        db.query(models.GroupMember, models.User)
-        .join(models.User, models.GroupMember.username == models.User.username)
-        .filter(models.GroupMember.conversation_id == conversation_id)
-        .all()
-    )
+        await db.execute(
+            select(models.GroupMember, models.User)
+            .join(models.User, models.GroupMember.username == models.User.username)
+            .where(models.GroupMember.conversation_id == conversation_id)
+        )
+    ).all()
 
     return {
         "conversation_id": conversation.conversation_id,
@@ -605,14 +636,12 @@ async def update_group(
 async def remove_member_from_group(
     conversations_id: int,
     member_username: str,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
     # Kiểm tra nếu cuộc hội thoại có tồn tại không
-    conversation = (
-        db.query(Conversation)
-        .filter(Conversation.conversation_id == conversations_id)
-        .first()
+    conversation = await db.scalar(
+        select(Conversation).where(Conversation.conversation_id == conversations_id)
     )
 
     if not conversation:
@@ -625,14 +654,12 @@ async def remove_member_from_group(
         )
 
     # Kiểm tra quyền người dùng (chỉ admin mới có quyền xóa thành viên)
-    is_admin = (
-        db.query(models.GroupMember)
-        .filter(
+    is_admin = await db.scalar(
+        select(models.GroupMember).where(
             models.GroupMember.conversation_id == conversations_id,
             models.GroupMember.username == current_user.username,
             models.GroupMember.role == "admin",
         )
-        .first()
     )
 
     if not is_admin:
@@ -646,13 +673,11 @@ async def remove_member_from_group(
         )
 
     # Tìm thành viên trong nhóm
-    member = (
-        db.query(GroupMember)
-        .filter(
+    member = await db.scalar(
+        select(GroupMember).where(
             GroupMember.username == member_username,
             GroupMember.conversation_id == conversations_id,
         )
-        .first()
     )
     if not member:
         raise HTTPException(
@@ -660,8 +685,8 @@ async def remove_member_from_group(
         )
 
     # Xóa thành viên khỏi nhóm
-    db.delete(member)
-    db.commit()
+    await db.delete(member)
+    await db.commit()
 
     notification = Notification(
         user_username=member_username,
@@ -673,7 +698,7 @@ async def remove_member_from_group(
         created_at_UTC=datetime.now(timezone.utc),
     )
     db.add(notification)
-    db.commit()
+    await db.commit()
 
     await websocket_manager.send_notification(
         noti_id=notification.id,
@@ -692,14 +717,12 @@ async def remove_member_from_group(
 async def assign_admin(
     conversation_id: int,
     member_username: str,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
     # Kiểm tra nếu cuộc hội thoại có tồn tại không
-    conversation = (
-        db.query(Conversation)
-        .filter(Conversation.conversation_id == conversation_id)
-        .first()
+    conversation = await db.scalar(
+        select(Conversation).where(Conversation.conversation_id == conversation_id)
     )
 
     if not conversation:
@@ -712,14 +735,12 @@ async def assign_admin(
         )
 
     # Kiểm tra quyền người dùng (chỉ admin mới có quyền chỉ định admin)
-    is_admin = (
-        db.query(models.GroupMember)
-        .filter(
+    is_admin = await db.scalar(
+        select(models.GroupMember).where(
             models.GroupMember.conversation_id == conversation_id,
             models.GroupMember.username == current_user.username,
             models.GroupMember.role == "admin",
         )
-        .first()
     )
 
     if not is_admin:
@@ -733,26 +754,22 @@ async def assign_admin(
         )
 
     # Tìm thành viên trong nhóm
-    member = (
-        db.query(GroupMember)
-        .filter(
+    member = await db.scalar(
+        select(GroupMember).where(
             GroupMember.username == member_username,
             GroupMember.conversation_id == conversation_id,
         )
-        .first()
     )
     if not member:
         raise HTTPException(
             status_code=404, detail="Thành viên không tồn tại trong nhóm."
         )
 
-    current_admin = (
-        db.query(models.GroupMember)
-        .filter(
+    current_admin = await db.scalar(
+        select(models.GroupMember).where(
             models.GroupMember.conversation_id == conversation_id,
             models.GroupMember.role == "admin",
         )
-        .first()
     )
 
     if current_admin and current_admin.username == current_user.username:
@@ -763,7 +780,7 @@ async def assign_admin(
         member.role = "admin"
         db.add(member)
 
-        db.commit()
+        await db.commit()
 
         notification = Notification(
             user_username=member_username,
@@ -775,7 +792,7 @@ async def assign_admin(
             created_at_UTC=datetime.now(timezone.utc),
         )
         db.add(notification)
-        db.commit()
+        await db.commit()
 
         await websocket_manager.send_notification(
             noti_id=notification.id,
@@ -800,25 +817,23 @@ async def assign_admin(
 )
 async def delete_conversation(
     conversation_id: int,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(get_current_user_async),
 ):
-    conversation = (
-        db.query(models.Conversation)
-        .filter(models.Conversation.conversation_id == conversation_id)
-        .first()
+    conversation = await db.scalar(
+        select(models.Conversation).where(
+            models.Conversation.conversation_id == conversation_id
+        )
     )
 
     if not conversation:
         raise HTTPException(status_code=404, detail="Hội thoại không tồn tại.")
 
-    is_member = (
-        db.query(models.GroupMember)
-        .filter(
+    is_member = await db.scalar(
+        select(models.GroupMember).where(
             models.GroupMember.conversation_id == conversation_id,
             models.GroupMember.username == current_user.username,
         )
-        .first()
     )
 
     if not is_member:
@@ -827,14 +842,12 @@ async def delete_conversation(
         )
 
     if conversation.type == "group":
-        is_admin = (
-            db.query(models.GroupMember)
-            .filter(
+        is_admin = await db.scalar(
+            select(models.GroupMember).where(
                 models.GroupMember.conversation_id == conversation_id,
                 models.GroupMember.username == current_user.username,
                 models.GroupMember.role == "admin",
             )
-            .first()
         )
 
         if not is_admin:
@@ -844,13 +857,13 @@ async def delete_conversation(
 
         # Lấy danh sách thành viên nhóm
         group_members = (
-            db.query(models.GroupMember.username)
-            .filter(
-                models.GroupMember.conversation_id == conversation_id,
-                models.GroupMember.role == "member",
+            await db.execute(
+                select(models.GroupMember.username).where(
+                    models.GroupMember.conversation_id == conversation_id,
+                    models.GroupMember.role == "member",
+                )
             )
-            .all()
-        )
+        ).all()
 
         # Gửi thông báo đến tất cả thành viên trong nhóm
         notifications = [
@@ -867,7 +880,7 @@ async def delete_conversation(
         ]
 
         db.add_all(notifications)
-        db.commit()
+        await db.commit()
 
         for notification in notifications:
             await websocket_manager.send_notification(
@@ -880,14 +893,25 @@ async def delete_conversation(
                 related_table=notification.related_table,
             )
 
-    db.query(models.Message).filter(
-        models.Message.conversation_id == conversation_id
-    ).delete()
-    db.query(models.GroupMember).filter(
-        models.GroupMember.conversation_id == conversation_id
-    ).delete()
-    db.delete(conversation)
-    db.commit()
+    file_urls = await delete_conversation_attachments(db, conversation_id)
+    await db.execute(
+        delete(models.MessageSearchTerm).where(
+            models.MessageSearchTerm.conversation_id == conversation_id
+        )
+    )
+    await db.execute(
+        delete(models.Message).where(models.Message.conversation_id == conversation_id)
+    )
+    await db.execute(
+        delete(models.GroupMember).where(
+            models.GroupMember.conversation_id == conversation_id
+        )
+    )
+    await db.delete(conversation)
+    await db.commit()
+
+    # Chỉ xóa blob khi không còn cuộc hội thoại nào khác dùng chung
+    await release_attachment_files(db, file_urls)
 
     conversation_dir = os.path.join(CONVERSATION_ATTACHMENTS_DIR, str(conversation_id))
     if os.path.exists(conversation_dir):
@@ -905,8 +929,8 @@ async def delete_conversation(
 )
 async def check_group_ban(
     conversation_id: int,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(get_current_user_async),
 ):
     """
     API kiểm tra xem nhóm chat có đang bị ban không.
@@ -914,26 +938,24 @@ async def check_group_ban(
     """
 
     # Kiểm tra nhóm có tồn tại không
-    conversation = (
-        db.query(models.Conversation)
-        .filter(
+    conversation = await db.scalar(
+        select(models.Conversation).where(
             models.Conversation.conversation_id == conversation_id,
             models.Conversation.type == "group",
         )
-        .first()
     )
     if not conversation:
         raise HTTPException(status_code=404, detail="Nhóm không tồn tại.")
 
     # Lấy tất cả các cảnh báo liên quan đến nhóm chat
     warnings = (
-        db.query(models.Warning)
-        .filter(
-            models.Warning.target_id == conversation_id,
-            models.Warning.target_type == "groups",
+        await db.scalars(
+            select(models.Warning).where(
+                models.Warning.target_id == conversation_id,
+                models.Warning.target_type == "groups",
+            )
         )
-        .all()
-    )
+    ).all()
 
     # Lấy thời gian hiện tại UTC
     now_utc = datetime.now(timezone.utc)
@@ -969,8 +991,8 @@ async def check_group_ban(
 )
 async def leave_group(
     conversation_id: int,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(get_current_user_async),
 ):
     """
     API để người dùng rời khỏi nhóm chat.
@@ -978,26 +1000,22 @@ async def leave_group(
     Nếu nhóm chỉ còn một thành viên, nhóm sẽ bị xóa.
     """
     # Kiểm tra nhóm có tồn tại không
-    group = (
-        db.query(models.Conversation)
-        .filter(
+    group = await db.scalar(
+        select(models.Conversation).where(
             models.Conversation.conversation_id == conversation_id,
             models.Conversation.type == "group",
         )
-        .first()
     )
 
     if not group:
         raise HTTPException(status_code=404, detail="Nhóm không tồn tại!")
 
     # Kiểm tra người dùng có trong nhóm không
-    user_in_group = (
-        db.query(models.GroupMember)
-        .filter(
+    user_in_group = await db.scalar(
+        select(models.GroupMember).where(
             models.GroupMember.conversation_id == conversation_id,
             models.GroupMember.username == current_user.username,
         )
-        .first()
     )
 
     if not user_in_group:
@@ -1007,22 +1025,34 @@ async def leave_group(
 
     # Lấy danh sách thành viên nhóm, sắp xếp theo thời gian tham gia
     group_members = (
-        db.query(models.GroupMember)
-        .filter(models.GroupMember.conversation_id == conversation_id)
-        .order_by(models.GroupMember.joined_at_UTC.asc())
-        .all()
-    )
+        await db.scalars(
+            select(models.GroupMember)
+            .where(models.GroupMember.conversation_id == conversation_id)
+            .order_by(models.GroupMember.joined_at_UTC.asc())
+        )
+    ).all()
 
     # Nếu nhóm chỉ còn 1 thành viên (người rời nhóm là thành viên cuối cùng) => Xóa nhóm
     if len(group_members) == 1:
-        db.query(models.Message).filter(
-            models.Message.conversation_id == conversation_id
-        ).delete()
-        db.query(models.GroupMember).filter(
-            models.GroupMember.conversation_id == conversation_id
-        ).delete()
-        db.delete(group)
-        db.commit()
+        file_urls = await delete_conversation_attachments(db, conversation_id)
+        await db.execute(
+            delete(models.MessageSearchTerm).where(
+                models.MessageSearchTerm.conversation_id == conversation_id
+            )
+        )
+        await db.execute(
+            delete(models.Message).where(
+                models.Message.conversation_id == conversation_id
+            )
+        )
+        await db.execute(
+            delete(models.GroupMember).where(
+                models.GroupMember.conversation_id == conversation_id
+            )
+        )
+        await db.delete(group)
+        await db.commit()
+        await release_attachment_files(db, file_urls)
         return {"message": "Nhóm đã bị xóa vì không còn thành viên nào."}
 
     # Nếu người dùng là ADMIN, chọn thành viên đầu tiên làm admin mới
@@ -1039,7 +1069,7 @@ async def leave_group(
 
         if new_admin:
             new_admin.role = "admin"
-            db.commit()
+            await db.commit()
 
             # Thông báo cho admin mới
             notification = models.Notification(
@@ -1052,7 +1082,7 @@ async def leave_group(
                 created_at_UTC=datetime.now(timezone.utc),
             )
             db.add(notification)
-            db.commit()
+            await db.commit()
 
             await websocket_manager.send_notification(
                 noti_id=notification.id,
@@ -1073,13 +1103,13 @@ async def leave_group(
     else:  # Nếu người dùng là thành viên thường
         # Tìm danh sách admin nhóm
         admin_users = (
-            db.query(models.GroupMember.username)
-            .filter(
-                models.GroupMember.conversation_id == conversation_id,
-                models.GroupMember.role == "admin",
+            await db.execute(
+                select(models.GroupMember.username).where(
+                    models.GroupMember.conversation_id == conversation_id,
+                    models.GroupMember.role == "admin",
+                )
             )
-            .all()
-        )
+        ).all()
 
         # Gửi thông báo cho tất cả admin rằng thành viên đã rời nhóm
         notifications = [
@@ -1095,7 +1125,7 @@ async def leave_group(
             for admin in admin_users
         ]
         db.add_all(notifications)
-        db.commit()
+        await db.commit()
 
         for notification in notifications:
             await websocket_manager.send_notification(
@@ -1109,44 +1139,51 @@ async def leave_group(
             )
 
     # Xóa người dùng khỏi nhóm
-    db.query(models.GroupMember).filter(
-        models.GroupMember.conversation_id == conversation_id,
-        models.GroupMember.username == current_user.username,
-    ).delete()
-    db.commit()
+    await db.execute(
+        delete(models.GroupMember).where(
+            models.GroupMember.conversation_id == conversation_id,
+            models.GroupMember.username == current_user.username,
+        )
+    )
+    await db.commit()
 
     return {"message": f"{current_user.username} đã rời khỏi nhóm '{group.name}'."}
 
 
-@conversation_router.get("/download/{conversation_id}/{filename}")
-def download_file(conversation_id: int, filename: str):
+@conversation_router.api_route(
+    "/download/{conversation_id}/{filename}", methods=["GET", "HEAD"]
+)
+def download_file(conversation_id: int, filename: str, request: Request):
     file_url = f"uploads/conversations/{conversation_id}/{filename}"
     file_path = Path(file_url)
+    if not file_path.exists():
+        # File mới nằm trong kho blob, tên file là <sha256>.<đuôi>
+        file_path = Path(ATTACHMENT_BLOBS_DIR, filename[:2], filename)
 
     if not file_path.exists() or not file_path.is_file():
         raise HTTPException(status_code=404, detail="File không tồn tại")
 
-    return FileResponse(
-        path=file_path,
-        media_type="application/octet-stream",
-        filename=filename,
-    )
+    return attachment_response(request, str(file_path), download_name=filename)
 
 
 @conversation_router.put("/conversations/{conversation_id}/mark-read")
 async def mark_conversation_as_read(
-    conversation_id: int, db: Session = Depends(get_db)
+    conversation_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.User = Depends(get_current_user_async),
 ):
-    conversation = (
-        db.query(Conversation)
-        .filter(Conversation.conversation_id == conversation_id)
-        .first()
+    conversation = await db.scalar(
+        select(Conversation).where(Conversation.conversation_id == conversation_id)
     )
 
     if not conversation:
         raise HTTPException(status_code=404, detail="Cuộc trò chuyện không tồn tại!")
 
-    conversation.is_read = True
-    db.commit()
+    # Dời con trỏ đã đọc của người dùng tới tin nhắn cuối
+    if conversation.last_message_id is not None:
+        await advance_read_cursor(
+            db, conversation_id, current_user.username, conversation.last_message_id
+        )
+        await db.commit()
 
     return {"message": "Thành công"}
@@ -2,9 +2,10 @@ import models
 import schemas
 from database import get_db
 from fastapi import APIRouter, Depends, HTTPException
-from routers.untils import update_last_active_dependency
+from routers.presence import presence_service
+from routers.untils import friendship_clause, update_last_active_dependency
 from routers.users import get_current_user
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, aliased
 
 friends_router = APIRouter(prefix="/friends", tags=["Friends"])
 
@@ -18,24 +19,20 @@ async def get_friends(
     current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)
 ):
     """Lấy danh sách bạn bè hiện tại"""
+    # Mỗi quan hệ có dòng (current_user, bạn) nên chỉ cần seek theo user_username
     friends = (
         db.query(models.User)
-        .join(
-            models.Friend,
-            (models.Friend.user_username == models.User.username)
-            | (models.Friend.friend_username == models.User.username),
-        )
-        .filter(
-            (models.Friend.user_username == current_user.username)
-            | (models.Friend.friend_username == current_user.username)
-        )
-        .filter(models.User.username != current_user.username)
+        .join(models.Friend, models.Friend.friend_username == models.User.username)
+        .filter(models.Friend.user_username == current_user.username)
         .all()
     )
 
     return [
         schemas.FriendResponse(
-            username=friend.username, nickname=friend.nickname, avatar=friend.avatar
+            username=friend.username,
+            nickname=friend.nickname,
+            avatar=friend.avatar,
+            is_online=presence_service.is_online(friend.username),
         )
         for friend in friends
     ]
@@ -50,32 +47,23 @@ async def unfriend(
     db: Session = Depends(get_db),
 ):
     """Xóa kết bạn"""
-    friend_username = friend_username
-
     friendship = (
         db.query(models.Friend)
         .filter(
-            (models.Friend.user_username == current_user.username)
-            & (models.Friend.friend_username == friend_username)
+            models.Friend.user_username == current_user.username,
+            models.Friend.friend_username == friend_username,
         )
         .first()
     )
 
-    if not friendship:
-        friendship = (
-            db.query(models.Friend)
-            .filter(
-                (models.Friend.user_username == friend_username)
-                & (models.Friend.friend_username == current_user.username)
-            )
-            .first()
-        )
-
     if not friendship:
         raise HTTPException(status_code=404, detail="Không tìm thấy bạn bè")
 
     try:
-        db.delete(friendship)
+        # Xóa cả hai dòng đối xứng của quan hệ
+        db.query(models.Friend).filter(
+            friendship_clause(current_user.username, friend_username)
+        ).delete(synchronize_session=False)
         db.commit()
         return {"message": "Xóa bạn bè thành công"}
     except Exception as e:
@@ -89,31 +77,19 @@ async def get_mutual_friends(
     current_user: models.User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    """Lấy danh sách bạn chung giữa người dùng hiện tại và {username} (hỗ trợ truy vấn 2 chiều)"""
+    """Lấy danh sách bạn chung giữa người dùng hiện tại và {username}"""
 
-    # Danh sách bạn của current_user (cả hai chiều)
-    user_friends = db.query(models.Friend.friend_username).filter(
-        models.Friend.user_username == current_user.username
-    )
-    user_friends_reverse = db.query(models.Friend.user_username).filter(
-        models.Friend.friend_username == current_user.username
-    )
-    user_friends = user_friends.union(user_friends_reverse).subquery()
-
-    # Danh sách bạn của username (cả hai chiều)
-    target_friends = db.query(models.Friend.friend_username).filter(
-        models.Friend.user_username == username
-    )
-    target_friends_reverse = db.query(models.Friend.user_username).filter(
-        models.Friend.friend_username == username
-    )
-    target_friends = target_friends.union(target_friends_reverse).subquery()
-
-    # Lấy bạn chung giữa hai danh sách
+    # Bạn chung = (current_user, X) và (username, X) cùng tồn tại
+    TargetFriend = aliased(models.Friend)
     mutual_friends = (
         db.query(models.User)
-        .filter(models.User.username.in_(user_friends))
-        .filter(models.User.username.in_(target_friends))
+        .join(models.Friend, models.Friend.friend_username == models.User.username)
+        .join(
+            TargetFriend,
+            (TargetFriend.friend_username == models.User.username)
+            & (TargetFriend.user_username == username),
+        )
+        .filter(models.Friend.user_username == current_user.username)
         .all()
     )
 
@@ -4,7 +4,11 @@ import models
 import schemas
 from database import get_db
 from fastapi import APIRouter, Depends, HTTPException
-from routers.untils import update_last_active_dependency
+from routers.untils import (
+    new_friendship,
+    resolve_friend_statuses,
+    update_last_active_dependency,
+)
 from routers.users import get_current_user
 from routers.websocket import websocket_manager
 from sqlalchemy.orm import Session, aliased
@@ -35,58 +39,8 @@ async def get_friend_status(
     if user.is_admin:
         raise HTTPException(status_code=403, detail="Người dùng là quản trị viên.")
 
-    # Kiểm tra xem có phải bạn bè không
-    friendship = (
-        db.query(models.Friend)
-        .filter(
-            (
-                (models.Friend.user_username == current_user.username)
-                & (models.Friend.friend_username == username)
-            )
-            | (
-                (models.Friend.user_username == username)
-                & (models.Friend.friend_username == current_user.username)
-            )
-        )
-        .first()
-    )
-    if friendship:
-        return {"status": "Bạn bè", "nickname": user.nickname, "avatar": user.avatar}
-
-    # Kiểm tra xem có đang chờ xử lý không
-    sent_request = (
-        db.query(models.FriendRequest)
-        .filter(
-            models.FriendRequest.sender_username == current_user.username,
-            models.FriendRequest.receiver_username == username,
-            models.FriendRequest.status == "Đợi",
-        )
-        .first()
-    )
-    if sent_request:
-        return {
-            "status": "Đã gửi lời mời",
-            "nickname": user.nickname,
-            "avatar": user.avatar,
-        }
-
-    received_request = (
-        db.query(models.FriendRequest)
-        .filter(
-            models.FriendRequest.sender_username == username,
-            models.FriendRequest.receiver_username == current_user.username,
-            models.FriendRequest.status == "Đợi",
-        )
-        .first()
-    )
-    if received_request:
-        return {
-            "status": "Chờ xác nhận",
-            "nickname": user.nickname,
-            "avatar": user.avatar,
-        }
-
-    return {"status": "Chưa kết bạn", "nickname": user.nickname, "avatar": user.avatar}
+    status = resolve_friend_statuses(db, current_user.username, [username])[username]
+    return {"status": status, "nickname": user.nickname, "avatar": user.avatar}
 
 
 @friend_request_router.post(
@@ -121,14 +75,8 @@ async def send_friend_request(
     existing_friendship = (
         db.query(models.Friend)
         .filter(
-            (
-                (models.Friend.user_username == sender.username)
-                & (models.Friend.friend_username == receiver.username)
-            )
-            | (
-                (models.Friend.user_username == receiver.username)
-                & (models.Friend.friend_username == sender.username)
-            )
+            models.Friend.user_username == sender.username,
+            models.Friend.friend_username == receiver.username,
         )
         .first()
     )
@@ -245,14 +193,8 @@ async def accept_friend_request(
     existing_friendship = (
         db.query(models.Friend)
         .filter(
-            (
-                (models.Friend.user_username == sender_username)
-                & (models.Friend.friend_username == receiver_username)
-            )
-            | (
-                (models.Friend.user_username == receiver_username)
-                & (models.Friend.friend_username == sender_username)
-            )
+            models.Friend.user_username == sender_username,
+            models.Friend.friend_username == receiver_username,
         )
         .first()
     )
@@ -260,11 +202,7 @@ async def accept_friend_request(
     if existing_friendship:
         raise HTTPException(status_code=400, detail="Hai người đã là bạn bè")
 
-    new_friend = models.Friend(
-        user_username=sender_username,
-        friend_username=receiver_username,
-        created_at_UTC=datetime.now(timezone.utc),
-    )
+    new_friends = new_friendship(sender_username, receiver_username)
 
     # Tạo thông báo cho người gửi
     new_notification = models.Notification(
@@ -277,7 +215,7 @@ async def accept_friend_request(
         created_at_UTC=datetime.now(timezone.utc),
     )
 
-    db.add(new_friend)
+    db.add_all(new_friends)
     db.add(new_notification)
     db.delete(friend_request)  # Xóa lời mời sau khi chấp nhận
     db.commit()
@@ -1,25 +1,48 @@
+import asyncio
 import json
-import os
-import shutil
-import uuid
 from datetime import datetime, timezone
 from typing import List
 
 import models
-from database import get_db
+from database import get_async_db
 from fastapi import APIRouter, Depends, File, HTTPException, Query, UploadFile
-from models import Attachment, Conversation, GroupMember, Message, User
+from models import (
+    Attachment,
+    Conversation,
+    GroupMember,
+    Message,
+    MessageSearchTerm,
+    User,
+)
+from routers.search import index_message
+from routers.thumbnails import thumbnail_pipeline
 from routers.untils import (
-    CONVERSATION_ATTACHMENTS_DIR,
-    get_current_user,
+    advance_read_cursor,
+    decode_message_cursor,
+    encode_message_cursor,
+    get_current_user_async,
     update_last_active_dependency,
 )
+from routers.upload_sessions import claim_upload_session, ensure_upload_complete
+from routers.uploads import release_attachment_files, spool_uploads, store_blobs
 from routers.websocket import websocket_manager
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
 messages_router = APIRouter(prefix="/messages", tags=["Messages"])
 
 
+def attachment_data(attachment: Attachment) -> dict:
+    return {
+        "file_url": attachment.file_url,
+        "file_type": attachment.file_type,
+        "thumbnail_url": attachment.thumbnail_url,
+        "width": attachment.width,
+        "height": attachment.height,
+    }
+
+
 @messages_router.post(
     "/",
     dependencies=[Depends(update_last_active_dependency)],
@@ -28,83 +51,95 @@ async def send_message(
     conversation_id: int,
     content: str | None = None,  # Tin nhắn văn bản (nếu có)
     files: List[UploadFile] | None = File(None),  # Danh sách file đính kèm (nếu có)
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    upload_ids: List[str] | None = Query(
+        None, description="Các phiên tải lên theo phần đã hoàn tất (/upload-sessions)"
+    ),
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
     # Kiểm tra cuộc hội thoại
-    conversation = (
-        db.query(Conversation)
-        .filter(Conversation.conversation_id == conversation_id)
-        .first()
+    conversation = await db.scalar(
+        select(Conversation).where(Conversation.conversation_id == conversation_id)
     )
     if not conversation:
         raise HTTPException(status_code=404, detail="Cuộc hội thoại không tồn tại")
 
     # Kiểm tra xem người dùng có phải là thành viên của nhóm không
-    is_member = (
-        db.query(GroupMember)
-        .filter(
+    is_member = await db.scalar(
+        select(GroupMember).where(
             GroupMember.conversation_id == conversation_id,
             GroupMember.username == current_user.username,
         )
-        .first()
     )
     if not is_member:
         raise HTTPException(status_code=403, detail="Bạn không thuộc nhóm này")
 
-    # Tạo tin nhắn mới (text message)
-    new_message = Message(
-        sender_id=current_user.user_id,
-        conversation_id=conversation_id,
-        content=content or "",  # Nếu không có nội dung thì gán chuỗi rỗng
-        timestamp=datetime.now(timezone.utc),
-        is_read=False,
-    )
-    db.add(new_message)
-    db.commit()
-    db.refresh(new_message)
-
-    conversation.is_read = False
-    db.commit()
-    # Tạo thư mục riêng cho cuộc hội thoại nếu chưa có
-    conversation_dir = os.path.join(CONVERSATION_ATTACHMENTS_DIR, str(conversation_id))
-    os.makedirs(conversation_dir, exist_ok=True)
+    # Lưu tạm các file đính kèm trước khi tạo tin nhắn để file lỗi hoặc quá lớn
+    # không để lại tin nhắn dở dang
+    upload_ids = list(dict.fromkeys(upload_ids or []))
+    for upload_id in upload_ids:
+        await asyncio.to_thread(
+            ensure_upload_complete, upload_id, current_user.username
+        )
+    spooled_files = await spool_uploads(files) if files else []
 
     # Danh sách lưu các đường dẫn file
     file_urls = []
-    if files:
-        for i, file in enumerate(files):
-            file_extension = file.filename.split(".")[-1].lower()
-
-            # Kiểm tra định dạng file
-            allowed_extensions = ["jpg", "jpeg", "png", "pdf", "mp4", "mp3"]
-            if file_extension not in allowed_extensions:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Định dạng file {file_extension} không được hỗ trợ!",
-                )
-
-            # Tạo tên file duy nhất và đường dẫn lưu trữ (sử dụng UUID)
-            file_name = f"{new_message.message_id}_{uuid.uuid4().hex}.{file_extension}"
-            file_path = os.path.join(conversation_dir, file_name)
-
-            # Lưu file vào hệ thống tệp tin
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-
-            # Đảm bảo đường dẫn sử dụng dấu gạch chéo "/"
-            file_url = f"uploads/conversations/{conversation_id}/{file_name}"
-
-            # Lưu thông tin file vào bảng Attachment
+    attachments = []
+    try:
+        # Phiên tải lên chỉ bị xóa sau khi tin nhắn đã commit (discard bên dưới);
+        # nếu có lỗi trước đó, phiên được trả lại để gửi lại
+        for upload_id in upload_ids:
+            spooled_files.append(
+                await claim_upload_session(upload_id, current_user.username)
+            )
+
+        # Tạo tin nhắn mới (text message)
+        new_message = Message(
+            sender_id=current_user.user_id,
+            conversation_id=conversation_id,
+            content=content or "",  # Nếu không có nội dung thì gán chuỗi rỗng
+            timestamp=datetime.now(timezone.utc),
+            is_read=False,
+        )
+        db.add(new_message)
+        await db.flush()
+        # Cập nhật chỉ mục tìm kiếm trong cùng transaction với tin nhắn
+        index_message(db, new_message)
+
+        # Cập nhật con trỏ tin nhắn cuối trong cùng transaction với tin nhắn mới
+        conversation.last_message_id = new_message.message_id
+        conversation.last_message_at = new_message.timestamp
+        conversation.message_count = Conversation.message_count + 1
+        # Người gửi hiển nhiên đã đọc tin nhắn của chính mình
+        is_member.last_read_message_id = new_message.message_id
+
+        for spooled in spooled_files:
+            # File cùng nội dung dùng chung một blob (đường dẫn theo SHA-256)
             attachment = Attachment(
                 message_id=new_message.message_id,
-                file_url=file_url,
-                file_type=file.content_type,
+                file_url=spooled.blob_url,
+                file_type=spooled.content_type,
+                file_size=spooled.size,
+                content_hash=spooled.content_hash,
             )
             db.add(attachment)
-            file_urls.append(file_url)
+            attachments.append(attachment)
+            file_urls.append(spooled.blob_url)
+
+        # File vào kho blob trước khi commit, dưới khóa blob: không có dòng
+        # Attachment nào trỏ tới blob chưa được ghi
+        async with store_blobs(db, spooled_files):
+            await db.commit()
+
+        for spooled in spooled_files:
+            # Ảnh thu nhỏ được tạo ở nền, get_messages trả về khi đã sẵn sàng
+            thumbnail_pipeline.submit(spooled.content_hash, spooled.blob_url)
+    finally:
+        for spooled in spooled_files:
+            spooled.discard()
 
-        db.commit()
+    await db.refresh(new_message)
 
     message_data = {
         "message_id": new_message.message_id,
@@ -118,20 +153,19 @@ async def send_message(
     }
 
     # Lấy danh sách thành viên nhóm (trừ người gửi)
-    group_members = (
-        db.query(GroupMember.username)
-        .filter(GroupMember.conversation_id == conversation_id)
-        .all()
+    group_members = await db.scalars(
+        select(GroupMember.username).where(
+            GroupMember.conversation_id == conversation_id
+        )
     )
     recipient_list = [
-        member[0] for member in group_members if member[0] != current_user.username
+        username for username in group_members if username != current_user.username
     ]
 
-    # Gửi tin nhắn đến tất cả thành viên nhóm
-    for recipient in recipient_list:
-        await websocket_manager.send_chat_message(
-            conversation_id, recipient, message_data
-        )
+    # Gửi tin nhắn đồng thời đến tất cả thành viên nhóm
+    await websocket_manager.broadcast_chat_message(
+        conversation_id, recipient_list, message_data
+    )
 
     # Trả về kết quả
 
@@ -143,15 +177,7 @@ async def send_message(
         "content": new_message.content,
         "timestamp": new_message.timestamp.isoformat(),
         "is_read": new_message.is_read,
-        "attachments": [
-            {"file_url": url, "file_type": att.file_type}
-            for url, att in zip(
-                file_urls,
-                db.query(Attachment)
-                .filter(Attachment.message_id == new_message.message_id)
-                .all(),
-            )
-        ],
+        "attachments": [attachment_data(att) for att in attachments],
     }
 
 
@@ -161,47 +187,91 @@ async def get_messages(
     conversation_id: int,
     limit: int = Query(20, ge=1, le=100),
     offset: int = Query(0, ge=0),
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    before_id: int | None = Query(
+        None, description="Lấy các tin nhắn cũ hơn message_id này"
+    ),
+    after_id: int | None = Query(
+        None, description="Lấy các tin nhắn mới hơn message_id này"
+    ),
+    cursor: str | None = Query(
+        None, description="Con trỏ phân trang lấy từ next_cursor của lần gọi trước"
+    ),
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
     # Kiểm tra cuộc hội thoại tồn tại không
-    conversation = (
-        db.query(Conversation)
-        .filter(Conversation.conversation_id == conversation_id)
-        .first()
+    conversation = await db.scalar(
+        select(Conversation).where(Conversation.conversation_id == conversation_id)
     )
     if not conversation:
         raise HTTPException(status_code=404, detail="Cuộc hội thoại không tồn tại")
 
     # Kiểm tra người dùng có thuộc nhóm không
-    is_member = (
-        db.query(GroupMember)
-        .filter(
+    is_member = await db.scalar(
+        select(GroupMember).where(
             GroupMember.conversation_id == conversation_id,
             GroupMember.username == current_user.username,
         )
-        .first()
     )
     if not is_member:
         raise HTTPException(status_code=403, detail="Bạn không thuộc nhóm này")
 
+    if cursor:
+        direction, cursor_id = decode_message_cursor(cursor)
+        if direction == "before":
+            before_id = cursor_id
+        else:
+            after_id = cursor_id
+
+    if before_id is not None and after_id is not None:
+        raise HTTPException(
+            status_code=400, detail="Chỉ được dùng một trong before_id hoặc after_id"
+        )
+
     # Lấy tin nhắn kèm thông tin người gửi
-    messages = (
-        db.query(Message, User)
+    query = (
+        select(Message, User)
         .join(User, Message.sender_id == User.user_id)
-        .filter(Message.conversation_id == conversation_id)
-        .order_by(Message.timestamp.desc())
-        .offset(offset)
-        .limit(limit)
-        .all()
+        .where(Message.conversation_id == conversation_id)
+        # Nạp file đính kèm của cả trang bằng một truy vấn IN (...) duy nhất
+        .options(selectinload(Message.attachments))
     )
+    if after_id is not None:
+        # Keyset: quét index (conversation_id, message_id) theo chiều tăng rồi đảo lại
+        query = (
+            query.where(Message.message_id > after_id)
+            .order_by(Message.message_id.asc())
+            .limit(limit)
+        )
+    elif before_id is not None:
+        query = (
+            query.where(Message.message_id < before_id)
+            .order_by(Message.message_id.desc())
+            .limit(limit)
+        )
+    else:
+        query = query.order_by(Message.message_id.desc()).offset(offset).limit(limit)
+
+    messages = (await db.execute(query)).all()
+    if after_id is not None:
+        messages.reverse()
+
+    # Trạng thái đã đọc tính từ con trỏ đọc: tin của người khác so với con trỏ của mình,
+    # tin của mình so với con trỏ nhỏ nhất trong các thành viên còn lại
+    my_read_id = is_member.last_read_message_id or 0
+    others_read_id = (
+        await db.scalar(
+            select(func.min(func.coalesce(GroupMember.last_read_message_id, 0))).where(
+                GroupMember.conversation_id == conversation_id,
+                GroupMember.username != current_user.username,
+            )
+        )
+    ) or 0
 
-    # Lấy danh sách file đính kèm theo từng tin nhắn
     message_list = []
     for msg, sender in messages:
-        attachments = (
-            db.query(Attachment).filter(Attachment.message_id == msg.message_id).all()
-        )
+        is_own = msg.sender_id == current_user.user_id
+        read_id = others_read_id if is_own else my_read_id
         message_list.append(
             {
                 "message_id": msg.message_id,
@@ -210,15 +280,25 @@ async def get_messages(
                 "sender_nickname": sender.nickname,
                 "content": msg.content,
                 "timestamp": msg.timestamp,
-                "is_read": msg.is_read,
-                "attachments": [
-                    {"file_url": att.file_url, "file_type": att.file_type}
-                    for att in attachments
-                ],
+                "is_read": msg.message_id <= read_id,
+                "attachments": [attachment_data(att) for att in msg.attachments],
             }
         )
 
-    return {"messages": message_list, "limit": limit, "offset": offset}
+    # Con trỏ cho trang tiếp theo (chỉ trả về khi trang hiện tại đầy)
+    next_cursor = None
+    if len(messages) == limit:
+        if after_id is not None:
+            next_cursor = encode_message_cursor("after", messages[0][0].message_id)
+        else:
+            next_cursor = encode_message_cursor("before", messages[-1][0].message_id)
+
+    return {
+        "messages": message_list,
+        "limit": limit,
+        "offset": offset,
+        "next_cursor": next_cursor,
+    }
 
 
 # API xóa tin nhắn
@@ -228,11 +308,11 @@ async def get_messages(
 )
 async def delete_message(
     message_id: int,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
     # Lấy tin nhắn từ cơ sở dữ liệu
-    message = db.query(Message).filter(Message.message_id == message_id).first()
+    message = await db.scalar(select(Message).where(Message.message_id == message_id))
 
     if not message:
         raise HTTPException(status_code=404, detail="Tin nhắn không tồn tại")
@@ -244,46 +324,49 @@ async def delete_message(
         )
 
     # Lấy danh sách các file đính kèm từ cơ sở dữ liệu
-    attachments = db.query(Attachment).filter(Attachment.message_id == message_id).all()
+    attachments = await db.scalars(
+        select(Attachment).where(Attachment.message_id == message_id)
+    )
 
-    # Xóa các file đính kèm
+    # Xóa thông tin file trong bảng Attachment
+    file_urls = set()
     for attachment in attachments:
-        file_path = os.path.join(
-            CONVERSATION_ATTACHMENTS_DIR, attachment.file_url.lstrip("/")
-        )  # Lấy đường dẫn đầy đủ của file
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)  # Xóa file
-            except Exception as e:
-                print(f"Lỗi khi xóa file: {e}")
-
-        # Xóa thông tin file trong bảng Attachment
-        db.delete(attachment)
+        file_urls.add(attachment.file_url)
+        await db.delete(attachment)
 
     message.content = f"Tin nhắn đã bị xóa bởi {current_user.nickname}"
-    db.commit()
+    message.is_deleted = True
+    # Nội dung cũ không còn tìm thấy được
+    await db.execute(
+        delete(MessageSearchTerm).where(MessageSearchTerm.message_id == message_id)
+    )
+    await db.commit()
 
-    conversation = (
-        db.query(Conversation)
-        .filter(Conversation.conversation_id == message.conversation_id)
-        .first()
+    # Chỉ xóa file khi không còn tin nhắn nào khác dùng chung
+    await release_attachment_files(db, file_urls)
+
+    conversation = await db.scalar(
+        select(Conversation).where(
+            Conversation.conversation_id == message.conversation_id
+        )
     )
 
     if conversation:
-        members = (
-            db.query(GroupMember.username)
-            .filter(GroupMember.conversation_id == conversation.conversation_id)
-            .all()
-        )
-        for member in members:
-            notification_message = json.dumps(
-                {
-                    "type": "message_deleted",
-                    "message_id": message_id,
-                    "content": f"Tin nhắn đã bị xóa bởi {current_user.nickname}.",
-                }
+        members = await db.scalars(
+            select(GroupMember.username).where(
+                GroupMember.conversation_id == conversation.conversation_id
             )
-            await websocket_manager.send_message(notification_message, "user")
+        )
+        notification_message = json.dumps(
+            {
+                "type": "message_deleted",
+                "message_id": message_id,
+                "content": f"Tin nhắn đã bị xóa bởi {current_user.nickname}.",
+            }
+        )
+        await websocket_manager.broadcast_to_users(
+            list(members), notification_message
+        )
 
     # Trả về thông báo thành công
     return {
@@ -298,57 +381,52 @@ async def delete_message(
 )
 async def clear_conversation(
     conversation_id: int,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    conversation = (
-        db.query(Conversation)
-        .filter(Conversation.conversation_id == conversation_id)
-        .first()
+    conversation = await db.scalar(
+        select(Conversation).where(Conversation.conversation_id == conversation_id)
     )
     if not conversation:
         raise HTTPException(status_code=404, detail="Cuộc hội thoại không tồn tại")
 
-    is_member = (
-        db.query(GroupMember)
-        .filter(
+    is_member = await db.scalar(
+        select(GroupMember).where(
             GroupMember.conversation_id == conversation_id,
             GroupMember.username == current_user.username,
         )
-        .first()
     )
     if not is_member:
         raise HTTPException(status_code=403, detail="Bạn không thuộc nhóm này")
 
-    messages = (
-        db.query(Message).filter(Message.conversation_id == conversation_id).all()
+    await db.execute(
+        delete(MessageSearchTerm).where(
+            MessageSearchTerm.conversation_id == conversation_id
+        )
+    )
+    messages = await db.scalars(
+        select(Message)
+        .where(Message.conversation_id == conversation_id)
+        .options(selectinload(Message.attachments))
     )
 
+    file_urls = set()
     for message in messages:
-        attachments = (
-            db.query(Attachment)
-            .filter(Attachment.message_id == message.message_id)
-            .all()
-        )
-
-        # Xóa các file đính kèm
-        for attachment in attachments:
-            file_path = os.path.join(
-                CONVERSATION_ATTACHMENTS_DIR, attachment.file_url.lstrip("/")
-            )
-            if os.path.exists(file_path):
-                try:
-                    os.remove(file_path)  # Xóa file
-                except Exception as e:
-                    print(f"Lỗi khi xóa file: {e}")
-
-            # Xóa thông tin file trong bảng Attachment
-            db.delete(attachment)
+        # Xóa thông tin file trong bảng Attachment
+        for attachment in message.attachments:
+            file_urls.add(attachment.file_url)
+            await db.delete(attachment)
 
         # Xóa tin nhắn
-        db.delete(message)
+        await db.delete(message)
+
+    conversation.last_message_id = None
+    conversation.last_message_at = None
+    conversation.message_count = 0
+    await db.commit()
 
-    db.commit()
+    # Chỉ xóa file khi không còn tin nhắn nào khác dùng chung
+    await release_attachment_files(db, file_urls)
 
     # Trả về thông báo thành công
     return {"message": "Tất cả tin nhắn và file đính kèm đã được xóa thành công"}
@@ -357,32 +435,30 @@ async def clear_conversation(
 @messages_router.put("/mark-read/{message_id}")
 async def mark_message_as_read(
     message_id: int,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
     # Tìm tin nhắn trong cơ sở dữ liệu
-    message = db.query(Message).filter(Message.message_id == message_id).first()
+    message = await db.scalar(select(Message).where(Message.message_id == message_id))
 
     if not message:
         raise HTTPException(status_code=404, detail="Tin nhắn không tồn tại")
 
     # Kiểm tra xem người dùng có phải là thành viên của cuộc trò chuyện không
-    conversation = (
-        db.query(Conversation)
-        .filter(Conversation.conversation_id == message.conversation_id)
-        .first()
+    conversation = await db.scalar(
+        select(Conversation).where(
+            Conversation.conversation_id == message.conversation_id
+        )
     )
 
     if not conversation:
         raise HTTPException(status_code=404, detail="Cuộc hội thoại không tồn tại")
 
-    is_member = (
-        db.query(GroupMember)
-        .filter(
+    is_member = await db.scalar(
+        select(GroupMember).where(
             GroupMember.conversation_id == message.conversation_id,
             GroupMember.username == current_user.username,
         )
-        .first()
     )
 
     if not is_member:
@@ -390,9 +466,64 @@ async def mark_message_as_read(
             status_code=403, detail="Bạn không phải là thành viên của nhóm này"
         )
 
-    # Cập nhật trạng thái is_read của tin nhắn
-    message.is_read = True
-    db.commit()
+    # Dời con trỏ đã đọc tới tin nhắn này (đồng nghĩa các tin trước đó cũng đã đọc)
+    await advance_read_cursor(
+        db, message.conversation_id, current_user.username, message_id
+    )
+    await db.commit()
 
     # Trả về kết quả thành công
     return {"message": "Tin nhắn đã được đánh dấu là đã đọc"}
+
+
+@messages_router.put(
+    "/{conversation_id}/read",
+    dependencies=[Depends(update_last_active_dependency)],
+)
+async def mark_conversation_read(
+    conversation_id: int,
+    up_to_message_id: int | None = Query(
+        None, description="Đánh dấu đã đọc tới tin nhắn này (mặc định: tin nhắn cuối)"
+    ),
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
+):
+    conversation = await db.scalar(
+        select(Conversation).where(Conversation.conversation_id == conversation_id)
+    )
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Cuộc hội thoại không tồn tại")
+
+    is_member = await db.scalar(
+        select(GroupMember).where(
+            GroupMember.conversation_id == conversation_id,
+            GroupMember.username == current_user.username,
+        )
+    )
+    if not is_member:
+        raise HTTPException(status_code=403, detail="Bạn không thuộc nhóm này")
+
+    # Không cho con trỏ vượt quá tin nhắn cuối của cuộc hội thoại
+    if up_to_message_id is None or (
+        conversation.last_message_id is not None
+        and up_to_message_id > conversation.last_message_id
+    ):
+        up_to_message_id = conversation.last_message_id
+    if up_to_message_id is None:
+        return {
+            "message": "Cuộc hội thoại chưa có tin nhắn",
+            "conversation_id": conversation_id,
+            "last_read_message_id": is_member.last_read_message_id,
+        }
+
+    await advance_read_cursor(
+        db, conversation_id, current_user.username, up_to_message_id
+    )
+    await db.commit()
+    await db.refresh(is_member)
+
+    return {
+        "message": "Cuộc hội thoại đã được đánh dấu là đã đọc",
+        "conversation_id": conversation_id,
+        "last_read_message_id": is_member.last_read_message_id,
+    }
@@ -1,10 +1,14 @@
 import models
 import schemas
-from database import get_db
+from database import get_async_db
 from fastapi import APIRouter, Depends, HTTPException, Query
-from routers.untils import update_last_active_dependency
-from routers.users import get_current_user
-from sqlalchemy.orm import Session
+from routers.untils import (
+    get_current_user_async,
+    unread_message_counts_subquery,
+    update_last_active_dependency,
+)
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 notifications_router = APIRouter(prefix="/notifications", tags=["Notifications"])
 
@@ -21,31 +25,69 @@ async def get_notifications(
         True,
         description="Sắp xếp theo thời gian (True = mới nhất trước, False = cũ nhất trước)",
     ),
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    query = db.query(models.Notification).filter(
+    query = select(models.Notification).where(
         models.Notification.user_username == current_user.username
     )
 
     if from_system:
-        query = query.filter(
+        query = query.where(
             models.Notification.sender_username.is_(None),
             models.Notification.related_id == 0,
             models.Notification.related_table.is_(None),
         )
 
     if unread_only:
-        query = query.filter(models.Notification.is_read == False)
+        query = query.where(models.Notification.is_read == False)
     query = query.order_by(
         models.Notification.created_at_UTC.desc()
         if newest_first
         else models.Notification.created_at_UTC.asc()
     )
-    notifications = query.all()
+    notifications = (await db.scalars(query)).all()
     return notifications
 
 
+@notifications_router.get(
+    "/unread-counts",
+    response_model=schemas.UnreadCountsResponse,
+    dependencies=[Depends(update_last_active_dependency)],
+)
+async def get_unread_counts(
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Lấy toàn bộ số lượng chưa đọc (tin nhắn, thông báo, lời mời kết bạn) một lần"""
+    unread_counts = unread_message_counts_subquery(current_user)
+    rows = await db.execute(
+        select(unread_counts.c.conversation_id, unread_counts.c.unread_count)
+    )
+    conversations = {row.conversation_id: row.unread_count for row in rows}
+
+    notifications = await db.scalar(
+        select(func.count(models.Notification.id)).where(
+            models.Notification.user_username == current_user.username,
+            models.Notification.is_read == False,
+        )
+    )
+
+    friend_requests = await db.scalar(
+        select(func.count(models.FriendRequest.id)).where(
+            models.FriendRequest.receiver_username == current_user.username,
+            models.FriendRequest.status == "Đợi",
+        )
+    )
+
+    return schemas.UnreadCountsResponse(
+        conversations=conversations,
+        messages=sum(conversations.values()),
+        notifications=notifications,
+        friend_requests=friend_requests,
+    )
+
+
 @notifications_router.post(
     "/{notification_id}/read",
     response_model=schemas.NotificationResponse,
@@ -53,26 +95,24 @@ async def get_notifications(
 )
 async def mark_notification_as_read(
     notification_id: int,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """Đánh dấu thông báo là đã đọc"""
 
-    notification = (
-        db.query(models.Notification)
-        .filter(
+    notification = await db.scalar(
+        select(models.Notification).where(
             models.Notification.id == notification_id,
             models.Notification.user_username == current_user.username,
         )
-        .first()
     )
 
     if not notification:
         raise HTTPException(status_code=404, detail="Thông báo không tồn tại")
 
     notification.is_read = True
-    db.commit()
-    db.refresh(notification)
+    await db.commit()
+    await db.refresh(notification)
 
     return schemas.NotificationResponse.from_orm(notification)
 
@@ -84,26 +124,24 @@ async def mark_notification_as_read(
 )
 async def mark_notification_as_unread(
     notification_id: int,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """Đánh dấu thông báo là chưa đọc"""
 
-    notification = (
-        db.query(models.Notification)
-        .filter(
+    notification = await db.scalar(
+        select(models.Notification).where(
             models.Notification.id == notification_id,
             models.Notification.user_username == current_user.username,
         )
-        .first()
     )
 
     if not notification:
         raise HTTPException(status_code=404, detail="Thông báo không tồn tại")
 
     notification.is_read = False
-    db.commit()
-    db.refresh(notification)
+    await db.commit()
+    await db.refresh(notification)
 
     return schemas.NotificationResponse.from_orm(notification)
 
@@ -114,19 +152,19 @@ async def mark_notification_as_unread(
     dependencies=[Depends(update_last_active_dependency)],
 )
 async def mark_all_notifications_as_read(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """Đánh dấu tất cả thông báo là đã đọc"""
 
     notifications = (
-        db.query(models.Notification)
-        .filter(
-            models.Notification.user_username == current_user.username,
-            models.Notification.is_read == False,
+        await db.scalars(
+            select(models.Notification).where(
+                models.Notification.user_username == current_user.username,
+                models.Notification.is_read == False,
+            )
         )
-        .all()
-    )
+    ).all()
 
     if not notifications:
         raise HTTPException(status_code=404, detail="Không có thông báo chưa đọc")
@@ -134,7 +172,7 @@ async def mark_all_notifications_as_read(
     for notification in notifications:
         notification.is_read = True
 
-    db.commit()
+    await db.commit()
 
     return [
         schemas.NotificationResponse.from_orm(notification)
@@ -148,19 +186,19 @@ async def mark_all_notifications_as_read(
     dependencies=[Depends(update_last_active_dependency)],
 )
 async def mark_all_notifications_as_unread(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """Đánh dấu tất cả thông báo là chưa đọc"""
 
     notifications = (
-        db.query(models.Notification)
-        .filter(
-            models.Notification.user_username == current_user.username,
-            models.Notification.is_read == True,
+        await db.scalars(
+            select(models.Notification).where(
+                models.Notification.user_username == current_user.username,
+                models.Notification.is_read == True,
+            )
         )
-        .all()
-    )
+    ).all()
 
     if not notifications:
         raise HTTPException(status_code=404, detail="Không tìm thấy thông báo đã đọc")
@@ -168,7 +206,7 @@ async def mark_all_notifications_as_unread(
     for notification in notifications:
         notification.is_read = False
 
-    db.commit()
+    await db.commit()
 
     return [
         schemas.NotificationResponse.from_orm(notification)
@@ -182,17 +220,15 @@ async def mark_all_notifications_as_unread(
 )
 async def delete_notification(
     notification_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: models.User = Depends(
-        get_current_user
+        get_current_user_async
     ),  # Lấy người dùng hiện tại từ token
 ):
     """Xóa thông báo theo ID"""
     # Tìm thông báo trong cơ sở dữ liệu
-    notification = (
-        db.query(models.Notification)
-        .filter(models.Notification.id == notification_id)
-        .first()
+    notification = await db.scalar(
+        select(models.Notification).where(models.Notification.id == notification_id)
     )
 
     if not notification:
@@ -205,7 +241,7 @@ async def delete_notification(
         )
 
     # Xóa thông báo và commit thay đổi vào cơ sở dữ liệu
-    db.delete(notification)
-    db.commit()
+    await db.delete(notification)
+    await db.commit()
 
     return {"message": "Thông báo đã được xóa thành công"}
@@ -0,0 +1,70 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Số luồng chạy bcrypt song song (bcrypt nhả GIL nên không chặn event loop)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 4))
+# Số yêu cầu băm/kiểm tra mật khẩu tối đa đang chờ hoặc đang chạy cùng lúc
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", 64))
+
+
+class PasswordHashPool:
+    """Chạy các hàm bcrypt trong pool luồng có giới hạn, ghi nhận thời gian chờ"""
+
+    def __init__(
+        self,
+        workers: int = PASSWORD_HASH_WORKERS,
+        max_pending: int = PASSWORD_HASH_MAX_PENDING,
+    ):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="password-hash"
+        )
+        self._slots = asyncio.Semaphore(max_pending)
+        self.pending = 0
+        self.completed = 0
+        self.total_queue_time = 0.0
+        self.max_queue_time = 0.0
+        self.total_run_time = 0.0
+
+    @staticmethod
+    def _timed(func, args):
+        started_at = time.monotonic()
+        result = func(*args)
+        return started_at, time.monotonic() - started_at, result
+
+    async def run(self, func, *args):
+        submitted_at = time.monotonic()
+        self.pending += 1
+        try:
+            async with self._slots:
+                loop = asyncio.get_running_loop()
+                started_at, run_time, result = await loop.run_in_executor(
+                    self.executor, self._timed, func, args
+                )
+        finally:
+            self.pending -= 1
+
+        queue_time = started_at - submitted_at
+        self.completed += 1
+        self.total_queue_time += queue_time
+        self.max_queue_time = max(self.max_queue_time, queue_time)
+        self.total_run_time += run_time
+        return result
+
+    def stats(self) -> dict:
+        completed = self.completed or 1
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "avg_queue_ms": round(self.total_queue_time / completed * 1000, 2),
+            "max_queue_ms": round(self.max_queue_time * 1000, 2),
+            "avg_run_ms": round(self.total_run_time / completed * 1000, 2),
+        }
+
+
+password_hash_pool = PasswordHashPool()
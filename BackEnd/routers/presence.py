@@ -0,0 +1,264 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import models
+from database import AsyncSessionLocal
+from fastapi import WebSocket
+from routers.websocket import WebSocketManager, websocket_manager
+from sqlalchemy import case, select, update
+
+# Độ trễ tối đa (giây) trước khi last_active_UTC được ghi xuống DB
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", 30))
+# Kết nối user không gửi heartbeat quá số giây này bị coi là đã mất (0 để tắt)
+PRESENCE_HEARTBEAT_TIMEOUT = float(os.getenv("PRESENCE_HEARTBEAT_TIMEOUT", 60))
+# Chu kỳ (giây) mỗi worker phát qua broker danh sách user đang kết nối tại worker đó;
+# worker im lặng quá 3 chu kỳ bị coi là đã dừng
+PRESENCE_SYNC_INTERVAL = float(os.getenv("PRESENCE_SYNC_INTERVAL", 15))
+
+
+class LastActiveTracker:
+    """Gom thời điểm hoạt động cuối của user trong bộ nhớ và ghi xuống bảng users
+    theo chu kỳ bằng một câu UPDATE duy nhất, thay vì commit ở mỗi request.
+    touch được gọi cả từ luồng của threadpool (dependency đồng bộ) nên mọi truy cập
+    pending đều giữ _lock."""
+
+    def __init__(self, flush_interval: float = PRESENCE_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.pending: dict[str, datetime] = {}
+        self._lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+
+    def touch(self, username: str):
+        """Ghi nhận user vừa hoạt động (không truy cập DB)"""
+        with self._lock:
+            self.pending[username] = datetime.now(timezone.utc)
+
+    def last_seen(self, username: str) -> datetime | None:
+        """Thời điểm hoạt động chưa kịp ghi xuống DB của user, nếu có"""
+        with self._lock:
+            return self.pending.get(username)
+
+    async def flush(self) -> int:
+        """Ghi mọi thời điểm đang chờ xuống DB, trả về số user được cập nhật"""
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(models.User)
+                    .where(models.User.username.in_(list(pending)))
+                    .values(
+                        last_active_UTC=case(pending, value=models.User.username)
+                    )
+                )
+                await db.commit()
+        except Exception as e:
+            # Trả lại các giá trị chưa ghi được, giữ thời điểm mới hơn nếu có
+            with self._lock:
+                for username, seen_at in pending.items():
+                    if self.pending.get(username, seen_at) <= seen_at:
+                        self.pending[username] = seen_at
+            logging.error(f"Lỗi khi ghi last_active: {e}")
+            return 0
+        return len(pending)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # Ghi nốt các giá trị còn lại trước khi tắt
+        await self.flush()
+
+
+class PresenceService:
+    """Trạng thái online dựa trên các kết nối WebSocket đang mở. Mỗi worker phát các
+    thay đổi của mình qua broker và ghép với trạng thái nhận được từ các worker khác,
+    nên user chỉ offline khi không còn thiết bị nào ở bất kỳ worker nào. Đổi trạng
+    thái được đẩy tới bạn bè qua socket, kết nối im lặng bị dọn theo heartbeat."""
+
+    def __init__(
+        self,
+        manager: WebSocketManager,
+        tracker: LastActiveTracker,
+        heartbeat_timeout: float = PRESENCE_HEARTBEAT_TIMEOUT,
+        sync_interval: float = PRESENCE_SYNC_INTERVAL,
+    ):
+        self.manager = manager
+        self.tracker = tracker
+        self.heartbeat_timeout = heartbeat_timeout
+        self.sync_interval = sync_interval
+        # Định danh của worker này trong các envelope presence
+        self.worker_id = uuid.uuid4().hex
+        # User đang kết nối tại các worker khác: worker_id -> (lúc nhận tin cuối, user)
+        self._remote: dict[str, tuple[float, set[str]]] = {}
+        self._sweeper: asyncio.Task | None = None
+        self._syncer: asyncio.Task | None = None
+        # Giữ tham chiếu các task nền để không bị thu gom giữa chừng
+        self._tasks: set[asyncio.Task] = set()
+        manager.add_presence_listener(self._on_presence_change)
+        manager.broker.subscribe(self._on_broker_envelope)
+
+    def _remote_usernames(self) -> list[set[str]]:
+        deadline = time.monotonic() - 3 * self.sync_interval
+        return [
+            usernames
+            for seen_at, usernames in self._remote.values()
+            if seen_at >= deadline
+        ]
+
+    def _online_elsewhere(self, username: str) -> bool:
+        return any(username in usernames for usernames in self._remote_usernames())
+
+    def is_online(self, username: str) -> bool:
+        return self.manager.is_online(username) or self._online_elsewhere(username)
+
+    def online_usernames(self) -> list[str]:
+        usernames = set(self.manager.online_usernames())
+        for remote in self._remote_usernames():
+            usernames |= remote
+        return list(usernames)
+
+    def heartbeat(self, websocket: WebSocket, username: str | None = None):
+        self.manager.heartbeat(websocket)
+        if username:
+            self.tracker.touch(username)
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _on_presence_change(self, username: str, is_online: bool):
+        """User có thiết bị đầu tiên/mất thiết bị cuối tại worker này"""
+        self.tracker.touch(username)
+        self._spawn(
+            self._publish(
+                {
+                    "kind": "presence",
+                    "worker": self.worker_id,
+                    "username": username,
+                    "is_online": is_online,
+                }
+            )
+        )
+        # Vẫn còn thiết bị ở worker khác thì trạng thái với bạn bè không đổi
+        if not self._online_elsewhere(username):
+            self._spawn(self._notify_friends(username, is_online))
+
+    def _on_broker_envelope(self, envelope: dict):
+        """Cập nhật trạng thái của các worker khác từ envelope presence"""
+        kind = envelope.get("kind")
+        if kind not in ("presence", "presence_sync"):
+            return
+        worker = envelope["worker"]
+        if worker == self.worker_id:
+            return
+
+        if kind == "presence_sync":
+            usernames = set(envelope["usernames"])
+        else:
+            _, usernames = self._remote.get(worker, (0.0, set()))
+            if envelope["is_online"]:
+                usernames.add(envelope["username"])
+            else:
+                usernames.discard(envelope["username"])
+        if usernames:
+            self._remote[worker] = (time.monotonic(), usernames)
+        else:
+            self._remote.pop(worker, None)
+
+    async def _publish(self, envelope: dict):
+        try:
+            await self.manager.broker.publish(envelope)
+        except Exception as e:
+            logging.error(f"Lỗi khi phát trạng thái online qua broker: {e}")
+
+    async def _publish_snapshot(self, usernames: list[str]):
+        await self._publish(
+            {"kind": "presence_sync", "worker": self.worker_id, "usernames": usernames}
+        )
+
+    async def _notify_friends(self, username: str, is_online: bool):
+        try:
+            async with AsyncSessionLocal() as db:
+                friends = (
+                    await db.scalars(
+                        select(models.Friend.friend_username).where(
+                            models.Friend.user_username == username
+                        )
+                    )
+                ).all()
+        except Exception as e:
+            logging.error(f"Lỗi khi lấy danh sách bạn bè của {username}: {e}")
+            return
+
+        message = json.dumps(
+            {
+                "type_socket": "presence_update",
+                "username": username,
+                "is_online": is_online,
+                "last_active_UTC": datetime.now(timezone.utc).isoformat(),
+            }
+        )
+        await self.manager.broadcast_to_users(friends, message)
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_timeout / 2)
+            for outbox in self.manager.stale_connections(self.heartbeat_timeout):
+                try:
+                    await outbox.websocket.close()
+                except RuntimeError:
+                    pass
+                self.manager.disconnect(
+                    outbox.websocket, outbox.user_type, outbox.username
+                )
+
+    async def _sync(self):
+        """Phát định kỳ toàn bộ danh sách để worker mới khởi động nắm được trạng thái
+        và bỏ các worker đã dừng mà không kịp báo"""
+        while True:
+            await self._publish_snapshot(self.manager.online_usernames())
+            deadline = time.monotonic() - 3 * self.sync_interval
+            for worker, (seen_at, _) in list(self._remote.items()):
+                if seen_at < deadline:
+                    del self._remote[worker]
+            await asyncio.sleep(self.sync_interval)
+
+    async def start(self):
+        if self.heartbeat_timeout > 0 and self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep())
+        if self.sync_interval > 0 and self._syncer is None:
+            self._syncer = asyncio.create_task(self._sync())
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        if self._syncer is not None:
+            self._syncer.cancel()
+            self._syncer = None
+            # Báo các worker khác bỏ danh sách của worker này ngay
+            await self._publish_snapshot([])
+
+
+last_active_tracker = LastActiveTracker()
+presence_service = PresenceService(websocket_manager, last_active_tracker)
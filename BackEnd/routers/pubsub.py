@@ -0,0 +1,135 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Callable
+
+# Địa chỉ broker dùng chung giữa các worker/host, ví dụ redis://localhost:6379/0.
+# Bỏ trống để dùng broker trong tiến trình (chỉ một worker).
+WS_BROKER_URL = os.getenv("WS_BROKER_URL", "")
+WS_BROKER_CHANNEL = os.getenv("WS_BROKER_CHANNEL", "chat_app:websocket")
+# Thời gian chờ (giây) trước lần kết nối lại Redis đầu tiên, nhân đôi sau mỗi lần lỗi
+# tới tối đa WS_BROKER_RECONNECT_MAX_DELAY
+WS_BROKER_RECONNECT_DELAY = float(os.getenv("WS_BROKER_RECONNECT_DELAY", 0.5))
+WS_BROKER_RECONNECT_MAX_DELAY = float(os.getenv("WS_BROKER_RECONNECT_MAX_DELAY", 30))
+
+Handler = Callable[[dict], None]
+
+
+class InProcessBroker:
+    """Broker mặc định: chuyển thẳng envelope cho các handler trong cùng tiến trình"""
+
+    def __init__(self):
+        self._handlers: list[Handler] = []
+
+    def subscribe(self, handler: Handler):
+        self._handlers.append(handler)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, envelope: dict):
+        for handler in self._handlers:
+            handler(envelope)
+
+
+class RedisBroker:
+    """Broker qua Redis pub/sub: mọi worker (kể cả worker gửi) nhận envelope từ channel
+    chung rồi tự giao cho các socket đang kết nối tại worker đó. Mất kết nối thì tự
+    đăng ký lại (các tin phát trong lúc mất kết nối không được giao lại)."""
+
+    def __init__(self, url: str, channel: str = WS_BROKER_CHANNEL, client=None):
+        if client is None:
+            try:
+                import redis.asyncio as redis_asyncio
+            except ImportError as e:
+                raise RuntimeError(
+                    "Cần cài đặt gói 'redis' để dùng WS_BROKER_URL dạng redis://"
+                ) from e
+            client = redis_asyncio.from_url(url, decode_responses=True)
+
+        self.channel = channel
+        # client: redis.asyncio.Redis hoặc đối tượng có cùng giao diện (dùng trong test)
+        self._redis = client
+        self._pubsub = None
+        self._listener: asyncio.Task | None = None
+        self._handlers: list[Handler] = []
+        self.reconnects = 0
+
+    def subscribe(self, handler: Handler):
+        self._handlers.append(handler)
+
+    async def _connect(self):
+        pubsub = self._redis.pubsub()
+        try:
+            await pubsub.subscribe(self.channel)
+        except BaseException:
+            await self._close_pubsub(pubsub)
+            raise
+        self._pubsub = pubsub
+
+    async def _close_pubsub(self, pubsub):
+        try:
+            await pubsub.aclose()
+        except Exception:
+            pass
+
+    async def start(self):
+        # Đăng ký ngay khi khởi động để không bỏ lỡ tin và báo lỗi cấu hình sớm
+        await self._connect()
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener:
+            self._listener.cancel()
+            self._listener = None
+        if self._pubsub:
+            await self._close_pubsub(self._pubsub)
+            self._pubsub = None
+        await self._redis.aclose()
+
+    async def publish(self, envelope: dict):
+        await self._redis.publish(self.channel, json.dumps(envelope))
+
+    def _dispatch(self, data: str):
+        try:
+            envelope = json.loads(data)
+            for handler in self._handlers:
+                handler(envelope)
+        except Exception as e:
+            logging.error(f"Lỗi khi xử lý tin từ broker: {e}")
+
+    async def _listen(self):
+        delay = WS_BROKER_RECONNECT_DELAY
+        while True:
+            try:
+                if self._pubsub is None:
+                    await self._connect()
+                    self.reconnects += 1
+                    logging.info("Đã kết nối lại broker Redis")
+                delay = WS_BROKER_RECONNECT_DELAY
+                async for item in self._pubsub.listen():
+                    if item.get("type") == "message":
+                        self._dispatch(item["data"])
+                raise ConnectionError("kết nối pub/sub đã đóng")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(
+                    f"Mất kết nối broker Redis ({e}), thử lại sau {delay:.1f} giây"
+                )
+            if self._pubsub is not None:
+                await self._close_pubsub(self._pubsub)
+                self._pubsub = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WS_BROKER_RECONNECT_MAX_DELAY)
+
+
+def create_broker(url: str = WS_BROKER_URL):
+    """Chọn broker theo WS_BROKER_URL (redis:// hoặc rediss:// dùng Redis)"""
+    if url.startswith(("redis://", "rediss://")):
+        return RedisBroker(url)
+    return InProcessBroker()
@@ -0,0 +1,174 @@
+import re
+import unicodedata
+from collections import Counter
+
+import models
+from database import get_async_db
+from fastapi import APIRouter, Depends, HTTPException, Query
+from models import GroupMember, Message, MessageSearchTerm, User, UserSearchTerm
+from routers.untils import (
+    decode_cursor,
+    encode_cursor,
+    get_current_user_async,
+    update_last_active_dependency,
+)
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+# Độ dài tối đa của một từ trong chỉ mục (khớp với cột term)
+MAX_TERM_LENGTH = 64
+# Số từ tối đa được dùng trong một truy vấn tìm kiếm
+MAX_QUERY_TERMS = 8
+
+search_router = APIRouter(prefix="/search", tags=["Search"])
+
+
+def normalize_text(text: str) -> str:
+    """Viết thường và bỏ dấu tiếng Việt ("Đường" -> "duong") để tìm không phân biệt
+    dấu"""
+    text = unicodedata.normalize("NFD", text.lower()).replace("đ", "d")
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def tokenize(text: str) -> list[str]:
+    return [term[:MAX_TERM_LENGTH] for term in re.findall(r"\w+", normalize_text(text))]
+
+
+def index_message(db: Session | AsyncSession, message: models.Message):
+    """Thêm các từ của tin nhắn vào chỉ mục (chưa commit). Gọi sau khi flush để tin
+    nhắn đã có message_id"""
+    if not message.content or message.is_deleted:
+        return
+    db.add_all(
+        MessageSearchTerm(
+            term=term,
+            message_id=message.message_id,
+            conversation_id=message.conversation_id,
+            frequency=frequency,
+        )
+        for term, frequency in Counter(tokenize(message.content)).items()
+    )
+
+
+def user_search_terms(user: models.User) -> set[tuple[str, str]]:
+    """Các cặp (trường, từ) của user: username, từng từ của nickname và cả nickname
+    (để gõ "nguyen va" vẫn khớp "Nguyễn Văn An")"""
+    terms = {("username", normalize_text(user.username)[:MAX_TERM_LENGTH])}
+    if user.nickname:
+        words = tokenize(user.nickname)
+        terms.update(("nickname", word) for word in words)
+        if len(words) > 1:
+            terms.add(("nickname", " ".join(words)[:MAX_TERM_LENGTH]))
+    return terms
+
+
+def prefix_match(column, prefix: str, dialect: str):
+    """Điều kiện `column LIKE 'prefix%'` đi theo index. SQLite chỉ dùng index cho LIKE
+    khi bật case_sensitive_like, nên ở đó so sánh theo khoảng [prefix, tiền tố kế
+    tiếp) (các từ trong chỉ mục đã viết thường, so sánh nhị phân là đúng)"""
+    if dialect == "sqlite":
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return and_(column >= prefix, column < upper)
+    # Tự escape thay vì startswith() để MySQL dùng được index cho LIKE 'abc%'
+    pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return column.like(pattern + "%", escape="\\")
+
+
+def index_user(db: Session, user: models.User):
+    """Ghi lại chỉ mục tìm kiếm của user (chưa commit). Gọi khi tạo user hoặc đổi
+    nickname, sau khi user đã có user_id"""
+    db.query(UserSearchTerm).filter(UserSearchTerm.user_id == user.user_id).delete()
+    db.add_all(
+        UserSearchTerm(field=field, term=term, user_id=user.user_id)
+        for field, term in user_search_terms(user)
+    )
+
+
+@search_router.get(
+    "/messages",
+    dependencies=[Depends(update_last_active_dependency)],
+)
+async def search_messages(
+    q: str = Query(..., min_length=1, description="Từ khóa, không phân biệt dấu"),
+    conversation_id: int | None = Query(
+        None, description="Chỉ tìm trong cuộc hội thoại này (mặc định: tất cả)"
+    ),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: str | None = Query(
+        None, description="Con trỏ phân trang lấy từ next_cursor của lần gọi trước"
+    ),
+    current_user: models.User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Tìm tin nhắn chứa tất cả các từ khóa qua chỉ mục đảo, xếp hạng theo số lần
+    xuất hiện của từ khóa rồi theo tin nhắn mới nhất"""
+    terms = list(dict.fromkeys(tokenize(q)))[:MAX_QUERY_TERMS]
+    if not terms:
+        raise HTTPException(status_code=400, detail="Từ khóa tìm kiếm không hợp lệ!")
+
+    if conversation_id is not None:
+        is_member = await db.scalar(
+            select(GroupMember.id).where(
+                GroupMember.conversation_id == conversation_id,
+                GroupMember.username == current_user.username,
+            )
+        )
+        if not is_member:
+            raise HTTPException(status_code=403, detail="Bạn không thuộc nhóm này")
+        conversation_filter = MessageSearchTerm.conversation_id == conversation_id
+    else:
+        conversation_filter = MessageSearchTerm.conversation_id.in_(
+            select(GroupMember.conversation_id).where(
+                GroupMember.username == current_user.username
+            )
+        )
+
+    # Mỗi (term, message_id) là duy nhất nên đếm số dòng = số từ khóa khớp
+    matches = (
+        select(
+            MessageSearchTerm.message_id,
+            func.sum(MessageSearchTerm.frequency).label("score"),
+        )
+        .where(MessageSearchTerm.term.in_(terms), conversation_filter)
+        .group_by(MessageSearchTerm.message_id)
+        .having(func.count() == len(terms))
+        .subquery()
+    )
+
+    query = (
+        select(Message, User, matches.c.score)
+        .join(matches, matches.c.message_id == Message.message_id)
+        .outerjoin(User, Message.sender_id == User.user_id)
+        .order_by(matches.c.score.desc(), Message.message_id.desc())
+        .limit(limit)
+    )
+    if cursor:
+        score, message_id = decode_cursor(cursor, int, int)
+        query = query.where(
+            or_(
+                matches.c.score < score,
+                and_(matches.c.score == score, Message.message_id < message_id),
+            )
+        )
+
+    rows = (await db.execute(query)).all()
+    results = [
+        {
+            "message_id": msg.message_id,
+            "conversation_id": msg.conversation_id,
+            "sender_id": msg.sender_id,
+            "sender_username": sender.username if sender else None,
+            "sender_nickname": sender.nickname if sender else None,
+            "content": msg.content,
+            "timestamp": msg.timestamp,
+            "score": int(score),
+        }
+        for msg, sender, score in rows
+    ]
+
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = encode_cursor(int(rows[-1][2]), rows[-1][0].message_id)
+
+    return {"messages": results, "limit": limit, "next_cursor": next_cursor}
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import models
+from database import AsyncSessionLocal
+from PIL import Image, ImageOps
+from routers.uploads import thumbnail_url
+from sqlalchemy import select, update
+
+# Cạnh dài nhất (px) của ảnh thu nhỏ
+THUMBNAIL_MAX_SIZE = int(os.getenv("THUMBNAIL_MAX_SIZE", 480))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", 80))
+# Số luồng tạo ảnh thu nhỏ song song
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", 2))
+# Số file tối đa chờ tạo ảnh thu nhỏ; vượt quá thì bỏ qua (tạo bù bằng maintenance.py)
+THUMBNAIL_QUEUE_SIZE = int(os.getenv("THUMBNAIL_QUEUE_SIZE", 200))
+# Thời gian tối đa (giây) cho ffmpeg lấy khung hình đại diện của video
+THUMBNAIL_FFMPEG_TIMEOUT = int(os.getenv("THUMBNAIL_FFMPEG_TIMEOUT", 60))
+
+IMAGE_EXTENSIONS = {"jpg", "jpeg", "png"}
+VIDEO_EXTENSIONS = {"mp4"}
+# Video chỉ có khung hình đại diện khi máy chủ cài ffmpeg
+FFMPEG = shutil.which("ffmpeg")
+
+EXIF_ORIENTATION = 0x0112
+
+
+def supports_thumbnail(file_url: str) -> bool:
+    extension = file_url.rsplit(".", 1)[-1].lower()
+    return extension in IMAGE_EXTENSIONS or (
+        extension in VIDEO_EXTENSIONS and FFMPEG is not None
+    )
+
+
+def _save_thumbnail(image: Image.Image, destination: str) -> tuple[int, int]:
+    """Thu nhỏ ảnh và ghi JPEG vào destination (nguyên tử), trả về kích thước gốc
+    đã xoay theo EXIF"""
+    width, height = image.size
+    if image.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+        width, height = height, width
+
+    # Với JPEG, draft giải mã thẳng ở độ phân giải thấp thay vì cả ảnh 12MP
+    image.draft("RGB", (THUMBNAIL_MAX_SIZE * 2, THUMBNAIL_MAX_SIZE * 2))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(destination), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            image.save(file, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+        os.replace(temp_path, destination)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return width, height
+
+
+def generate_thumbnail(source: str, destination: str) -> tuple[int, int] | None:
+    """Tạo ảnh thu nhỏ cho ảnh hoặc khung hình đại diện cho video (hàm chặn, chạy
+    trong pool luồng). Trả về kích thước gốc, None nếu định dạng không hỗ trợ"""
+    extension = source.rsplit(".", 1)[-1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        with Image.open(source) as image:
+            return _save_thumbnail(image, destination)
+
+    if extension not in VIDEO_EXTENSIONS or FFMPEG is None:
+        return None
+
+    fd, frame_path = tempfile.mkstemp(suffix=".png")
+    os.close(fd)
+    try:
+        # Bộ lọc thumbnail chọn khung hình tiêu biểu, tránh khung đen ở đầu video
+        subprocess.run(
+            [FFMPEG, "-y", "-loglevel", "error", "-i", source]
+            + ["-vf", "thumbnail", "-frames:v", "1", frame_path],
+            check=True,
+            timeout=THUMBNAIL_FFMPEG_TIMEOUT,
+        )
+        with Image.open(frame_path) as image:
+            return _save_thumbnail(image, destination)
+    finally:
+        os.remove(frame_path)
+
+
+class ThumbnailPipeline:
+    """Tạo ảnh thu nhỏ ở nền sau khi file đính kèm được lưu: hàng đợi có giới hạn và
+    một pool luồng riêng, nên send_message không phải chờ việc xử lý ảnh/video"""
+
+    def __init__(
+        self, workers: int = THUMBNAIL_WORKERS, queue_size: int = THUMBNAIL_QUEUE_SIZE
+    ):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="thumbnail"
+        )
+        self._queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def submit(self, content_hash: str, file_url: str) -> bool:
+        """Xếp file vào hàng đợi (không chờ). Trả về False nếu bỏ qua"""
+        if self._queue is None or not supports_thumbnail(file_url):
+            return False
+        try:
+            self._queue.put_nowait((content_hash, file_url))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logging.warning(f"Hàng đợi ảnh thu nhỏ đã đầy, bỏ qua {file_url}")
+            return False
+        return True
+
+    async def process(self, content_hash: str, file_url: str):
+        destination = thumbnail_url(content_hash)
+        async with AsyncSessionLocal() as db:
+            # File trùng nội dung đã có ảnh thu nhỏ thì dùng lại
+            existing = (
+                await db.execute(
+                    select(models.Attachment.width, models.Attachment.height)
+                    .where(
+                        models.Attachment.content_hash == content_hash,
+                        models.Attachment.thumbnail_url.isnot(None),
+                    )
+                    .limit(1)
+                )
+            ).first()
+
+        if existing and os.path.isfile(destination):
+            width, height = existing
+        else:
+            loop = asyncio.get_running_loop()
+            size = await loop.run_in_executor(
+                self.executor, generate_thumbnail, file_url, destination
+            )
+            if size is None:
+                return
+            width, height = size
+
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(models.Attachment)
+                .where(
+                    models.Attachment.content_hash == content_hash,
+                    models.Attachment.thumbnail_url.is_(None),
+                )
+                .values(thumbnail_url=destination, width=width, height=height)
+            )
+            await db.commit()
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            content_hash, file_url = await queue.get()
+            try:
+                await self.process(content_hash, file_url)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Lỗi khi tạo ảnh thu nhỏ cho {file_url}: {e}")
+            finally:
+                queue.task_done()
+
+    async def start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._tasks = [
+                asyncio.create_task(self._worker(self._queue))
+                for _ in range(self.workers)
+            ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._queue = None
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "video_posters": FFMPEG is not None,
+        }
+
+
+thumbnail_pipeline = ThumbnailPipeline()
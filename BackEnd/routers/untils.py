@@ -1,3 +1,6 @@
+import base64
+import binascii
+import json
 import logging
 import os
 import secrets
@@ -9,11 +12,16 @@ from email.mime.text import MIMEText
 
 import jwt
 import models
-from database import get_db
+from database import get_async_db, get_db
 from dotenv import load_dotenv
 from fastapi import Depends, HTTPException, Request, Security, status
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
+from routers.password_pool import password_hash_pool
+from routers.presence import last_active_tracker
+from routers.user_cache import auth_user_cache
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 # Load biến môi trường từ .env
@@ -45,6 +53,17 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+# Bản async dùng trong handler: bcrypt chạy trong pool luồng thay vì trên event loop
+async def hash_password_async(password: str) -> str:
+    return await password_hash_pool.run(pwd_context.hash, password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await password_hash_pool.run(
+        pwd_context.verify, plain_password, hashed_password
+    )
+
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None) -> str:
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + (
@@ -77,9 +96,32 @@ def get_current_user(
     user_id = payload.get("user_id")
     if not user_id:
         raise HTTPException(status_code=401, detail="Token không hợp lệ")
-    user = db.query(models.User).filter(models.User.user_id == user_id).first()
-    if not user:
-        raise HTTPException(status_code=401, detail="Người dùng không tồn tại")
+    user = auth_user_cache.get(db, user_id)
+    if user is None:
+        user = db.query(models.User).filter(models.User.user_id == user_id).first()
+        if not user:
+            raise HTTPException(status_code=401, detail="Người dùng không tồn tại")
+        auth_user_cache.put(user)
+    return user
+
+
+async def get_current_user_async(
+    token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)
+):
+    """get_current_user cho các route async: dùng chung AsyncSession của request nên
+    mỗi request chỉ giữ một kết nối trong pool thay vì thêm một kết nối đồng bộ"""
+    payload = decode_jwt_token(token)
+    user_id = payload.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Token không hợp lệ")
+    user = auth_user_cache.get(db.sync_session, user_id)
+    if user is None:
+        user = await db.scalar(
+            select(models.User).where(models.User.user_id == user_id)
+        )
+        if not user:
+            raise HTTPException(status_code=401, detail="Người dùng không tồn tại")
+        auth_user_cache.put(user)
     return user
 
 
@@ -90,6 +132,150 @@ def get_admin_user(token: str = Depends(oauth2_scheme), db: Session = Depends(ge
     return user
 
 
+def encode_cursor(*values) -> str:
+    """Mã hóa khóa sắp xếp của kết quả cuối trang thành con trỏ mờ (opaque) cho
+    client"""
+    raw = json.dumps(values, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, *types) -> tuple:
+    """Giải mã con trỏ của encode_cursor, ép từng giá trị theo types; 400 nếu con trỏ
+    không hợp lệ"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError
+        return tuple(cast(value) for cast, value in zip(types, values))
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Con trỏ phân trang không hợp lệ!")
+
+
+def encode_message_cursor(direction: str, message_id: int) -> str:
+    """Con trỏ phân trang tin nhắn theo hướng ("before"/"after") và message_id"""
+    return encode_cursor(direction, message_id)
+
+
+def decode_message_cursor(cursor: str) -> tuple[str, int]:
+    """Giải mã con trỏ phân trang tin nhắn, trả về (hướng, message_id)"""
+    direction, message_id = decode_cursor(cursor, str, int)
+    if direction not in ("before", "after"):
+        raise HTTPException(status_code=400, detail="Con trỏ phân trang không hợp lệ!")
+    return direction, message_id
+
+
+async def advance_read_cursor(
+    db: AsyncSession, conversation_id: int, username: str, message_id: int
+) -> int:
+    """Dời con trỏ đã đọc của thành viên tới message_id (chỉ tiến, không lùi).
+    Trả về số dòng được cập nhật, không tự commit."""
+    result = await db.execute(
+        update(models.GroupMember)
+        .where(
+            models.GroupMember.conversation_id == conversation_id,
+            models.GroupMember.username == username,
+            (models.GroupMember.last_read_message_id < message_id)
+            | (models.GroupMember.last_read_message_id.is_(None)),
+        )
+        .values(last_read_message_id=message_id)
+    )
+    return result.rowcount
+
+
+def unread_message_counts_subquery(user: models.User):
+    """Subquery (conversation_id, unread_count): số tin nhắn người khác gửi sau con trỏ
+    đã đọc của user, cho mọi cuộc hội thoại user tham gia"""
+    return (
+        select(
+            models.Message.conversation_id.label("conversation_id"),
+            func.count(models.Message.message_id).label("unread_count"),
+        )
+        .join(
+            models.GroupMember,
+            (models.GroupMember.conversation_id == models.Message.conversation_id)
+            & (models.GroupMember.username == user.username),
+        )
+        .where(
+            models.Message.message_id
+            > func.coalesce(models.GroupMember.last_read_message_id, 0),
+            (models.Message.sender_id != user.user_id)
+            | (models.Message.sender_id.is_(None)),
+        )
+        .group_by(models.Message.conversation_id)
+        .subquery()
+    )
+
+
+def new_friendship(username: str, friend_username: str) -> list[models.Friend]:
+    """Quan hệ bạn bè được lưu thành hai dòng đối xứng (a, b) và (b, a), nên mọi truy
+    vấn chỉ cần lọc theo user_username (một lần seek trên unique_friendship)"""
+    created_at = datetime.now(timezone.utc)
+    return [
+        models.Friend(
+            user_username=username,
+            friend_username=friend_username,
+            created_at_UTC=created_at,
+        ),
+        models.Friend(
+            user_username=friend_username,
+            friend_username=username,
+            created_at_UTC=created_at,
+        ),
+    ]
+
+
+def friendship_clause(username: str, friend_username: str):
+    """Điều kiện chọn cả hai dòng đối xứng của một quan hệ (dùng khi xóa)"""
+    return (
+        (models.Friend.user_username == username)
+        & (models.Friend.friend_username == friend_username)
+    ) | (
+        (models.Friend.user_username == friend_username)
+        & (models.Friend.friend_username == username)
+    )
+
+
+def resolve_friend_statuses(
+    db: Session, username: str, other_usernames: list[str]
+) -> dict[str, str]:
+    """Trạng thái kết bạn giữa `username` và từng user trong other_usernames, tính bằng
+    đúng hai truy vấn cho cả danh sách: "Bạn bè", "Đã gửi lời mời", "Chờ xác nhận"
+    hoặc "Chưa kết bạn" (theo thứ tự ưu tiên đó)"""
+    statuses = dict.fromkeys(other_usernames, "Chưa kết bạn")
+    others = list(statuses)
+    if not others:
+        return statuses
+
+    pending = db.query(
+        models.FriendRequest.sender_username, models.FriendRequest.receiver_username
+    ).filter(
+        models.FriendRequest.status == "Đợi",
+        (
+            (models.FriendRequest.sender_username == username)
+            & (models.FriendRequest.receiver_username.in_(others))
+        )
+        | (
+            (models.FriendRequest.receiver_username == username)
+            & (models.FriendRequest.sender_username.in_(others))
+        ),
+    )
+    # Lời mời đã gửi được ưu tiên hơn lời mời nhận được
+    for sender, receiver in sorted(pending, key=lambda row: row[0] == username):
+        if sender == username:
+            statuses[receiver] = "Đã gửi lời mời"
+        else:
+            statuses[sender] = "Chờ xác nhận"
+
+    friends = db.query(models.Friend.friend_username).filter(
+        models.Friend.user_username == username,
+        models.Friend.friend_username.in_(others),
+    )
+    for (friend_username,) in friends:
+        statuses[friend_username] = "Bạn bè"
+    return statuses
+
+
 def create_reset_token(db: Session, user_id: int):
     db.query(models.ResetToken).filter(models.ResetToken.user_id == user_id).delete()
     reset_uuid = str(uuid.uuid4())
@@ -137,20 +323,16 @@ def send_reset_email(to_email: str, reset_uuid: str, base_url: str):
         raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
 
 
-def update_last_active_dependency(request: Request, db: Session = Depends(get_db)):
+def update_last_active_dependency(request: Request):
+    # Chỉ ghi nhận trong bộ nhớ; last_active_tracker ghi xuống DB theo lô định kỳ
     token = request.headers.get("Authorization")
     if token:
         token = token.replace("Bearer ", "")
         try:
             payload = decode_jwt_token(token)
             username = payload.get("sub")
-            user = (
-                db.query(models.User).filter(models.User.username == username).first()
-            )
-            if user:
-                user.last_active_UTC = datetime.now(timezone.utc)
-                db.commit()
-                db.refresh(user)
+            if username:
+                last_active_tracker.touch(username)
         except Exception as e:
             logging.error(f"Lỗi khi cập nhật last_active: {e}")
     return None
@@ -160,8 +342,14 @@ UPLOAD_DIR = "uploads"
 AVATARS_USER_DIR = os.path.join(UPLOAD_DIR, "avatars", "users")
 AVATARS_GROUP_DIR = os.path.join(UPLOAD_DIR, "avatars", "groups")
 CONVERSATION_ATTACHMENTS_DIR = os.path.join(UPLOAD_DIR, "conversations")
+# Kho file đính kèm đánh địa chỉ theo nội dung (SHA-256), dùng chung giữa các hội thoại
+ATTACHMENT_BLOBS_DIR = os.path.join(UPLOAD_DIR, "blobs")
+# Ảnh thu nhỏ của file đính kèm, đặt tên theo SHA-256 của file gốc
+THUMBNAILS_DIR = os.path.join(UPLOAD_DIR, "thumbnails")
 
 # Tạo các thư mục nếu chưa tồn tại
 os.makedirs(AVATARS_USER_DIR, exist_ok=True)
 os.makedirs(AVATARS_GROUP_DIR, exist_ok=True)
 os.makedirs(CONVERSATION_ATTACHMENTS_DIR, exist_ok=True)
+os.makedirs(ATTACHMENT_BLOBS_DIR, exist_ok=True)
+os.makedirs(THUMBNAILS_DIR, exist_ok=True)
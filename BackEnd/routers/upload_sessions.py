@@ -0,0 +1,365 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+import models
+import schemas
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from routers.untils import (
+    UPLOAD_DIR,
+    get_current_user_async,
+    update_last_active_dependency,
+)
+from routers.uploads import (
+    SpooledUpload,
+    guess_content_type,
+    hash_file,
+    validate_extension,
+)
+
+# Mỗi phiên tải lên gồm <upload_id>.json (thông tin) và <upload_id>.part (dữ liệu)
+UPLOAD_SESSIONS_DIR = os.path.join(UPLOAD_DIR, "upload_sessions")
+# Dung lượng tối đa (byte) của một file tải lên theo phiên
+MAX_RESUMABLE_UPLOAD_SIZE = int(
+    os.getenv("MAX_RESUMABLE_UPLOAD_SIZE", 500 * 1024 * 1024)
+)
+# Số byte tối đa trong một lần PUT
+MAX_UPLOAD_CHUNK_SIZE = int(os.getenv("MAX_UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+# Phiên không nhận thêm dữ liệu sau số giây này sẽ bị xóa
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", 24 * 3600))
+UPLOAD_SESSION_GC_INTERVAL = int(os.getenv("UPLOAD_SESSION_GC_INTERVAL", 3600))
+
+os.makedirs(UPLOAD_SESSIONS_DIR, exist_ok=True)
+
+upload_sessions_router = APIRouter(prefix="/upload-sessions", tags=["Upload sessions"])
+
+# Khóa theo phiên để các lần PUT cùng phiên không ghi chồng lên nhau
+_session_locks: dict[str, asyncio.Lock] = {}
+_gc_task: asyncio.Task | None = None
+
+
+def _meta_path(upload_id: str) -> str:
+    return os.path.join(UPLOAD_SESSIONS_DIR, f"{upload_id}.json")
+
+
+def _data_path(upload_id: str) -> str:
+    return os.path.join(UPLOAD_SESSIONS_DIR, f"{upload_id}.part")
+
+
+def _claimed_path(upload_id: str) -> str:
+    # Thông tin phiên đang được một tin nhắn sử dụng (đổi tên từ .json)
+    return os.path.join(UPLOAD_SESSIONS_DIR, f"{upload_id}.claimed")
+
+
+def _create_session_files(meta: dict):
+    open(_data_path(meta["upload_id"]), "wb").close()
+    _write_meta(meta)
+
+
+def _claim(upload_id: str):
+    os.rename(_meta_path(upload_id), _claimed_path(upload_id))
+    # Mốc thời gian cho GC: phiên đang được gửi không bị coi là bỏ dở
+    os.utime(_claimed_path(upload_id))
+
+
+def _write_meta(meta: dict):
+    temp_path = _meta_path(meta["upload_id"]) + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(meta, file)
+    os.replace(temp_path, _meta_path(meta["upload_id"]))
+
+
+def _remove_session(upload_id: str):
+    paths = (_meta_path(upload_id), _data_path(upload_id), _claimed_path(upload_id))
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    _session_locks.pop(upload_id, None)
+
+
+def _session_lock(upload_id: str) -> asyncio.Lock:
+    return _session_locks.setdefault(upload_id, asyncio.Lock())
+
+
+def load_upload_session(upload_id: str, username: str) -> dict:
+    """Đọc thông tin phiên của user; 404 nếu không có, hết hạn hoặc của người khác"""
+    not_found = HTTPException(
+        status_code=404, detail="Phiên tải lên không tồn tại hoặc đã hết hạn!"
+    )
+    try:
+        upload_id = uuid.UUID(upload_id).hex
+    except ValueError:
+        raise not_found
+
+    try:
+        with open(_meta_path(upload_id)) as file:
+            meta = json.load(file)
+    except FileNotFoundError:
+        raise not_found
+
+    if meta["username"] != username or meta["expires_at"] < time.time():
+        raise not_found
+    return meta
+
+
+def ensure_session_open(meta: dict):
+    """Kiểm tra lại (khi đang giữ khóa phiên) rằng phiên chưa bị giữ hoặc bị xóa"""
+    upload_id = meta["upload_id"]
+    if os.path.exists(_meta_path(upload_id)):
+        return
+    if os.path.exists(_claimed_path(upload_id)):
+        raise HTTPException(
+            status_code=409,
+            detail=f"File {meta['filename']} đang được gửi trong tin nhắn khác!",
+        )
+    raise HTTPException(
+        status_code=404, detail="Phiên tải lên không tồn tại hoặc đã hết hạn!"
+    )
+
+
+def _session_response(meta: dict) -> dict:
+    return {
+        "upload_id": meta["upload_id"],
+        "filename": meta["filename"],
+        "size": meta["size"],
+        "offset": os.path.getsize(_data_path(meta["upload_id"])),
+        "expires_at_UTC": datetime.fromtimestamp(meta["expires_at"], timezone.utc),
+    }
+
+
+def ensure_upload_complete(upload_id: str, username: str) -> dict:
+    meta = load_upload_session(upload_id, username)
+    try:
+        received = os.path.getsize(_data_path(meta["upload_id"]))
+    except FileNotFoundError:
+        # Một request khác vừa gửi xong phiên này
+        raise HTTPException(
+            status_code=404, detail="Phiên tải lên không tồn tại hoặc đã hết hạn!"
+        )
+    if received != meta["size"]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"File {meta['filename']} chưa được tải lên đầy đủ!",
+        )
+    return meta
+
+
+class SessionUpload(SpooledUpload):
+    """File của một phiên đã được giữ cho một tin nhắn. Dữ liệu nằm nguyên trong phiên
+    cho tới khi store_blobs chuyển nó vào kho blob; discard trả phiên lại nếu tin nhắn
+    không được lưu, hoặc dọn phiên nếu file đã vào kho blob"""
+
+    def __init__(self, meta: dict, content_hash: str):
+        super().__init__(
+            _data_path(meta["upload_id"]),
+            meta["size"],
+            content_hash,
+            meta["extension"],
+            # Phiên tạo trước khi có giá trị mặc định có thể thiếu content_type
+            meta["content_type"] or guess_content_type(meta["filename"]),
+        )
+        self.upload_id = meta["upload_id"]
+
+    def discard(self):
+        if self.stored:
+            _remove_session(self.upload_id)
+            return
+        try:
+            os.replace(_claimed_path(self.upload_id), _meta_path(self.upload_id))
+        except FileNotFoundError:
+            pass
+
+
+async def claim_upload_session(upload_id: str, username: str) -> SessionUpload:
+    """Giữ phiên đã nhận đủ dữ liệu cho một tin nhắn và tính SHA-256. Việc giữ là
+    nguyên tử (đổi tên file thông tin), nên hai request gửi cùng upload_id thì chỉ
+    một request dùng được; phiên chưa bị xóa cho tới khi tin nhắn được commit"""
+    meta = await asyncio.to_thread(ensure_upload_complete, upload_id, username)
+    upload_id = meta["upload_id"]
+    async with _session_lock(upload_id):
+        try:
+            await asyncio.to_thread(_claim, upload_id)
+        except FileNotFoundError:
+            raise HTTPException(
+                status_code=409,
+                detail=f"File {meta['filename']} đang được gửi trong tin nhắn khác!",
+            )
+        try:
+            content_hash = await asyncio.to_thread(hash_file, _data_path(upload_id))
+        except BaseException:
+            await asyncio.to_thread(
+                os.replace, _claimed_path(upload_id), _meta_path(upload_id)
+            )
+            raise
+    return SessionUpload(meta, content_hash)
+
+
+def collect_expired_upload_sessions() -> int:
+    """Xóa các phiên đã hết hạn và file .part mồ côi"""
+    now = time.time()
+    removed = 0
+    for filename in os.listdir(UPLOAD_SESSIONS_DIR):
+        upload_id, extension = os.path.splitext(filename)
+        path = os.path.join(UPLOAD_SESSIONS_DIR, filename)
+        try:
+            if extension == ".json":
+                with open(path) as file:
+                    expired = json.load(file)["expires_at"] < now
+            elif extension == ".part" and os.path.exists(_claimed_path(upload_id)):
+                continue
+            elif not os.path.exists(_meta_path(upload_id)):
+                # .part mồ côi hoặc .claimed của một lần gửi bị gián đoạn
+                expired = os.path.getmtime(path) < now - UPLOAD_SESSION_TTL
+            else:
+                continue
+        except (OSError, ValueError, KeyError):
+            continue
+        if expired:
+            _remove_session(upload_id)
+            removed += 1
+    return removed
+
+
+async def _collect_periodically():
+    while True:
+        await asyncio.sleep(UPLOAD_SESSION_GC_INTERVAL)
+        try:
+            await asyncio.to_thread(collect_expired_upload_sessions)
+        except Exception as e:
+            logging.error(f"Lỗi khi dọn phiên tải lên: {e}")
+
+
+async def start_upload_session_gc():
+    global _gc_task
+    if _gc_task is None:
+        _gc_task = asyncio.create_task(_collect_periodically())
+
+
+async def stop_upload_session_gc():
+    global _gc_task
+    if _gc_task is not None:
+        _gc_task.cancel()
+        _gc_task = None
+
+
+@upload_sessions_router.post(
+    "/",
+    response_model=schemas.UploadSessionResponse,
+    dependencies=[Depends(update_last_active_dependency)],
+)
+async def create_upload_session(
+    request: schemas.UploadSessionCreate,
+    current_user: models.User = Depends(get_current_user_async),
+):
+    extension = validate_extension(request.filename)
+    if request.size > MAX_RESUMABLE_UPLOAD_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File {request.filename} vượt quá dung lượng cho phép!",
+        )
+
+    upload_id = uuid.uuid4().hex
+    meta = {
+        "upload_id": upload_id,
+        "username": current_user.username,
+        "filename": request.filename,
+        "extension": extension,
+        "content_type": request.content_type or guess_content_type(request.filename),
+        "size": request.size,
+        "expires_at": time.time() + UPLOAD_SESSION_TTL,
+    }
+    await asyncio.to_thread(_create_session_files, meta)
+    return await asyncio.to_thread(_session_response, meta)
+
+
+@upload_sessions_router.get(
+    "/{upload_id}",
+    response_model=schemas.UploadSessionResponse,
+    dependencies=[Depends(update_last_active_dependency)],
+)
+async def get_upload_session(
+    upload_id: str, current_user: models.User = Depends(get_current_user_async)
+):
+    """Trạng thái phiên: client dùng `offset` để biết cần gửi tiếp từ byte nào"""
+    meta = await asyncio.to_thread(
+        load_upload_session, upload_id, current_user.username
+    )
+    return await asyncio.to_thread(_session_response, meta)
+
+
+@upload_sessions_router.put(
+    "/{upload_id}",
+    response_model=schemas.UploadSessionResponse,
+    dependencies=[Depends(update_last_active_dependency)],
+)
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0, description="Vị trí byte đầu tiên của phần này"),
+    current_user: models.User = Depends(get_current_user_async),
+):
+    """Nhận một phần dữ liệu (body thô). Phần phải bắt đầu đúng tại offset server đang
+    có; nếu kết nối đứt giữa chừng, các byte đã nhận vẫn được giữ lại"""
+    meta = await asyncio.to_thread(
+        load_upload_session, upload_id, current_user.username
+    )
+    upload_id = meta["upload_id"]
+    data_path = _data_path(upload_id)
+
+    async with _session_lock(upload_id):
+        # meta được đọc trước khi giữ khóa: phiên có thể vừa được giữ cho một tin
+        # nhắn (đổi tên .json) hoặc bị hủy trong lúc chờ
+        await asyncio.to_thread(ensure_session_open, meta)
+        current_size = await asyncio.to_thread(os.path.getsize, data_path)
+        if offset != current_size:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Offset không khớp, server đã nhận {current_size} byte!",
+            )
+
+        received = 0
+        buffer = await asyncio.to_thread(open, data_path, "ab")
+        with buffer:
+            try:
+                async for chunk in request.stream():
+                    received += len(chunk)
+                    if (
+                        received > MAX_UPLOAD_CHUNK_SIZE
+                        or current_size + received > meta["size"]
+                    ):
+                        raise HTTPException(
+                            status_code=413,
+                            detail="Phần dữ liệu vượt quá dung lượng cho phép!",
+                        )
+                    await asyncio.to_thread(buffer.write, chunk)
+            except HTTPException:
+                await asyncio.to_thread(buffer.truncate, current_size)
+                raise
+            finally:
+                await asyncio.to_thread(buffer.flush)
+
+        meta["expires_at"] = time.time() + UPLOAD_SESSION_TTL
+        await asyncio.to_thread(_write_meta, meta)
+
+    return await asyncio.to_thread(_session_response, meta)
+
+
+@upload_sessions_router.delete(
+    "/{upload_id}", dependencies=[Depends(update_last_active_dependency)]
+)
+async def cancel_upload_session(
+    upload_id: str, current_user: models.User = Depends(get_current_user_async)
+):
+    meta = await asyncio.to_thread(
+        load_upload_session, upload_id, current_user.username
+    )
+    async with _session_lock(meta["upload_id"]):
+        await asyncio.to_thread(ensure_session_open, meta)
+        await asyncio.to_thread(_remove_session, meta["upload_id"])
+    return {"message": "Đã hủy phiên tải lên", "upload_id": meta["upload_id"]}
@@ -0,0 +1,393 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from typing import Iterable, List
+
+import models
+from fastapi import APIRouter, HTTPException, Request, UploadFile
+from fastapi.responses import FileResponse, Response
+from routers.untils import ATTACHMENT_BLOBS_DIR, THUMBNAILS_DIR, UPLOAD_DIR
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ khóa được giữa các request trong cùng tiến trình
+    fcntl = None
+
+# Kích thước mỗi lần đọc/ghi khi lưu file tải lên
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Dung lượng tối đa (byte) của một file đính kèm
+MAX_ATTACHMENT_SIZE = int(os.getenv("MAX_ATTACHMENT_SIZE", 50 * 1024 * 1024))
+# Tổng dung lượng tối đa (byte) các file trong một request
+MAX_UPLOAD_REQUEST_SIZE = int(os.getenv("MAX_UPLOAD_REQUEST_SIZE", 200 * 1024 * 1024))
+ALLOWED_ATTACHMENT_EXTENSIONS = ["jpg", "jpeg", "png", "pdf", "mp4", "mp3"]
+# File tạm khi tải lên nằm cùng hệ thống file với kho blob để đổi tên nguyên tử
+UPLOAD_TEMP_DIR = os.path.join(ATTACHMENT_BLOBS_DIR, "tmp")
+# File khóa dùng chung giữa các worker và maintenance.py khi lưu/xóa blob
+BLOB_LOCKS_DIR = os.path.join(UPLOAD_DIR, "blob_locks")
+
+
+# Tên file trong kho blob: <sha256>.<đuôi>
+BLOB_FILENAME = re.compile(r"([0-9a-f]{64})\.([a-z0-9]+)")
+# Blob không bao giờ đổi nội dung nên trình duyệt được cache vĩnh viễn
+BLOB_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+blobs_router = APIRouter(tags=["Attachments"])
+
+_blob_locks: dict[str, asyncio.Lock] = {}
+
+
+def blob_url(content_hash: str, extension: str) -> str:
+    """Đường dẫn (đồng thời là file_url) của blob: cùng nội dung thì cùng đường dẫn"""
+    return f"uploads/blobs/{content_hash[:2]}/{content_hash}.{extension}"
+
+
+def thumbnail_url(content_hash: str) -> str:
+    """Đường dẫn ảnh thu nhỏ (JPEG) dùng chung cho mọi file có cùng nội dung"""
+    return f"uploads/thumbnails/{content_hash[:2]}/{content_hash}.jpg"
+
+
+def _open_blob_lock(content_hash: str):
+    """Mở và khóa (chặn) file khóa của nhóm blob chứa content_hash. Khóa được nhả khi
+    đóng file"""
+    os.makedirs(BLOB_LOCKS_DIR, exist_ok=True)
+    lock_file = open(os.path.join(BLOB_LOCKS_DIR, f"{content_hash[:2]}.lock"), "a")
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+@contextmanager
+def blob_file_lock(content_hash: str):
+    """Khóa liên tiến trình của blob, dùng cho các lệnh bảo trì chạy đồng bộ"""
+    lock_file = _open_blob_lock(content_hash)
+    try:
+        yield
+    finally:
+        lock_file.close()
+
+
+@asynccontextmanager
+async def blob_lock(content_hash: str):
+    """Tuần tự hóa việc lưu và xóa blob cùng nội dung: store_blob và
+    release_attachment_files đều giữ khóa này. Khóa theo nhóm hai ký tự đầu của
+    SHA-256 (cùng thư mục con của kho blob) nên số khóa không tăng theo số file"""
+    lock = _blob_locks.setdefault(content_hash[:2], asyncio.Lock())
+    async with lock:
+        lock_file = await asyncio.to_thread(_open_blob_lock, content_hash)
+        try:
+            yield
+        finally:
+            lock_file.close()
+
+
+class SpooledUpload:
+    """File tải lên đã được ghi trọn vào file tạm, chờ đổi tên vào vị trí cuối"""
+
+    def __init__(
+        self,
+        temp_path: str,
+        size: int,
+        content_hash: str,
+        extension: str,
+        content_type: str,
+    ):
+        self.temp_path = temp_path
+        self.size = size
+        self.content_hash = content_hash
+        self.extension = extension
+        self.content_type = content_type
+        # Dữ liệu đã được chuyển vào kho blob (không còn ở temp_path)
+        self.stored = False
+
+    @property
+    def blob_url(self) -> str:
+        return blob_url(self.content_hash, self.extension)
+
+    async def commit(self, destination: str):
+        # os.replace là nguyên tử trên cùng hệ thống file: không ai thấy file dở dang
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        await asyncio.to_thread(os.replace, self.temp_path, destination)
+
+    async def store_blob(self):
+        """Đưa file vào kho blob; nếu blob đã có sẵn thì thay bằng bản cùng nội dung
+        (nguyên tử). Chỉ gọi qua store_blobs, khi đang giữ khóa blob."""
+        await self.commit(self.blob_url)
+        self.stored = True
+
+    async def unstore_blob(self):
+        """Trả file từ kho blob về temp_path (khi Attachment không được commit)"""
+        try:
+            await asyncio.to_thread(os.replace, self.blob_url, self.temp_path)
+        except FileNotFoundError:
+            # Một file khác cùng nội dung trong request đã lấy lại blob này
+            pass
+        self.stored = False
+
+    def discard(self):
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+def validate_extension(filename: str) -> str:
+    """Lấy phần mở rộng của file đính kèm, báo lỗi nếu định dạng không được hỗ trợ"""
+    file_extension = filename.split(".")[-1].lower()
+    if file_extension not in ALLOWED_ATTACHMENT_EXTENSIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Định dạng file {file_extension} không được hỗ trợ!",
+        )
+    return file_extension
+
+
+def guess_content_type(filename: str) -> str:
+    """Kiểu MIME đoán từ tên file khi client không gửi (file_type là NOT NULL)"""
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def attachment_extension(file: UploadFile) -> str:
+    return validate_extension(file.filename)
+
+
+def hash_file(path: str) -> str:
+    """SHA-256 của một file trên đĩa (hàm chặn, gọi qua asyncio.to_thread)"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _write_chunk(buffer, hasher, chunk: bytes):
+    hasher.update(chunk)
+    buffer.write(chunk)
+
+
+def _finish(buffer):
+    buffer.flush()
+    os.fsync(buffer.fileno())
+    buffer.close()
+
+
+async def spool_upload(
+    file: UploadFile, directory: str, max_size: int = MAX_ATTACHMENT_SIZE
+) -> SpooledUpload:
+    """Ghi file theo từng khối vào file tạm trong `directory` (ngoài event loop),
+    đồng thời tính SHA-256 và dừng ngay khi vượt quá max_size"""
+    file_extension = attachment_extension(file)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".upload-", suffix=".part")
+    buffer = os.fdopen(fd, "wb")
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_size:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"File {file.filename} vượt quá dung lượng cho phép!",
+                )
+            await asyncio.to_thread(_write_chunk, buffer, hasher, chunk)
+        await asyncio.to_thread(_finish, buffer)
+    except BaseException:
+        buffer.close()
+        os.remove(temp_path)
+        raise
+
+    return SpooledUpload(
+        temp_path,
+        size,
+        hasher.hexdigest(),
+        file_extension,
+        file.content_type or guess_content_type(file.filename),
+    )
+
+
+async def spool_uploads(
+    files: List[UploadFile], directory: str = UPLOAD_TEMP_DIR
+) -> list[SpooledUpload]:
+    """Lưu tạm mọi file của một request, áp dụng giới hạn từng file và tổng request.
+    Nếu có lỗi, các file tạm đã ghi đều bị xóa."""
+    for file in files:
+        attachment_extension(file)
+
+    spooled = []
+    total_size = 0
+    try:
+        for file in files:
+            remaining = MAX_UPLOAD_REQUEST_SIZE - total_size
+            upload = await spool_upload(
+                file, directory, min(MAX_ATTACHMENT_SIZE, remaining)
+            )
+            spooled.append(upload)
+            total_size += upload.size
+    except BaseException:
+        for upload in spooled:
+            upload.discard()
+        raise
+    return spooled
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.error(f"Lỗi khi xóa file {path}: {e}")
+
+
+async def _is_referenced(db: AsyncSession, column, value) -> bool:
+    return (
+        await db.scalar(
+            select(models.Attachment.attachment_id).where(column == value).limit(1)
+        )
+    ) is not None
+
+
+async def release_attachment_files(db: AsyncSession, file_urls: Iterable[str]) -> int:
+    """Xóa các file không còn Attachment nào tham chiếu (đếm tham chiếu theo file_url
+    trong bảng attachments). Gọi sau khi đã commit việc xóa Attachment."""
+    file_urls = set(file_urls)
+    if not file_urls:
+        return 0
+
+    # Lọc nhanh một lần; các file còn lại được kiểm tra lại trong khóa blob
+    candidates = file_urls - set(
+        await db.scalars(
+            select(models.Attachment.file_url)
+            .where(models.Attachment.file_url.in_(file_urls))
+            .distinct()
+        )
+    )
+    removed = 0
+    for file_url in candidates:
+        match = BLOB_FILENAME.fullmatch(os.path.basename(file_url))
+        if match is None:
+            # File cũ ngoài kho blob không dùng chung giữa các tin nhắn
+            await asyncio.to_thread(_remove_file, file_url)
+            removed += 1
+            continue
+
+        content_hash = match.group(1)
+        async with blob_lock(content_hash):
+            # Một tin nhắn cùng nội dung có thể vừa commit sau lần lọc ở trên
+            if await _is_referenced(db, models.Attachment.file_url, file_url):
+                continue
+            await asyncio.to_thread(_remove_file, file_url)
+            removed += 1
+            # Ảnh thu nhỏ đi theo nội dung: chỉ xóa khi không còn file nào cùng SHA-256
+            if not await _is_referenced(
+                db, models.Attachment.content_hash, content_hash
+            ):
+                await asyncio.to_thread(_remove_file, thumbnail_url(content_hash))
+    return removed
+
+
+@asynccontextmanager
+async def store_blobs(db: AsyncSession, uploads: list[SpooledUpload]):
+    """Đưa các file vào kho blob trước khi commit các Attachment tham chiếu tới chúng,
+    và giữ khóa blob cho tới hết khối with (nơi commit): release_attachment_files và
+    maintenance.py không thể xóa blob chưa có dòng nào tham chiếu. Nếu khối with lỗi
+    thì rollback và trả các blob không được dòng nào khác dùng về file tạm."""
+    hashes = {upload.content_hash[:2]: upload.content_hash for upload in uploads}
+    async with AsyncExitStack() as stack:
+        # Khóa theo thứ tự cố định để hai request không chờ nhau vòng tròn
+        for bucket in sorted(hashes):
+            await stack.enter_async_context(blob_lock(hashes[bucket]))
+        try:
+            for upload in uploads:
+                await upload.store_blob()
+            yield
+        except BaseException:
+            await db.rollback()
+            for upload in uploads:
+                if upload.stored and not await _is_referenced(
+                    db, models.Attachment.file_url, upload.blob_url
+                ):
+                    await upload.unstore_blob()
+            raise
+
+
+async def delete_conversation_attachments(
+    db: AsyncSession, conversation_id: int
+) -> set[str]:
+    """Xóa (chưa commit) các Attachment của cuộc hội thoại, trả về các file_url để
+    truyền cho release_attachment_files sau khi commit"""
+    message_ids = select(models.Message.message_id).where(
+        models.Message.conversation_id == conversation_id
+    )
+    file_urls = set(
+        await db.scalars(
+            select(models.Attachment.file_url).where(
+                models.Attachment.message_id.in_(message_ids)
+            )
+        )
+    )
+    await db.execute(
+        delete(models.Attachment).where(models.Attachment.message_id.in_(message_ids))
+    )
+    return file_urls
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def attachment_response(
+    request: Request, path: str, download_name: str | None = None
+) -> Response:
+    """Trả file đính kèm với đúng Content-Type. Range/If-Range do FileResponse xử lý;
+    blob có ETag mạnh theo SHA-256, được cache lâu dài và trả 304 khi client đã có"""
+    filename = os.path.basename(path)
+    blob_match = BLOB_FILENAME.fullmatch(filename)
+    if blob_match:
+        etag = f'"{blob_match.group(1)}"'
+        headers = {"ETag": etag, "Cache-Control": BLOB_CACHE_CONTROL}
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+    else:
+        # File cũ có thể bị ghi đè nên luôn phải kiểm tra lại với server
+        headers = {"Cache-Control": "no-cache"}
+
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    return FileResponse(
+        path, media_type=media_type, filename=download_name, headers=headers
+    )
+
+
+def _content_addressed_response(
+    directory: str, prefix: str, filename: str, request: Request
+) -> Response:
+    path = os.path.join(directory, prefix, filename)
+    if (
+        not BLOB_FILENAME.fullmatch(filename)
+        or prefix != filename[:2]
+        or not os.path.isfile(path)
+    ):
+        raise HTTPException(status_code=404, detail="File không tồn tại")
+    return attachment_response(request, path)
+
+
+@blobs_router.api_route("/uploads/blobs/{prefix}/{filename}", methods=["GET", "HEAD"])
+def get_blob(prefix: str, filename: str, request: Request):
+    return _content_addressed_response(ATTACHMENT_BLOBS_DIR, prefix, filename, request)
+
+
+@blobs_router.api_route(
+    "/uploads/thumbnails/{prefix}/{filename}", methods=["GET", "HEAD"]
+)
+def get_thumbnail(prefix: str, filename: str, request: Request):
+    return _content_addressed_response(THUMBNAILS_DIR, prefix, filename, request)
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import anyio.from_thread
+import models
+from routers.websocket import websocket_manager
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+# Thời gian (giây) một bản ghi user đã xác thực được dùng lại mà không truy vấn DB
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", 60))
+# Số user tối đa giữ trong cache (bỏ user ít dùng nhất khi đầy)
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", 1000))
+
+
+class AuthUserCache:
+    """Cache TTL/LRU các cột của user đã xác thực, khóa theo user_id.
+    Chỉ lưu giá trị cột; mỗi request nhận một đối tượng User riêng gắn vào session
+    của request đó nên handler vẫn sửa/xóa current_user như bình thường.
+    Lệnh xóa khỏi cache được phát qua broker tới mọi worker. Tin phát lúc broker mất
+    kết nối có thể bị lỡ, nên worker khác vẫn có thể dùng bản cũ tối đa ttl giây."""
+
+    def __init__(
+        self,
+        broker=None,
+        ttl: float = AUTH_CACHE_TTL,
+        max_size: int = AUTH_CACHE_SIZE,
+    ):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict[int, tuple[float, dict]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Dependency xác thực là hàm đồng bộ, chạy song song trong threadpool
+        self._lock = threading.Lock()
+        self.broker = broker
+        # Giữ tham chiếu các task phát tin để không bị thu gom giữa chừng
+        self._tasks: set[asyncio.Task] = set()
+        if broker is not None:
+            broker.subscribe(self._on_broker_envelope)
+
+    def get(self, db: Session, user_id: int) -> models.User | None:
+        with self._lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(user_id, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            values = entry[1]
+
+        existing = db.identity_map.get(db.identity_key(models.User, (user_id,)))
+        if existing is not None:
+            return existing
+
+        # Dựng lại User như vừa được load từ DB rồi gắn vào session hiện tại
+        user = models.User(**values)
+        make_transient_to_detached(user)
+        db.add(user)
+        return user
+
+    def put(self, user: models.User):
+        values = {
+            attr.key: getattr(user, attr.key)
+            for attr in inspect(models.User).column_attrs
+        }
+        with self._lock:
+            self.entries[user.user_id] = (time.monotonic() + self.ttl, values)
+            self.entries.move_to_end(user.user_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def _evict(self, user_id: int):
+        with self._lock:
+            self.entries.pop(user_id, None)
+
+    def invalidate(self, user_id: int):
+        """Gọi sau khi thông tin, mật khẩu hoặc tài khoản của user thay đổi (sau
+        commit): xóa ở worker này ngay và báo các worker khác qua broker"""
+        self._evict(user_id)
+        if self.broker is None:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            try:
+                # Handler đồng bộ chạy trong threadpool: tạo task trên event loop
+                anyio.from_thread.run_sync(self._spawn_publish, user_id)
+            except RuntimeError:
+                # Ngoài server (vd. lệnh bảo trì): không có worker nào để báo
+                pass
+            return
+        self._spawn_publish(user_id)
+
+    def _spawn_publish(self, user_id: int):
+        task = asyncio.create_task(self._publish(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _publish(self, user_id: int):
+        try:
+            await self.broker.publish({"kind": "auth_invalidate", "user_id": user_id})
+        except Exception as e:
+            logging.error(f"Lỗi khi phát lệnh xóa cache xác thực qua broker: {e}")
+
+    def _on_broker_envelope(self, envelope: dict):
+        if envelope.get("kind") == "auth_invalidate":
+            self._evict(envelope["user_id"])
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+auth_user_cache = AuthUserCache(websocket_manager.broker)
@@ -5,20 +5,35 @@ from typing import List
 
 import models
 from database import get_db
-from fastapi import APIRouter, Depends, File, HTTPException, Path, Query, UploadFile
+from fastapi import (
+    APIRouter,
+    Depends,
+    File,
+    HTTPException,
+    Path,
+    Query,
+    Response,
+    UploadFile,
+)
 from pydantic import EmailStr
 from routers.auth import ALGORITHM, SECRET_KEY, oauth2_scheme
+from routers.presence import last_active_tracker
+from routers.search import index_user, normalize_text, prefix_match, tokenize
 from routers.untils import (
     AVATARS_USER_DIR,
+    decode_cursor,
+    encode_cursor,
     get_current_user,
-    hash_password,
-    pwd_context,
+    hash_password_async,
+    resolve_friend_statuses,
     update_last_active_dependency,
+    verify_password_async,
 )
+from routers.user_cache import auth_user_cache
 from routers.websocket import websocket_manager
 from schemas import ChangePassword, UserResponse, UserWithFriendStatus
-from sqlalchemy import case
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, case, exists, or_
+from sqlalchemy.orm import Session, aliased
 
 # Tạo router
 users_router = APIRouter(prefix="/users", tags=["User"])
@@ -37,7 +52,8 @@ async def get_user_info(current_user: models.User = Depends(get_current_user)):
         nickname=current_user.nickname,
         email=current_user.email,
         avatar=current_user.avatar,
-        last_active_UTC=current_user.last_active_UTC,
+        last_active_UTC=last_active_tracker.last_seen(current_user.username)
+        or current_user.last_active_UTC,
         created_at_UTC=current_user.created_at_UTC,
     )
 
@@ -48,82 +64,70 @@ async def get_user_info(current_user: models.User = Depends(get_current_user)):
     dependencies=[Depends(update_last_active_dependency)],
 )
 async def search_users(
+    response: Response,
     query: str = Query(..., description="Từ khóa tìm kiếm"),
     search_by_nickname: bool = Query(False, description="Tìm kiếm theo nickname"),
+    limit: int = Query(20, ge=1, le=50),
+    cursor: str | None = Query(
+        None, description="Con trỏ trang tiếp theo, lấy từ header X-Next-Cursor"
+    ),
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
+    """Tìm user theo tiền tố của username hoặc các từ trong nickname (không phân biệt
+    hoa thường, dấu) qua bảng user_search_terms. Kết quả khớp chính xác đứng đầu"""
     if search_by_nickname:
-        users = (
-            db.query(models.User)
-            .filter(
-                models.User.nickname.ilike(f"%{query}%"),
-                models.User.is_admin == False,
-                models.User.username != current_user.username,
-            )
-            .all()
-        )
+        field, prefix = "nickname", " ".join(tokenize(query))
     else:
-        users = (
-            db.query(models.User)
-            .filter(
-                models.User.username.ilike(f"%{query}%"),
-                models.User.is_admin == False,
-                models.User.username != current_user.username,
+        field, prefix = "username", normalize_text(query.strip())
+    if not prefix:
+        return []
+
+    dialect = db.get_bind().dialect.name
+    terms = models.UserSearchTerm
+    earlier = aliased(models.UserSearchTerm)
+    matches = (
+        db.query(terms.term, models.User)
+        .join(models.User, models.User.user_id == terms.user_id)
+        .filter(
+            terms.field == field,
+            prefix_match(terms.term, prefix, dialect),
+            # Mỗi user chỉ giữ dòng có từ khớp nhỏ nhất (min(term)), nên khóa
+            # (term, user_id) của user là duy nhất: không trùng giữa các trang mà
+            # vẫn duyệt theo thứ tự index và dừng ở LIMIT thay vì GROUP BY mọi dòng
+            ~exists().where(
+                earlier.user_id == terms.user_id,
+                earlier.field == field,
+                prefix_match(earlier.term, prefix, dialect),
+                earlier.term < terms.term,
+            ),
+            models.User.is_admin == False,
+            models.User.username != current_user.username,
+        )
+    )
+    if cursor:
+        term, user_id = decode_cursor(cursor, str, int)
+        matches = matches.filter(
+            or_(
+                terms.term > term,
+                and_(terms.term == term, terms.user_id > user_id),
             )
-            .all()
         )
+    rows = matches.order_by(terms.term, terms.user_id).limit(limit).all()
+    if len(rows) == limit:
+        last_term, last_user = rows[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(
+            last_term, last_user.user_id
+        )
+    users = [user for _, user in rows]
 
-    results = []
+    # Trạng thái kết bạn của cả trang kết quả trong hai truy vấn
+    statuses = resolve_friend_statuses(
+        db, current_user.username, [user.username for user in users]
+    )
 
+    results = []
     for user in users:
-        # Mặc định trạng thái
-        status = "Chưa kết bạn"
-
-        # Là bạn bè?
-        is_friend = (
-            db.query(models.Friend)
-            .filter(
-                (
-                    (models.Friend.user_username == current_user.username)
-                    & (models.Friend.friend_username == user.username)
-                )
-                | (
-                    (models.Friend.user_username == user.username)
-                    & (models.Friend.friend_username == current_user.username)
-                )
-            )
-            .first()
-        )
-        if is_friend:
-            status = "Bạn bè"
-        else:
-            # Đã gửi lời mời?
-            sent = (
-                db.query(models.FriendRequest)
-                .filter(
-                    models.FriendRequest.sender_username == current_user.username,
-                    models.FriendRequest.receiver_username == user.username,
-                    models.FriendRequest.status == "Đợi",
-                )
-                .first()
-            )
-            if sent:
-                status = "Đã gửi lời mời"
-            else:
-                # Đã nhận lời mời?
-                received = (
-                    db.query(models.FriendRequest)
-                    .filter(
-                        models.FriendRequest.sender_username == user.username,
-                        models.FriendRequest.receiver_username == current_user.username,
-                        models.FriendRequest.status == "Đợi",
-                    )
-                    .first()
-                )
-                if received:
-                    status = "Chờ xác nhận"
-
         results.append(
             UserWithFriendStatus(
                 user_id=user.user_id,
@@ -133,7 +137,7 @@ async def search_users(
                 avatar=user.avatar,
                 created_at_UTC=user.created_at_UTC,
                 last_active_UTC=user.last_active_UTC,
-                status=status,
+                status=statuses[user.username],
             )
         )
 
@@ -163,6 +167,7 @@ async def update_user_and_avatar(
 
     if nickname:
         current_user.nickname = nickname
+        index_user(db, current_user)
     if email:
         current_user.email = email
 
@@ -194,6 +199,7 @@ async def update_user_and_avatar(
         current_user.avatar = normalized_path
 
     db.commit()
+    auth_user_cache.invalidate(current_user.user_id)
     db.refresh(current_user)
 
     return {
@@ -315,10 +321,14 @@ async def delete_user(
         models.Warning.target_id == current_user.user_id
     ).update({"target_id": None})
     # Xóa tài khoản
+    db.query(models.UserSearchTerm).filter(
+        models.UserSearchTerm.user_id == current_user.user_id
+    ).delete()
     db.delete(current_user)
 
     try:
         db.commit()
+        auth_user_cache.invalidate(current_user.user_id)
 
         # Xóa các thông báo không cần thiết
         db.query(models.Notification).filter(
@@ -625,14 +635,17 @@ async def change_password(
     db: Session = Depends(get_db),
 ):
     # Kiểm tra mật khẩu cũ
-    if not pwd_context.verify(request.current_password, current_user.password_hash):
+    if not await verify_password_async(
+        request.current_password, current_user.password_hash
+    ):
         raise HTTPException(status_code=400, detail="Mật khẩu hiện tại không đúng!")
 
     # Cập nhật mật khẩu mới
-    current_user.password_hash = hash_password(request.new_password)
+    current_user.password_hash = await hash_password_async(request.new_password)
 
     try:
         db.commit()
+        auth_user_cache.invalidate(current_user.user_id)
         db.refresh(current_user)
 
         # Thông báo cho người dùng
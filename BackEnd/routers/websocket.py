@@ -1,53 +1,253 @@
+import asyncio
 import json
+import os
+import time
 from datetime import datetime, timezone
-from typing import List
+from typing import Callable, List
 
 from fastapi import WebSocket, WebSocketDisconnect
+from routers.pubsub import create_broker
+
+# Thời gian tối đa (giây) cho một lần gửi tới một socket trước khi coi socket đó hỏng
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", 5))
+# Số tin tối đa chờ gửi trong hàng đợi của mỗi kết nối
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", 100))
+# Cách xử lý khi hàng đợi đầy: drop_oldest | drop_newest | disconnect
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop_oldest")
+
+# Mã đóng khi kết nối bị loại: tràn hàng đợi (client nên kết nối lại sau) và lỗi gửi
+WS_CLOSE_TRY_AGAIN_LATER = 1013
+WS_CLOSE_INTERNAL_ERROR = 1011
+
+
+class ConnectionOutbox:
+    """Hàng đợi gửi có giới hạn của một kết nối, được xả bởi một task ghi riêng.
+    Các handler chỉ đưa tin vào hàng đợi, không bao giờ chờ I/O mạng."""
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        user_type: str,
+        username: str | None,
+        on_failure: Callable[["ConnectionOutbox", int], None],
+        max_size: int = WS_QUEUE_SIZE,
+        policy: str = WS_OVERFLOW_POLICY,
+    ):
+        self.websocket = websocket
+        self.user_type = user_type
+        self.username = username
+        self.policy = policy
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=max_size)
+        self.sent_count = 0
+        self.dropped_count = 0
+        # Lần cuối client gửi heartbeat (hoặc lúc kết nối)
+        self.last_heartbeat = time.monotonic()
+        self._on_failure = on_failure
+        self._writer = asyncio.create_task(self._drain())
+
+    def enqueue(self, message: str) -> bool:
+        """Đưa tin vào hàng đợi; áp dụng chính sách tràn nếu hàng đợi đã đầy"""
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            self.dropped_count += 1
+
+        if self.policy == "drop_newest":
+            return False
+        if self.policy == "disconnect":
+            self._on_failure(self, WS_CLOSE_TRY_AGAIN_LATER)
+            return False
+
+        # drop_oldest: bỏ tin cũ nhất để nhường chỗ cho tin mới
+        self.queue.get_nowait()
+        self.queue.put_nowait(message)
+        return True
+
+    async def _drain(self):
+        while True:
+            message = await self.queue.get()
+            try:
+                await asyncio.wait_for(
+                    self.websocket.send_text(message), WS_SEND_TIMEOUT
+                )
+                self.sent_count += 1
+            except (asyncio.TimeoutError, WebSocketDisconnect, RuntimeError, OSError):
+                self._on_failure(self, WS_CLOSE_INTERNAL_ERROR)
+                return
+
+    def close(self):
+        """Dừng task ghi (không tự hủy khi được gọi từ chính task ghi)"""
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "user_type": self.user_type,
+            "username": self.username,
+            "queue_depth": self.queue.qsize(),
+            "sent": self.sent_count,
+            "dropped": self.dropped_count,
+        }
 
 
 class WebSocketManager:
-    def __init__(self):
-        self.active_connections: dict[str, dict[str, WebSocket] | list[WebSocket]] = {
-            "user": {},  # Lưu kết nối user theo username
+    def __init__(self, broker=None):
+        self.active_connections: dict[
+            str, dict[str, set[WebSocket]] | list[WebSocket]
+        ] = {
+            "user": {},  # Lưu tập kết nối (nhiều thiết bị) của user theo username
             "admin": [],  # Lưu danh sách WebSocket của admin
         }
+        self.outboxes: dict[WebSocket, ConnectionOutbox] = {}
+        # Tổng số tin bị bỏ của các kết nối đã đóng (phục vụ giám sát)
+        self.closed_dropped_count = 0
+        # Mọi tin gửi đi đều qua broker để các worker khác cũng giao được cho socket
+        # đang kết nối tại worker đó
+        self.broker = broker or create_broker()
+        self.broker.subscribe(self._deliver_local)
+        # Callback (username, is_online) khi user có thiết bị đầu tiên/mất thiết bị cuối
+        self.presence_listeners: list[Callable[[str, bool], None]] = []
+        # Giữ tham chiếu các task đóng socket để không bị thu gom giữa chừng
+        self._close_tasks: set[asyncio.Task] = set()
+
+    async def start(self):
+        await self.broker.start()
+
+    async def stop(self):
+        await self.broker.stop()
 
     async def connect(self, websocket: WebSocket, user_type: str, username: str = None):
         """Xử lý khi một user hoặc admin kết nối WebSocket"""
         await websocket.accept()
+        came_online = False
         if user_type == "user" and username:
-            self.active_connections["user"][username] = websocket
+            came_online = username not in self.active_connections["user"]
+            self.active_connections["user"].setdefault(username, set()).add(websocket)
         elif user_type == "admin":
             self.active_connections["admin"].append(websocket)
+        else:
+            return
+        self.outboxes[websocket] = ConnectionOutbox(
+            websocket, user_type, username, self._on_send_failure
+        )
+        if came_online:
+            self._emit_presence(username, True)
 
     def disconnect(self, websocket: WebSocket, user_type: str, username: str = None):
         """Xử lý khi một user hoặc admin mất kết nối"""
         if user_type == "user" and username:
-            self.active_connections["user"].pop(username, None)
+            # Chỉ gỡ đúng socket vừa đóng, giữ nguyên các thiết bị khác của user
+            connections = self.active_connections["user"].get(username)
+            if connections is not None:
+                connections.discard(websocket)
+                if not connections:
+                    del self.active_connections["user"][username]
+                    self._emit_presence(username, False)
         elif user_type == "admin" and websocket in self.active_connections["admin"]:
             self.active_connections["admin"].remove(websocket)
 
-    async def send_message(self, message: str, user_type: str):
-        """Gửi tin nhắn đến đúng nhóm user hoặc admin"""
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox:
+            self.closed_dropped_count += outbox.dropped_count
+            outbox.close()
+
+    def add_presence_listener(self, listener: Callable[[str, bool], None]):
+        self.presence_listeners.append(listener)
+
+    def _emit_presence(self, username: str, is_online: bool):
+        for listener in self.presence_listeners:
+            listener(username, is_online)
+
+    def heartbeat(self, websocket: WebSocket):
+        """Ghi nhận client vẫn còn sống"""
+        outbox = self.outboxes.get(websocket)
+        if outbox:
+            outbox.last_heartbeat = time.monotonic()
+
+    def is_online(self, username: str) -> bool:
+        return username in self.active_connections["user"]
+
+    def online_usernames(self) -> list[str]:
+        return list(self.active_connections["user"])
+
+    def stale_connections(self, timeout: float) -> list[ConnectionOutbox]:
+        """Các kết nối user không gửi heartbeat trong `timeout` giây"""
+        deadline = time.monotonic() - timeout
+        return [
+            outbox
+            for outbox in self.outboxes.values()
+            if outbox.user_type == "user" and outbox.last_heartbeat < deadline
+        ]
+
+    def _on_send_failure(self, outbox: ConnectionOutbox, code: int):
+        """Loại bỏ kết nối gửi lỗi, quá hạn hoặc tràn hàng đợi (chính sách disconnect),
+        rồi đóng hẳn socket để client biết mà kết nối lại thay vì treo im lặng"""
+        self.disconnect(outbox.websocket, outbox.user_type, outbox.username)
+        task = asyncio.create_task(self._close_socket(outbox.websocket, code))
+        self._close_tasks.add(task)
+        task.add_done_callback(self._close_tasks.discard)
+
+    async def _close_socket(self, websocket: WebSocket, code: int):
+        try:
+            await asyncio.wait_for(websocket.close(code=code), WS_SEND_TIMEOUT)
+        except (asyncio.TimeoutError, WebSocketDisconnect, RuntimeError, OSError):
+            # Socket đã đóng hoặc không còn phản hồi: không còn gì để làm
+            pass
+
+    def _enqueue(self, connection: WebSocket, message: str):
+        outbox = self.outboxes.get(connection)
+        if outbox:
+            outbox.enqueue(message)
+
+    def _enqueue_to_user(self, username: str, message: str) -> bool:
+        """Gửi tới mọi thiết bị của user, trả về False nếu user không có kết nối"""
+        connections = self.active_connections["user"].get(username)
+        if not connections:
+            return False
+        for connection in list(connections):
+            self._enqueue(connection, message)
+        return True
+
+    def get_stats(self) -> dict:
+        """Độ sâu hàng đợi và số tin bị bỏ của từng kết nối"""
+        connections = [outbox.stats() for outbox in self.outboxes.values()]
+        return {
+            "connections": len(connections),
+            "queue_size": WS_QUEUE_SIZE,
+            "overflow_policy": WS_OVERFLOW_POLICY,
+            "total_queued": sum(c["queue_depth"] for c in connections),
+            "total_dropped": self.closed_dropped_count
+            + sum(c["dropped"] for c in connections),
+            "details": connections,
+        }
+
+    def _deliver_local(self, envelope: dict):
+        """Giao envelope nhận từ broker cho các socket đang kết nối tại tiến trình này"""
+        if envelope["kind"] == "users":
+            for username in envelope["usernames"]:
+                self._enqueue_to_user(username, envelope["message"])
+            return
+        if envelope["kind"] != "user_type":
+            # Envelope khác (vd. presence) do subscriber khác của broker xử lý
+            return
+
+        message = envelope["message"]
+
+        user_type = envelope["user_type"]
         if user_type in self.active_connections:
             if isinstance(
                 self.active_connections[user_type], list
             ):  # Kiểm tra xem là danh sách WebSocket
-                for connection in self.active_connections[user_type]:
-                    try:
-                        await connection.send_text(message)
-                    except WebSocketDisconnect:
-                        self.disconnect(connection, user_type)
+                for connection in list(self.active_connections[user_type]):
+                    self._enqueue(connection, message)
             elif isinstance(
                 self.active_connections[user_type], dict
             ):  # Kiểm tra kiểu từ 'user'
-                for connection in self.active_connections[
-                    user_type
-                ].values():  # Duyệt qua các kết nối user theo username
-                    try:
-                        await connection.send_text(message)
-                    except WebSocketDisconnect:
-                        self.disconnect(connection, user_type)
+                for username in list(
+                    self.active_connections[user_type]
+                ):  # Duyệt qua các kết nối user theo username
+                    self._enqueue_to_user(username, message)
             else:
                 print(
                     f"Lỗi: active_connections[{user_type}] không phải là kiểu hợp lệ."
@@ -55,6 +255,12 @@ class WebSocketManager:
         else:
             print(f"Lỗi: Không có kết nối cho loại người dùng '{user_type}'")
 
+    async def send_message(self, message: str, user_type: str):
+        """Gửi tin nhắn đến đúng nhóm user hoặc admin"""
+        await self.broker.publish(
+            {"kind": "user_type", "user_type": user_type, "message": message}
+        )
+
     async def notify_new_report(
         self,
         report_id: int,
@@ -110,24 +316,30 @@ class WebSocketManager:
 
         if user_username == "admin":
             # Gửi thông báo đến tất cả admin đang kết nối
-            for admin_ws in self.active_connections["admin"]:
-                try:
-                    await admin_ws.send_text(notification_data)
-                except WebSocketDisconnect:
-                    self.active_connections["admin"].remove(admin_ws)
+            await self.send_message(notification_data, "admin")
         else:
-            # Gửi thông báo đến user cụ thể
-            connection = self.active_connections["user"].get(user_username)
-            if connection:
-                try:
-                    await connection.send_text(notification_data)
-                except WebSocketDisconnect:
-                    self.active_connections["user"].pop(user_username, None)
+            # Gửi thông báo đến mọi thiết bị của user cụ thể
+            await self.broadcast_to_users([user_username], notification_data)
+
+    async def broadcast_to_users(self, usernames: List[str], message: str):
+        """Đưa một tin vào hàng đợi của nhiều user; việc gửi do task ghi đảm nhận"""
+        if usernames:
+            await self.broker.publish(
+                {"kind": "users", "usernames": list(usernames), "message": message}
+            )
 
     async def send_chat_message(
         self, conversation_id: int, recipient_username: str, message_data: dict
     ):
         """Gửi tin nhắn real-time đến người nhận"""
+        await self.broadcast_chat_message(
+            conversation_id, [recipient_username], message_data
+        )
+
+    async def broadcast_chat_message(
+        self, conversation_id: int, recipient_usernames: List[str], message_data: dict
+    ):
+        """Gửi tin nhắn real-time đồng thời đến tất cả người nhận trong cuộc hội thoại"""
         message = json.dumps(
             {
                 "type_socket": "new_message",
@@ -135,15 +347,7 @@ class WebSocketManager:
                 "message": message_data,
             }
         )
-
-        connection = self.active_connections["user"].get(recipient_username)
-        if connection:
-            try:
-                await connection.send_text(message)
-            except WebSocketDisconnect:
-                self.disconnect(connection, "user", recipient_username)
-        else:
-            print(f"❌ Người nhận {recipient_username} không có kết nối WebSocket.")
+        await self.broadcast_to_users(recipient_usernames, message)
 
 
 websocket_manager = WebSocketManager()
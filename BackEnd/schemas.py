@@ -136,6 +136,7 @@ class FriendResponse(BaseModel):
     username: str
     nickname: str | None = None
     avatar: str | None = None
+    is_online: bool = False
 
     class Config:
         from_attributes = True
@@ -169,6 +170,29 @@ class NotificationResponse(BaseModel):
         from_attributes = True
 
 
+# Số lượng chưa đọc cho các huy hiệu (badge) trên giao diện
+class UnreadCountsResponse(BaseModel):
+    conversations: dict[int, int]  # conversation_id -> số tin nhắn chưa đọc
+    messages: int
+    notifications: int
+    friend_requests: int
+
+
+# Phiên tải lên file đính kèm theo từng phần (có thể tiếp tục khi bị ngắt)
+class UploadSessionCreate(BaseModel):
+    filename: str
+    size: int = Field(gt=0)  # Tổng số byte của file
+    content_type: str | None = None  # Mặc định: đoán từ phần mở rộng của filename
+
+
+class UploadSessionResponse(BaseModel):
+    upload_id: str
+    filename: str
+    size: int
+    offset: int  # Số byte server đã nhận, client gửi tiếp từ vị trí này
+    expires_at_UTC: datetime
+
+
 # Schema cho tạo cuộc hội thoại
 class ConversationCreate(BaseModel):
     type: str  # "private" hoặc "group"
@@ -198,6 +222,8 @@ class ConversationResponse(BaseModel):
     created_at_UTC: datetime | None
     is_read: bool = False
     last_message_time: datetime | None = None
+    last_message_preview: str | None = None
+    unread_count: int = 0
     group_members: Optional[List[GroupMemberResponse]] = []
 
     class Config:
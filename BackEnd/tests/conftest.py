@@ -0,0 +1,58 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Cho phép import các module của BackEnd khi chạy pytest từ bất kỳ thư mục nào
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Mỗi lần chạy test dùng một thư mục tạm: SQLite và file tải lên không đụng vào dữ
+# liệu thật. Phải đặt trước khi bất kỳ test nào import database
+WORK_DIR = tempfile.mkdtemp(prefix="chat-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(WORK_DIR, 'test.db')}"
+os.chdir(WORK_DIR)
+
+TEST_PASSWORD = "Matkhau123@"
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    from main import app
+
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(scope="session")
+def register(client):
+    """Tạo user qua /auth/register, trả về header Authorization của user đó"""
+
+    def _register(username: str, nickname: str | None = None) -> dict:
+        response = client.post(
+            "/auth/register",
+            json={
+                "username": username,
+                "nickname": nickname or username,
+                "email": f"{username}@example.com",
+                "password": TEST_PASSWORD,
+            },
+        )
+        assert response.status_code == 200, response.text
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    return _register
+
+
+@pytest.fixture(scope="session")
+def befriend():
+    from database import SessionLocal
+    from routers.untils import new_friendship
+
+    def _befriend(username: str, friend_username: str):
+        with SessionLocal() as db:
+            db.add_all(new_friendship(username, friend_username))
+            db.commit()
+
+    return _befriend
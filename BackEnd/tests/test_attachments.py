@@ -0,0 +1,132 @@
+import hashlib
+import os
+
+import pytest
+
+CONTENT = bytes(range(256)) * 40  # 10240 byte
+
+
+@pytest.fixture(scope="module")
+def blob_url(client):
+    from routers.uploads import blob_url
+
+    content_hash = hashlib.sha256(CONTENT).hexdigest()
+    path = blob_url(content_hash, "pdf")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(CONTENT)
+    return "/" + path
+
+
+def test_full_blob_has_strong_etag_and_long_cache(client, blob_url):
+    response = client.get(blob_url)
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert response.headers["content-type"] == "application/pdf"
+    assert response.headers["etag"] == f'"{hashlib.sha256(CONTENT).hexdigest()}"'
+    assert "immutable" in response.headers["cache-control"]
+    assert response.headers["accept-ranges"] == "bytes"
+
+
+def test_byte_range_returns_partial_content(client, blob_url):
+    response = client.get(blob_url, headers={"Range": "bytes=100-1123"})
+
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 100-1123/{len(CONTENT)}"
+    assert response.headers["content-length"] == "1024"
+    assert response.content == CONTENT[100:1124]
+
+
+def test_open_ended_and_suffix_ranges(client, blob_url):
+    tail = client.get(blob_url, headers={"Range": "bytes=10000-"})
+    assert tail.status_code == 206
+    assert tail.content == CONTENT[10000:]
+
+    suffix = client.get(blob_url, headers={"Range": "bytes=-40"})
+    assert suffix.status_code == 206
+    assert suffix.headers["content-range"] == (
+        f"bytes {len(CONTENT) - 40}-{len(CONTENT) - 1}/{len(CONTENT)}"
+    )
+    assert suffix.content == CONTENT[-40:]
+
+
+def test_unsatisfiable_range_returns_416(client, blob_url):
+    response = client.get(blob_url, headers={"Range": f"bytes={len(CONTENT)}-"})
+
+    assert response.status_code == 416
+    # Starlette 0.46 bỏ đơn vị "bytes " trong Content-Range của 416
+    assert response.headers["content-range"].endswith(f"*/{len(CONTENT)}")
+
+
+def test_matching_etag_returns_304_without_body(client, blob_url):
+    etag = client.get(blob_url).headers["etag"]
+
+    for if_none_match in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+        response = client.get(blob_url, headers={"If-None-Match": if_none_match})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["etag"] == etag
+
+    assert client.get(blob_url, headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_blob_path_must_match_its_hash_prefix(client, blob_url):
+    filename = blob_url.rsplit("/", 1)[1]
+
+    assert client.get(f"/uploads/blobs/zz/{filename}").status_code == 404
+    assert client.get(f"/uploads/blobs/{filename[:2]}/missing.pdf").status_code == 404
+
+
+def test_failed_blob_store_leaves_no_attachment_rows(
+    client, register, befriend, monkeypatch
+):
+    import models
+    from database import SessionLocal
+    from routers.uploads import SpooledUpload
+
+    headers = register("luu_loi", "Lưu Lỗi")
+    register("ban_luu", "Bạn Lưu")
+    befriend("luu_loi", "ban_luu")
+    conversation_id = client.post(
+        "/conversations/",
+        params={"type": "private", "username": ["ban_luu"]},
+        headers=headers,
+    ).json()["conversation_id"]
+
+    # File đầu vào kho blob bình thường, file thứ hai lỗi khi ghi
+    store_blob = SpooledUpload.store_blob
+    calls = []
+
+    async def failing_store_blob(self):
+        calls.append(self)
+        if len(calls) == 2:
+            raise OSError("đĩa đầy")
+        await store_blob(self)
+
+    monkeypatch.setattr(SpooledUpload, "store_blob", failing_store_blob)
+    files = [
+        ("files", ("a.pdf", b"noi dung a", "application/pdf")),
+        ("files", ("b.pdf", b"noi dung b", "application/pdf")),
+    ]
+    with pytest.raises(OSError):
+        client.post(
+            "/messages/",
+            params={"conversation_id": conversation_id},
+            files=files,
+            headers=headers,
+        )
+
+    assert len(calls) == 2
+    with SessionLocal() as db:
+        assert (
+            db.query(models.Message)
+            .filter(models.Message.conversation_id == conversation_id)
+            .count()
+            == 0
+        )
+        file_urls = [url for (url,) in db.query(models.Attachment.file_url)]
+    assert all(os.path.isfile(url) for url in file_urls)
+    # Blob của file đầu đã được trả về file tạm và dọn đi
+    assert not os.path.exists(calls[0].blob_url)
+    assert not os.path.exists(calls[0].temp_path)
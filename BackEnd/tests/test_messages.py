@@ -0,0 +1,124 @@
+from datetime import datetime, timezone
+
+import pytest
+
+
+@pytest.fixture
+def count_queries():
+    """Đếm số câu SQL mà engine async (router messages dùng) chạy trong khối with"""
+    from contextlib import contextmanager
+
+    from database import async_engine
+    from sqlalchemy import event
+
+    @contextmanager
+    def _count():
+        statements = []
+
+        def on_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        engine = async_engine.sync_engine
+        event.listen(engine, "before_cursor_execute", on_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, "before_cursor_execute", on_execute)
+
+    return _count
+
+
+def add_messages_with_attachments(conversation_id: int, sender_id: int, count: int):
+    import models
+    from database import SessionLocal
+
+    with SessionLocal() as db:
+        for index in range(count):
+            message = models.Message(
+                sender_id=sender_id,
+                conversation_id=conversation_id,
+                content=f"tin {index}",
+                timestamp=datetime.now(timezone.utc),
+                is_read=False,
+            )
+            db.add(message)
+            db.flush()
+            db.add_all(
+                models.Attachment(
+                    message_id=message.message_id,
+                    file_url=f"uploads/blobs/00/{index:064d}.{extension}",
+                    file_type="application/octet-stream",
+                    file_size=1,
+                )
+                for extension in ("png", "pdf")
+            )
+        db.commit()
+
+
+def test_get_messages_query_count_does_not_grow_with_page_size(
+    client, register, befriend, count_queries
+):
+    headers = register("doc_tin", "Đọc Tin")
+    register("gui_tin", "Gửi Tin")
+    befriend("doc_tin", "gui_tin")
+    conversation_id = client.post(
+        "/conversations/",
+        params={"type": "private", "username": ["gui_tin"]},
+        headers=headers,
+    ).json()["conversation_id"]
+    sender_id = client.get("/users/", headers=headers).json()["user_id"]
+    add_messages_with_attachments(conversation_id, sender_id, 60)
+
+    counts = {}
+    for limit in (5, 50):
+        with count_queries() as statements:
+            response = client.get(
+                f"/messages/{conversation_id}/messages",
+                params={"limit": limit},
+                headers=headers,
+            )
+        assert response.status_code == 200, response.text
+        page = response.json()["messages"]
+        assert len(page) == limit
+        assert all(len(message["attachments"]) == 2 for message in page)
+        counts[limit] = len(statements)
+
+    # Hội thoại, thành viên, trang tin nhắn, file đính kèm (một IN), con trỏ đọc
+    assert counts == {5: 5, 50: 5}
+
+
+def test_deleted_message_is_not_searchable(client, register, befriend):
+    from database import SessionLocal
+    from maintenance import rebuild_search_index
+
+    headers = register("xoa_tin", "Xóa Tin")
+    register("ban_xoa", "Bạn Xóa")
+    befriend("xoa_tin", "ban_xoa")
+    conversation_id = client.post(
+        "/conversations/",
+        params={"type": "private", "username": ["ban_xoa"]},
+        headers=headers,
+    ).json()["conversation_id"]
+    response = client.post(
+        "/messages/",
+        params={"conversation_id": conversation_id, "content": "mật khẩu wifi"},
+        headers=headers,
+    )
+    assert response.status_code == 200, response.text
+    message_id = response.json()["message_id"]
+
+    def search(q: str) -> list[int]:
+        response = client.get("/search/messages", params={"q": q}, headers=headers)
+        assert response.status_code == 200, response.text
+        return [message["message_id"] for message in response.json()["messages"]]
+
+    assert search("wifi") == [message_id]
+    response = client.put(f"/messages/delete/{message_id}", headers=headers)
+    assert response.status_code == 200, response.text
+    assert search("wifi") == []
+
+    # Dựng lại chỉ mục cũng không đưa tin đã xóa (cả tên người xóa) trở lại
+    with SessionLocal() as db:
+        rebuild_search_index(db)
+    assert search("wifi") == []
+    assert search("xoa tin") == []
@@ -0,0 +1,138 @@
+import asyncio
+import json
+
+import pytest
+from routers import pubsub
+from routers.pubsub import RedisBroker
+
+
+class StandInPubSub:
+    """Thay thế redis.asyncio PubSub: nhận tin qua hàng đợi, có thể bị ngắt kết nối"""
+
+    def __init__(self, server: "StandInRedis"):
+        self.server = server
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.channels: set[str] = set()
+
+    async def subscribe(self, channel: str):
+        if self.server.down:
+            raise ConnectionError("redis không phản hồi")
+        self.channels.add(channel)
+        self.server.subscribers.append(self)
+
+    async def listen(self):
+        while True:
+            item = await self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    async def aclose(self):
+        if self in self.server.subscribers:
+            self.server.subscribers.remove(self)
+
+
+class StandInRedis:
+    """Máy chủ pub/sub trong bộ nhớ dùng chung giữa nhiều RedisBroker (nhiều worker)"""
+
+    def __init__(self):
+        self.subscribers: list[StandInPubSub] = []
+        self.down = False
+
+    def pubsub(self) -> StandInPubSub:
+        return StandInPubSub(self)
+
+    async def publish(self, channel: str, data: str) -> int:
+        receivers = [sub for sub in self.subscribers if channel in sub.channels]
+        for sub in receivers:
+            sub.queue.put_nowait({"type": "message", "channel": channel, "data": data})
+        return len(receivers)
+
+    def drop_connections(self):
+        for sub in list(self.subscribers):
+            sub.queue.put_nowait(ConnectionError("mất kết nối"))
+        self.subscribers.clear()
+
+    async def aclose(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def fast_reconnect(monkeypatch):
+    monkeypatch.setattr(pubsub, "WS_BROKER_RECONNECT_DELAY", 0.01)
+    monkeypatch.setattr(pubsub, "WS_BROKER_RECONNECT_MAX_DELAY", 0.05)
+
+
+async def wait_until(condition, timeout: float = 1.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "hết thời gian chờ"
+        await asyncio.sleep(0.005)
+
+
+def make_worker(server: StandInRedis) -> tuple[RedisBroker, list[dict]]:
+    received = []
+    broker = RedisBroker("", client=server)
+    broker.subscribe(received.append)
+    return broker, received
+
+
+def test_publish_reaches_every_worker_including_sender():
+    async def scenario():
+        server = StandInRedis()
+        (first, first_received), (second, second_received) = (
+            make_worker(server),
+            make_worker(server),
+        )
+        await first.start()
+        await second.start()
+
+        await first.publish({"kind": "users", "usernames": ["an"], "message": "hi"})
+        await wait_until(lambda: first_received and second_received)
+
+        assert first_received == second_received
+        assert first_received[0]["usernames"] == ["an"]
+        await first.stop()
+        await second.stop()
+
+    asyncio.run(scenario())
+
+
+def test_listener_reconnects_after_connection_drop():
+    async def scenario():
+        server = StandInRedis()
+        broker, received = make_worker(server)
+        await broker.start()
+
+        # Redis tạm thời không nhận kết nối: listener phải thử lại chứ không dừng
+        server.down = True
+        server.drop_connections()
+        await asyncio.sleep(0.05)
+        assert not broker._listener.done()
+
+        server.down = False
+        await wait_until(lambda: broker.reconnects == 1)
+        await broker.publish({"kind": "users", "usernames": ["an"], "message": "lại"})
+        await wait_until(lambda: received)
+
+        assert received[0]["message"] == "lại"
+        await broker.stop()
+
+    asyncio.run(scenario())
+
+
+def test_bad_envelope_does_not_stop_listener():
+    async def scenario():
+        server = StandInRedis()
+        broker, received = make_worker(server)
+        await broker.start()
+
+        await server.publish(broker.channel, "không phải json")
+        await server.publish(broker.channel, json.dumps({"kind": "users"}))
+        await wait_until(lambda: received)
+
+        assert received == [{"kind": "users"}]
+        assert not broker._listener.done()
+        await broker.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,52 @@
+import os
+
+CONTENT = b"%PDF-1.4 noi dung thu"
+
+
+def create_session(client, headers) -> str:
+    response = client.post(
+        "/upload-sessions/",
+        json={"filename": "a.pdf", "size": len(CONTENT)},
+        headers=headers,
+    )
+    assert response.status_code == 200, response.text
+    upload_id = response.json()["upload_id"]
+    response = client.put(
+        f"/upload-sessions/{upload_id}",
+        params={"offset": 0},
+        content=CONTENT,
+        headers=headers,
+    )
+    assert response.status_code == 200, response.text
+    assert response.json()["offset"] == len(CONTENT)
+    return upload_id
+
+
+def test_chunk_after_claim_does_not_reopen_session(client, register, monkeypatch):
+    from routers import upload_sessions
+
+    headers = register("tai_len", "Tải Lên")
+    upload_id = create_session(client, headers)
+
+    # Tin nhắn giữ phiên ngay sau khi PUT đọc meta, trước khi PUT giữ khóa phiên
+    load_upload_session = upload_sessions.load_upload_session
+
+    def load_then_claim(upload_id: str, username: str) -> dict:
+        meta = load_upload_session(upload_id, username)
+        os.rename(
+            upload_sessions._meta_path(meta["upload_id"]),
+            upload_sessions._claimed_path(meta["upload_id"]),
+        )
+        return meta
+
+    monkeypatch.setattr(upload_sessions, "load_upload_session", load_then_claim)
+    response = client.put(
+        f"/upload-sessions/{upload_id}",
+        params={"offset": len(CONTENT)},
+        content=b"",
+        headers=headers,
+    )
+
+    assert response.status_code == 409, response.text
+    assert not os.path.exists(upload_sessions._meta_path(upload_id))
+    assert os.path.exists(upload_sessions._claimed_path(upload_id))
@@ -0,0 +1,42 @@
+import asyncio
+
+import anyio.to_thread
+
+
+def make_workers():
+    """Hai cache như ở hai worker, nối với nhau qua cùng một broker"""
+    import models
+    from routers.pubsub import InProcessBroker
+    from routers.user_cache import AuthUserCache
+
+    broker = InProcessBroker()
+    caches = [AuthUserCache(broker), AuthUserCache(broker)]
+    user = models.User(user_id=7, username="bo_nho", nickname="Bộ Nhớ")
+    for cache in caches:
+        cache.put(user)
+    return caches
+
+
+async def settle(cache):
+    await asyncio.gather(*cache._tasks)
+
+
+def test_invalidate_reaches_other_workers():
+    async def scenario():
+        first, second = make_workers()
+        first.invalidate(7)
+        await settle(first)
+        return first.entries, second.entries
+
+    assert asyncio.run(scenario()) == ({}, {})
+
+
+def test_invalidate_from_threadpool_reaches_other_workers():
+    # Handler đồng bộ (vd. admin xóa user) gọi invalidate từ luồng của threadpool
+    async def scenario():
+        first, second = make_workers()
+        await anyio.to_thread.run_sync(first.invalidate, 7)
+        await settle(first)
+        return first.entries, second.entries
+
+    assert asyncio.run(scenario()) == ({}, {})
@@ -0,0 +1,27 @@
+def search_all_pages(client, headers, query: str, limit: int) -> list[str]:
+    usernames, cursor = [], None
+    while True:
+        params = {"query": query, "search_by_nickname": True, "limit": limit}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/users/search", params=params, headers=headers)
+        assert response.status_code == 200, response.text
+        usernames += [user["username"] for user in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            return usernames
+
+
+def test_user_matching_several_terms_appears_once_across_pages(client, register):
+    headers = register("tim_kiem", "Người Tìm")
+    # "An Nguyễn" khớp "an" qua cả từ "an" lẫn cả nickname "an nguyen"
+    register("an_nguyen", "An Nguyễn")
+    register("an_tran", "An Trần")
+    register("anh_le", "Anh Lê")
+
+    for limit in (1, 2, 50):
+        usernames = search_all_pages(client, headers, "an", limit)
+        assert sorted(usernames) == ["an_nguyen", "an_tran", "anh_le"]
+        # Khớp nguyên từ "an" đứng trước khớp tiền tố "anh"
+        assert usernames[-1] == "anh_le"
+
@@ -5,12 +5,16 @@ import toggleReportsList from './report.js';
 // Các biến toàn cục
 let selectedFiles = [];
 let currentConversationId = null;
-let messageOffset = 0;
+let messageCursor = null;
+let hasMoreMessages = true;
 let isLoadingMessages = false;
 const messageLimit = 20;
 let isReloadConfirmed = true;
 // Thêm biến để quản lý WebSocket
 let socket = null;
+let heartbeatTimer = null;
+// Gửi heartbeat định kỳ để server biết kết nối còn sống (presence)
+const HEARTBEAT_INTERVAL_MS = 25000;
 
 // Hàm lấy người dùng trong localstorage
 function getCurrentUser() {
@@ -53,14 +57,9 @@ async function loadConversations() {
       return;
     }
 
+    // Server đã sắp xếp theo hoạt động gần nhất
     const conversations = await response.json();
 
-    conversations.sort((a, b) => {
-      const timeA = a.last_message_time ? new Date(a.last_message_time) : new Date(0);
-      const timeB = b.last_message_time ? new Date(b.last_message_time) : new Date(0);
-      return timeB - timeA;
-    });
-
     const chatList = document.querySelector('.chat-list');
     const noResultItem = chatList.querySelector('.no-results');
     chatList.innerHTML = '';
@@ -170,14 +169,9 @@ async function loadConversationsForWebSocket() {
       return;
     }
 
+    // Server đã sắp xếp theo hoạt động gần nhất
     const conversations = await response.json();
 
-    conversations.sort((a, b) => {
-      const timeA = a.last_message_time ? new Date(a.last_message_time) : new Date(0);
-      const timeB = b.last_message_time ? new Date(b.last_message_time) : new Date(0);
-      return timeB - timeA;
-    });
-
     const chatList = document.querySelector('.chat-list');
     const noResultItem = chatList.querySelector('.no-results');
     chatList.innerHTML = '';
@@ -267,14 +261,18 @@ async function loadMessages(conversationId, conversationName, isInitial = true)
     chatHeader.dataset.id = conversationId;
     document.getElementById('conversation-name').textContent = conversationName;
     chatContent.innerHTML = '';
-    messageOffset = 0;
+    messageCursor = null;
+    hasMoreMessages = true;
   }
 
-  if (isLoadingMessages) return;
+  if (isLoadingMessages || !hasMoreMessages) return;
   isLoadingMessages = true;
 
   try {
-    const response = await fetch(`${config.baseURL}/messages/${conversationId}/messages?limit=${messageLimit}&offset=${messageOffset}`, {
+    const params = new URLSearchParams({ limit: messageLimit });
+    if (messageCursor) params.append('cursor', messageCursor);
+
+    const response = await fetch(`${config.baseURL}/messages/${conversationId}/messages?${params.toString()}`, {
       headers: {
         Authorization: `Bearer ${token}`,
         Accept: 'application/json',
@@ -289,6 +287,9 @@ async function loadMessages(conversationId, conversationName, isInitial = true)
     const data = await response.json();
     const messages = data.messages || [];
 
+    messageCursor = data.next_cursor || null;
+    hasMoreMessages = Boolean(messageCursor);
+
     if (messages.length === 0) return;
 
     const oldScrollHeight = chatContent.scrollHeight;
@@ -306,8 +307,6 @@ async function loadMessages(conversationId, conversationName, isInitial = true)
       }, 0);
     }
 
-    messageOffset += messages.length;
-
     // Cập nhật thông tin cuộc trò chuyện nếu sidebar đang mở
     const sidebar = document.getElementById('conversation-info-sidebar');
     if (sidebar.style.display === 'flex') {
@@ -320,15 +319,25 @@ async function loadMessages(conversationId, conversationName, isInitial = true)
   }
 }
 
+function resolveFileUrl(fileUrl) {
+  return fileUrl.startsWith('http') ? fileUrl : `${config.baseURL}/${fileUrl.replace(/^\/+/, '')}`;
+}
+
 function createAttachmentElement(att) {
-  const fixedFileUrl = att.file_url.startsWith('http') ? att.file_url : `${config.baseURL}/${att.file_url.replace(/^\/+/, '')}`;
+  const fixedFileUrl = resolveFileUrl(att.file_url);
 
   const isImage = /\.(jpg|jpeg|png|gif)$/i.test(fixedFileUrl);
 
   // Nếu là ảnh
   if (isImage) {
     const img = document.createElement('img');
-    img.src = fixedFileUrl;
+    // Hiển thị ảnh thu nhỏ nếu server đã tạo xong, ảnh gốc chỉ tải khi mở xem
+    img.src = att.thumbnail_url ? resolveFileUrl(att.thumbnail_url) : fixedFileUrl;
+    img.loading = 'lazy';
+    if (att.width && att.height) {
+      img.width = att.width;
+      img.height = att.height;
+    }
     img.className = 'attachment-img has-context';
     img.alt = 'Ảnh đính kèm';
     img.setAttribute('data-url', fixedFileUrl);
@@ -380,6 +389,16 @@ function createAttachmentElement(att) {
   fileLink.className = 'attachment-file';
   fileLink.textContent = '';
 
+  // Khung hình đại diện của video
+  if (att.thumbnail_url && /\.(mp4)$/i.test(fixedFileUrl)) {
+    const poster = document.createElement('img');
+    poster.src = resolveFileUrl(att.thumbnail_url);
+    poster.className = 'attachment-poster';
+    poster.loading = 'lazy';
+    poster.alt = 'Video đính kèm';
+    fileLink.appendChild(poster);
+  }
+
   fileWrapper.appendChild(fileLink);
 
   // Gửi HEAD request để kiểm tra file tồn tại
@@ -538,7 +557,7 @@ document.addEventListener('click', function (e) {
     const modal = document.getElementById('image-modal');
     const modalImg = document.getElementById('modal-image');
     modal.style.display = 'flex';
-    modalImg.src = e.target.src;
+    modalImg.src = e.target.dataset.url || e.target.src;
   }
 
   if (e.target.classList.contains('close-btn') || e.target.id === 'image-modal') {
@@ -647,6 +666,10 @@ function connectWebSocket() {
 
   socket.onopen = () => {
     console.log('✅ WebSocket đã kết nối');
+    clearInterval(heartbeatTimer);
+    heartbeatTimer = setInterval(() => {
+      if (socket.readyState === WebSocket.OPEN) socket.send('ping');
+    }, HEARTBEAT_INTERVAL_MS);
   };
 
   socket.onmessage = async (event) => {
@@ -661,6 +684,14 @@ function connectWebSocket() {
         window.dispatchEvent(updateEvent);
       }
 
+      // Bạn bè online/offline
+      if (data.type_socket === 'presence_update') {
+        const presenceEvent = new CustomEvent('presence-update', {
+          detail: data,
+        });
+        window.dispatchEvent(presenceEvent);
+      }
+
       // Xử lý thông báo hệ thống
       if (data.type_socket === 'new_notification') {
         // Hiển thị toast thông báo
@@ -744,6 +775,7 @@ function connectWebSocket() {
   };
 
   socket.onclose = () => {
+    clearInterval(heartbeatTimer);
     console.log('❌ WebSocket đã đóng, đang kết nối lại...');
     setTimeout(connectWebSocket, 2000);
   };
@@ -778,34 +810,17 @@ function setupMarkMessagesReadOnClick() {
         return;
       }
 
-      // Duyệt qua tất cả tin nhắn chưa đọc và gửi yêu cầu PUT cho từng tin nhắn
-      for (const unreadMessage of unreadMessages) {
-        const messageDiv = unreadMessage.closest('.message');
-        if (!messageDiv) continue;
-
-        const messageId = messageDiv.dataset.messageId;
-        if (!messageId) continue;
-
-        // Gửi yêu cầu PUT để đánh dấu tin nhắn là đã đọc
-        await fetch(`${config.baseURL}/messages/mark-read/${messageId}`, {
-          method: 'PUT',
-          headers: {
-            Authorization: `Bearer ${token}`,
-          },
-        });
-
-        // Xóa thẻ 'unread-label' trong UI sau khi đánh dấu là đã đọc
-        unreadMessage.remove();
-      }
-
-      // Đánh dấu cuộc trò chuyện là đã đọc
-      await fetch(`${config.baseURL}/conversations/conversations/${currentConversationId}/mark-read`, {
+      // Dời con trỏ đã đọc tới tin nhắn cuối bằng một yêu cầu duy nhất
+      await fetch(`${config.baseURL}/messages/${currentConversationId}/read`, {
         method: 'PUT',
         headers: {
           Authorization: `Bearer ${token}`,
         },
       });
 
+      // Xóa thẻ 'unread-label' trong UI sau khi đánh dấu là đã đọc
+      unreadMessages.forEach((unreadMessage) => unreadMessage.remove());
+
       // Xóa dấu chấm chưa đọc khỏi cuộc trò chuyện trong danh sách
       const chatItem = document.querySelector(`.chat-item[data-id="${currentConversationId}"]`);
       if (chatItem) {
@@ -824,14 +839,16 @@ async function checkUnreadStatus() {
   if (!token) return;
 
   try {
-    // Kiểm tra thông báo chưa đọc
-    const notiRes = await fetch(`${config.baseURL}/notifications/?unread_only=true`, {
+    // Lấy toàn bộ số lượng chưa đọc trong một lần gọi
+    const countsRes = await fetch(`${config.baseURL}/notifications/unread-counts`, {
       headers: { Authorization: `Bearer ${token}` },
     });
-    const unreadNotis = await notiRes.json();
+    const counts = await countsRes.json();
+
+    // Kiểm tra thông báo chưa đọc
     const bellBtn = document.querySelector('.sidebar-toggle-container button[title="Thông báo"] i');
     if (bellBtn) {
-      if (unreadNotis.length > 0) {
+      if (counts.notifications > 0) {
         bellBtn.classList.add('has-unread');
       } else {
         bellBtn.classList.remove('has-unread');
@@ -839,13 +856,9 @@ async function checkUnreadStatus() {
     }
 
     // Kiểm tra yêu cầu kết bạn chưa đọc
-    const friendReqRes = await fetch(`${config.baseURL}/friend-requests/received`, {
-      headers: { Authorization: `Bearer ${token}` },
-    });
-    const friendReqs = await friendReqRes.json();
     const friendReqBtn = document.querySelector('.sidebar-toggle-container button[title="Yêu cầu kết bạn"] i');
     if (friendReqBtn) {
-      if (friendReqs.length > 0) {
+      if (counts.friend_requests > 0) {
         friendReqBtn.classList.add('has-unread');
       } else {
         friendReqBtn.classList.remove('has-unread');
@@ -1349,6 +1362,14 @@ async function submitCreateConversation() {
   }
 }
 
+// Cập nhật trạng thái online của bạn bè đang hiển thị khi nhận presence_update
+window.addEventListener('presence-update', (event) => {
+  const { username, is_online } = event.detail;
+  document.querySelectorAll(`.friend-item[data-username="${CSS.escape(username)}"]`).forEach((item) => {
+    item.classList.toggle('online', is_online);
+  });
+});
+
 // Gắn sự kiện tìm kiếm cho thanh input trong friend-list
 const friendSearchInput = document.querySelector('#friend-list .search');
 const friendListContainer = document.querySelector('.friend-items');
@@ -1466,6 +1487,8 @@ friendSearchInput.addEventListener('input', async function (e) {
       for (const user of friends) {
         const li = document.createElement('li');
         li.className = 'friend-item';
+        li.dataset.username = user.username;
+        li.classList.toggle('online', Boolean(user.is_online));
 
         // Thêm sự kiện click để hiển thị modal thông tin
         li.onclick = () => showUserInfo(user.username);
@@ -1620,6 +1643,8 @@ async function loadFriendList() {
       const friendItem = document.createElement('li');
       friendItem.className = 'friend-item';
       friendItem.onclick = () => showUserInfo(friend.username);
+      friendItem.dataset.username = friend.username;
+      friendItem.classList.toggle('online', Boolean(friend.is_online));
 
       const friendInfo = document.createElement('div');
       friendInfo.className = 'friend-info';
@@ -2059,14 +2084,14 @@ async function checkUnreadNotifications() {
   const token = localStorage.getItem('access_token');
   if (!token) return;
 
-  const res = await fetch(`${config.baseURL}/notifications/?unread_only=true`, {
+  const res = await fetch(`${config.baseURL}/notifications/unread-counts`, {
     headers: { Authorization: `Bearer ${token}` },
   });
 
-  const unread = await res.json();
+  const counts = await res.json();
   const bellBtn = document.querySelector('.sidebar-toggle-container button[title="Thông báo"] i');
 
-  if (unread.length > 0) {
+  if (counts.notifications > 0) {
     bellBtn.classList.add('has-unread');
   } else {
     bellBtn.classList.remove('has-unread');